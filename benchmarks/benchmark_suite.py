@@ -0,0 +1,219 @@
+# Times every stage of the data pipeline and the models on a synthetic MIMIC III extract (see synthetic_mimic.py),
+# so performance changes can be measured without access to MIMIC III:
+#   datasampler       - data_sampling/datasampler.py sampling all stays of the extract, run as a script
+#   preprocess_mp.*   - the sections of data_cleaning/preprocess_mp.py, run one after another as its main does:
+#                       reading the tables, I clean, II exclusions and labels, III normalize, IV window, V pad,
+#                       VI ICD-9 codes and VII writing the outputs
+#   events_to_list    - data_cleaning/events_to_list.py building and saving the event store
+#   collate.*         - collating all stays in batches of --batch-size with the collate function of every encoding
+#   forward.*, backward.* - median forward and backward pass of every model on a batch of --batch-size stays
+#
+# The seconds of every stage are written with the sizes of the data, the configuration and the library versions to
+# a json baseline file (--out). With --compare, the stages are compared with those of an earlier baseline, and the
+# suite exits with status 1 if a stage got slower by more than --tolerance.
+#
+# Usage:
+#   python3 benchmarks/benchmark_suite.py --patients 2000 --out benchmarks/baseline.json
+#   python3 benchmarks/benchmark_suite.py --patients 2000 --out new.json --compare benchmarks/baseline.json
+
+import warnings
+warnings.simplefilter(action='ignore', category=FutureWarning)
+
+import argparse
+import json
+import os
+import pickle
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'data_cleaning'))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'source'))
+import dataloader
+import events_to_list
+import preprocess_mp
+from models import LogisticRegression, LSTMPlusCNN, ReadmissionLSTM
+from synthetic_mimic import generate
+from training import loss_and_predictions, model_output
+
+# stages shorter than this are not compared, as their timings are mostly noise
+MIN_COMPARED_SECONDS = 0.05
+
+
+@contextmanager
+def timed(seconds, stage):
+    start_time = time.perf_counter()
+    yield
+    seconds[stage] = time.perf_counter() - start_time
+    print('{:<32}{:9.3f}s'.format(stage, seconds[stage]))
+
+def run_datasampler(seconds, work_dir, num_stays, workers):
+    command = [sys.executable, os.path.join(ROOT_DIR, 'data_sampling', 'datasampler.py'), '--project-dir', work_dir,
+               '--mimic-path', 'mimic/', '--subset-path', 'subset/', '--sample-size', str(num_stays),
+               '--workers', str(workers)]
+    with timed(seconds, 'datasampler'):
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+
+def run_preprocessing(seconds, mimic_path):
+    # the sections of the main of preprocess_mp.py, writing to the working directory
+    with timed(seconds, 'preprocess_mp.read'):
+        icu_stays = pd.read_csv(mimic_path + 'ICUSTAYS.csv', header=0, parse_dates=['intime', 'outtime'])
+        patients = pd.read_csv(mimic_path + 'PATIENTS.csv', header=0, parse_dates=['dob', 'dod', 'dod_hosp', 'dod_ssn'])
+        icd_9 = pd.read_csv(mimic_path + 'DIAGNOSES_ICD.csv', header=0, dtype={'icd9_code': str})
+        chart_events = preprocess_mp.read_chart_events(mimic_path)
+    with timed(seconds, 'preprocess_mp.I_clean'):
+        chart_events = preprocess_mp.clean_chart_events(chart_events, icu_stays)
+    with timed(seconds, 'preprocess_mp.II_label'):
+        remove, pos = preprocess_mp.find_exclusions(preprocess_mp.first_chart_events(chart_events), icu_stays, patients)
+        chart_events = preprocess_mp.label_chart_events(chart_events, remove, pos)
+    with timed(seconds, 'preprocess_mp.III_normalize'):
+        event_label_stats = chart_events.groupby('itemid')['valuenum'].agg(['mean', 'std'])
+        chart_events = preprocess_mp.normalize_chart_events(chart_events, event_label_stats)
+    with timed(seconds, 'preprocess_mp.IV_window'):
+        chart_events = preprocess_mp.window_chart_events(chart_events)
+    with timed(seconds, 'preprocess_mp.V_pad'):
+        chart_events = preprocess_mp.pad_chart_events(chart_events, chart_events['row_id'].max() + 1)
+    stay_labels = chart_events.drop_duplicates(subset='icustay_id')
+    with timed(seconds, 'preprocess_mp.VI_icd9'):
+        preprocess_mp.write_icd9_codes(icd_9, icu_stays, stay_labels['icustay_id'].to_list())
+    with timed(seconds, 'preprocess_mp.VII_write'):
+        outputs = {'chart_events_df.pickle': chart_events,
+                   'icu_stays.pickle': chart_events['icustay_id'].to_list(),
+                   'evids.pickle': chart_events['row_id'].to_list(),
+                   'readmit_labels.pickle': stay_labels['readmit_label'].to_list(),
+                   'categories.pickle': preprocess_mp.category_dict,
+                   'preprocessing.pickle': preprocess_mp.preprocessing_config(event_label_stats)}
+        for name, output in outputs.items():
+            with open(name, 'wb') as f:
+                pickle.dump(output, f)
+    return len(chart_events)
+
+def run_events_to_list(seconds):
+    with timed(seconds, 'events_to_list'):
+        with open('chart_events_df.pickle', 'rb') as f:
+            chart_events = pickle.load(f)
+        chart_events = chart_events.sort_values(['icustay_id', 'hours_from_beginning', 'category_num'])
+        values, counts, offsets = events_to_list.build_event_store(chart_events)
+        events_to_list.save_event_store(values, counts, offsets, 'events', events_to_list.stay_lengths(chart_events))
+
+def run_collate(seconds, dataset, batch_size):
+    items = [dataset[i] for i in range(len(dataset))]
+    for encoding, collate_fn in dataloader.ENCODINGS.items():
+        with timed(seconds, 'collate.{}'.format(encoding)):
+            for start in range(0, len(items), batch_size):
+                collate_fn(items[start:start + batch_size], dataset.shape)
+
+def run_models(seconds, dataset, batch_size, hidden_size, repeats):
+    size = dataloader.input_size(dataset.shape)
+    models = {
+        'lstm-cnn': (LSTMPlusCNN(input_size=size, input_len=dataset.shape[1], feature_len=dataset.num_codes,
+                                 hidden_size=hidden_size), nn.CrossEntropyLoss()),
+        'lstm': (ReadmissionLSTM(input_size=size, input_len=dataset.shape[1], hidden_size=hidden_size),
+                 nn.CrossEntropyLoss()),
+        'logistic': (LogisticRegression(feature_size=dataset.num_codes), nn.BCELoss()),
+    }
+    x, feats, masks, y = dataloader.collate_fn([dataset[i % len(dataset)] for i in range(batch_size)], dataset.shape)
+    for name, (model, criterion) in models.items():
+        model.train()
+        forward_times, backward_times = [], []
+        for _ in range(repeats + 1): # the first pass is a warm-up
+            model.zero_grad()
+            start_time = time.perf_counter()
+            loss, _ = loss_and_predictions(model_output(model, x, feats, masks), y, criterion)
+            forward_times.append(time.perf_counter() - start_time)
+            start_time = time.perf_counter()
+            loss.backward()
+            backward_times.append(time.perf_counter() - start_time)
+        for stage, times in (('forward', forward_times), ('backward', backward_times)):
+            seconds['{}.{}'.format(stage, name)] = float(np.median(times[1:]))
+            print('{:<32}{:9.3f}s'.format('{}.{}'.format(stage, name), seconds['{}.{}'.format(stage, name)]))
+
+def compare(seconds, data, baseline, tolerance):
+    # prints the ratio of every stage to the baseline and returns the stages that got slower than the tolerance
+    regressions = []
+    print('\n{:<32}{:>10}{:>10}{:>8}'.format('stage', 'baseline', 'now', 'ratio'))
+    for stage, old in baseline['seconds'].items():
+        if stage not in seconds:
+            continue
+        ratio = seconds[stage] / old if old else float('nan')
+        regression = old >= MIN_COMPARED_SECONDS and ratio > 1 + tolerance
+        if regression:
+            regressions.append(stage)
+        print('{:<32}{:>9.3f}s{:>9.3f}s{:>7.2f}x{}'.format(stage, old, seconds[stage], ratio,
+                                                        '  slower' if regression else ''))
+    if baseline['data'] != data:
+        print('note: the baseline was run on different data: {}'.format(baseline['data']))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--patients', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='processes of the data sampler')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--hidden-size', type=int, default=128)
+    parser.add_argument('--repeats', type=int, default=5, help='passes of every model, after a warm-up pass')
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads())
+    parser.add_argument('--work-dir', help='directory to keep the data in; a temporary directory by default')
+    parser.add_argument('--out', default='benchmark_results.json', help='baseline file to write')
+    parser.add_argument('--compare', help='baseline file to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown of a stage, as a fraction')
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    out_path = os.path.abspath(args.out)
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    seconds = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        work_dir = os.path.abspath(args.work_dir or temp_dir)
+        with timed(seconds, 'generate'):
+            num_stays, num_chart_events = generate(os.path.join(work_dir, 'mimic', ''), args.patients, args.seed)
+        run_datasampler(seconds, work_dir, num_stays, args.workers)
+
+        data_dir = os.path.join(work_dir, 'data')
+        os.makedirs(data_dir, exist_ok=True)
+        os.chdir(data_dir)
+        num_processed_events = run_preprocessing(seconds, os.path.join(work_dir, 'subset', ''))
+        run_events_to_list(seconds)
+
+        dataset = dataloader.CustomDataset.load(data_dir)
+        run_collate(seconds, dataset, args.batch_size)
+        run_models(seconds, dataset, args.batch_size, args.hidden_size, args.repeats)
+        os.chdir(ROOT_DIR)
+
+        results_data = {'patients': args.patients, 'seed': args.seed, 'stays': num_stays,
+                        'chart_events': num_chart_events, 'processed_chart_events': num_processed_events,
+                        'dims': [int(dim) for dim in dataset.shape], 'num_codes': int(dataset.num_codes)}
+
+    results = {
+        'data': results_data,
+        'config': {'batch_size': args.batch_size, 'hidden_size': args.hidden_size, 'repeats': args.repeats,
+                   'threads': args.threads, 'workers': args.workers},
+        'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+                        'torch': torch.__version__, 'cpus': os.cpu_count(), 'machine': platform.machine()},
+        'seconds': seconds,
+    }
+    with open(out_path, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('baseline written to {}'.format(out_path))
+
+    if baseline is not None:
+        regressions = compare(seconds, results_data, baseline, args.tolerance)
+        if regressions:
+            print('{} stage(s) slower than the baseline by more than {:.0%}: {}'.format(
+                len(regressions), args.tolerance, ', '.join(regressions)))
+            sys.exit(1)
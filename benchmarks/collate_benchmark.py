@@ -0,0 +1,116 @@
+# Microbenchmark comparing the vectorized dataloader.collate_fn against the original per-event loop. The loop is fed
+# the nested lists of events.pickle, as the original dataloader was, when the data directory holds it, so the
+# vectorized batches are checked against the original data rather than against lists rebuilt from the event store
+#
+# Usage:
+#   python3 benchmarks/collate_benchmark.py --data-dir data
+
+import argparse
+import os
+import pickle
+import sys
+import time
+
+import numpy as np
+import torch
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT_DIR, 'source'))
+import dataloader
+
+
+def loop_collate_fn(data, dims):
+    # collate_fn as it was before vectorization, fed from the nested events lists
+    events, features, labels = zip(*data)
+    batch_size = len(events)
+    _, max_num_hours, max_num_categories, max_num_events = dims
+
+    y = torch.tensor(labels, dtype=torch.long)
+
+    x = torch.full((batch_size, max_num_hours, max_num_categories, max_num_events), 0.0, dtype=torch.float)
+    masks = torch.zeros((batch_size, max_num_hours, max_num_categories, max_num_events), dtype=torch.bool)
+    for i_patient, patient in enumerate(events):
+        for j_hour, hour in enumerate(patient):
+            for k_category, category in enumerate(hour):
+                for l_event in range(len(category)):
+                    x[i_patient][j_hour][k_category][l_event] = category[l_event]
+                    masks[i_patient][j_hour][k_category][l_event] = True
+
+    feats = torch.tensor(features, dtype=torch.long)
+
+    return x, feats, masks, y
+
+
+def load_original(data_dir):
+    # the nested events lists, one-hot ICD-9 codes and labels the original dataloader read, when the data directory
+    # still holds the pickles events_to_list.py and preprocess_mp.py wrote before the stores replaced them
+    names = ('events.pickle', 'icd9_per_icustay.pickle', 'readmit_labels.pickle')
+    if not all(os.path.isfile(os.path.join(data_dir, name)) for name in names):
+        return None
+    original = []
+    for name in names:
+        with open(os.path.join(data_dir, name), 'rb') as f:
+            original.append(pickle.load(f))
+    return original
+
+
+def nested_events(store, index):
+    # rebuilds the original (hour, category, event) lists of one stay from the event store, for data directories
+    # without events.pickle
+    values, counts = store[index]
+    cells = np.split(np.asarray(values, dtype=np.float64), np.cumsum(counts.ravel())[:-1])
+    num_categories = counts.shape[1]
+    return [[cells[j * num_categories + k].tolist() for k in range(num_categories)] for j in range(counts.shape[0])]
+
+
+def dense_codes(codes, num_codes):
+    # one-hot list of a stay's ICD-9 codes as stored in icd9_per_icustay.pickle
+    dense = np.zeros(num_codes, dtype=np.int64)
+    dense[codes] = 1
+    return dense.tolist()
+
+
+def time_batches(collate, batches, dims):
+    start = time.perf_counter()
+    for batch in batches:
+        collate(batch, dims)
+    return len(batches) / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data-dir', default=os.path.join(ROOT_DIR, 'data'))
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--num-batches', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    dataset = dataloader.get_dataset(args.data_dir)
+    rng = np.random.default_rng(args.seed)
+    batch_idx = [rng.integers(len(dataset), size=args.batch_size) for _ in range(args.num_batches)]
+
+    original = load_original(args.data_dir)
+    if original is not None:
+        events, codes, labels = original
+        assert len(events) == len(dataset), 'events.pickle and the event store hold different stays'
+        loop_batches = [[(events[i], codes[i], labels[i]) for i in idx] for idx in batch_idx]
+    else:
+        loop_batches = [[(nested_events(dataset.x, i), dense_codes(dataset.feats[i], dataset.num_codes), dataset.y[i])
+                         for i in idx] for idx in batch_idx]
+    flat_batches = [[dataset[i] for i in idx] for idx in batch_idx]
+
+    # the vectorized path must reproduce the original tensors exactly
+    for loop_batch, flat_batch in zip(loop_batches, flat_batches):
+        x, feats, masks, y = dataloader.collate_fn(flat_batch, dataset.shape)
+        feats = dataloader.dense_feats(feats, dataset.num_codes)
+        for expected, actual in zip(loop_collate_fn(loop_batch, dataset.shape), (x, feats, masks, y)):
+            assert expected.dtype == actual.dtype and torch.equal(expected, actual)
+
+    loop_rate = time_batches(loop_collate_fn, loop_batches, dataset.shape)
+    flat_rate = time_batches(dataloader.collate_fn, flat_batches, dataset.shape)
+
+    print('batch size {}, {} stays, dims {}, reference from {}'.format(
+        args.batch_size, len(dataset), dataset.shape, 'events.pickle' if original is not None else 'the event store'))
+    print('loop collate:       {:10.2f} batches/sec'.format(loop_rate))
+    print('vectorized collate: {:10.2f} batches/sec'.format(flat_rate))
+    print('speedup:            {:10.1f}x'.format(flat_rate / loop_rate))
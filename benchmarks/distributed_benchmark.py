@@ -0,0 +1,75 @@
+# Measures how the data-parallel training of source/distributed.py scales from 1 to N ranks: every --ranks setting
+# trains the same fold for --epochs epochs with ranks started as processes on this machine (see
+# distributed.launch_local), each on its slice of the CPUs, and reports the training seconds per epoch of the slowest
+# rank, the stays trained per second, the speedup and parallel efficiency over the first setting, the seconds rank 0
+# spent all-reducing gradients per epoch and the test loss of the last epoch.
+#
+# By default the global batch is held at --batch-size stays, split between the ranks, so every setting steps the
+# model alike and the test losses compare; with --per-rank-batch every rank trains batches of --batch-size stays and
+# the global batch grows with the ranks. The ranks only speed training up while they have CPUs of their own: with
+# more ranks than CPUs, they take turns on them and the all-reduce waits for the slowest.
+#
+# Usage:
+#   python3 benchmarks/distributed_benchmark.py --data-dir data --model LSTMPlusCNN --ranks 1 2 4 8 --epochs 3
+
+import argparse
+import os
+import sys
+
+import numpy as np
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT_DIR, 'source'))
+import dataloader
+import distributed
+from checkpoint import MODELS
+from training import subset_weighted_random_sampler
+
+
+def epoch_seconds(result):
+    # the median over the epochs after the first, which also loads the data into the page cache
+    seconds = result['train_seconds']
+    return float(np.median(seconds[1:] if len(seconds) > 1 else seconds))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data-dir', default=os.path.join(ROOT_DIR, 'data'))
+    parser.add_argument('--model', choices=list(MODELS), default='LSTMPlusCNN')
+    parser.add_argument('--hidden-size', type=int, default=128)
+    parser.add_argument('--encoding', default='events')
+    parser.add_argument('--bucketing', action='store_true')
+    parser.add_argument('--ranks', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--epochs', type=int, default=3)
+    parser.add_argument('--batch-size', type=int, default=64, help='stays per global batch')
+    parser.add_argument('--per-rank-batch', action='store_true', help='--batch-size stays per batch of every rank')
+    parser.add_argument('--lr', type=float, default=0.002)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    dataset = dataloader.get_dataset(args.data_dir)
+    train_idx, _ = distributed.split(len(dataset), 5, 0, args.seed)
+    num_train = subset_weighted_random_sampler(dataset, train_idx, 'over').num_samples
+    print('{} stays, {} trained per epoch, model {}, {} CPUs'.format(len(dataset), num_train, args.model, os.cpu_count()))
+
+    model_kwargs = {} if args.model == 'LogisticRegression' else {'hidden_size': args.hidden_size}
+    results = []
+    for ranks in args.ranks:
+        batch_size = args.batch_size if args.per_rank_batch else max(args.batch_size // ranks, 1)
+        config = {'data_dir': os.path.abspath(args.data_dir), 'model': args.model, 'model_kwargs': model_kwargs,
+                  'k_folds': 5, 'fold': 0, 'seed': args.seed, 'n_epochs': args.epochs, 'batch_size': batch_size,
+                  'lr': args.lr, 'verbose': False, 'trace': True,
+                  'loader_kwargs': {'encoding': args.encoding, 'bucketing': args.bucketing}}
+        result = distributed.launch_local(config, ranks)[0]
+        all_reduce = result['trace']['phases'].get('train.all_reduce', {'wall': 0.0})['wall'] / args.epochs
+        results.append((ranks, batch_size, epoch_seconds(result), all_reduce, result['history']['test_loss'][-1]))
+        print('{} ranks done'.format(ranks))
+
+    base_ranks, _, base_seconds, _, _ = results[0]
+    print('\n{:>6}{:>12}{:>14}{:>12}{:>10}{:>12}{:>16}{:>12}'.format(
+        'ranks', 'rank batch', 's/epoch', 'stays/s', 'speedup', 'efficiency', 'all-reduce s', 'test loss'))
+    for ranks, batch_size, seconds, all_reduce, test_loss in results:
+        speedup = base_seconds / seconds
+        print('{:>6}{:>12}{:>14.2f}{:>12.0f}{:>9.2f}x{:>11.0%}{:>16.3f}{:>12.3f}'.format(
+            ranks, batch_size, seconds, num_train / seconds, speedup, speedup * base_ranks / ranks, all_reduce,
+            test_loss))
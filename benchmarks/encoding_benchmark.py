@@ -0,0 +1,102 @@
+# Compares the 'events' input encoding (every event of an hour and category, padded to the largest number of events)
+# with the 'summary' encoding (count, mean, min, max, last value and mask bit of the events of every hour and
+# category): bytes of the model input per batch, training time per batch and validation accuracy and AUROC of the
+# same model trained on the same folds with either encoding.
+#
+# Usage:
+#   python3 benchmarks/encoding_benchmark.py --data-dir data --model lstm-cnn --epochs 10
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+from sklearn.metrics import roc_auc_score
+from sklearn.model_selection import KFold
+from torch.utils.data import SubsetRandomSampler
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT_DIR, 'source'))
+import dataloader
+from models import LSTMPlusCNN, ReadmissionLSTM
+
+
+def build_model(name, dataset, encoding, hidden_size):
+    size = dataloader.input_size(dataset.shape, encoding)
+    if name == 'lstm':
+        return ReadmissionLSTM(input_size=size, input_len=dataset.shape[1], hidden_size=hidden_size)
+    return LSTMPlusCNN(input_size=size, input_len=dataset.shape[1], feature_len=dataset.num_codes, hidden_size=hidden_size)
+
+
+def forward(model, x, feats, masks):
+    if isinstance(model, ReadmissionLSTM):
+        return model(x, masks)
+    return model(x, feats, masks)
+
+
+def run_fold(args, dataset, encoding, train_idx, val_idx):
+    torch.manual_seed(args.seed)
+    train_loader, val_loader = dataloader.load_data(SubsetRandomSampler(train_idx), list(val_idx),
+                                                    batch_size=args.batch_size, dataset=dataset, encoding=encoding)
+    model = build_model(args.model, dataset, encoding, args.hidden_size)
+    optimizer = torch.optim.Adam(model.parameters(), lr=0.002)
+    criterion = nn.CrossEntropyLoss()
+
+    batch_times, input_bytes = [], []
+    for epoch in range(args.epochs):
+        model.train()
+        for x, feats, masks, y in train_loader:
+            start_time = time.perf_counter()
+            optimizer.zero_grad()
+            loss = criterion(forward(model, x, feats, masks), y)
+            loss.backward()
+            optimizer.step()
+            batch_times.append(time.perf_counter() - start_time)
+            input_bytes.append(x.element_size() * x.numel() + masks.element_size() * masks.numel())
+
+    model.eval()
+    probs, labels = [], []
+    with torch.no_grad():
+        for x, feats, masks, y in val_loader:
+            probs.append(forward(model, x, feats, masks)[:, 1])
+            labels.append(y)
+    probs, labels = torch.cat(probs).numpy(), torch.cat(labels).numpy()
+
+    accuracy = ((probs > 0.5) == labels).mean() * 100
+    auroc = roc_auc_score(labels, probs) if len(np.unique(labels)) == 2 else float('nan')
+    return np.mean(batch_times), np.mean(input_bytes), accuracy, auroc
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data-dir', default=os.path.join(ROOT_DIR, 'data'))
+    parser.add_argument('--model', choices=['lstm', 'lstm-cnn'], default='lstm-cnn')
+    parser.add_argument('--hidden-size', type=int, default=128)
+    parser.add_argument('--epochs', type=int, default=5)
+    parser.add_argument('--folds', type=int, default=3)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    dataset = dataloader.get_dataset(args.data_dir)
+    folds = list(KFold(n_splits=args.folds, shuffle=True, random_state=args.seed).split(np.arange(len(dataset))))
+    print('{} stays, dims {}, model {}, {} folds of {} epochs'.format(len(dataset), dataset.shape, args.model,
+                                                                     args.folds, args.epochs))
+
+    results = {}
+    for encoding in dataloader.ENCODINGS:
+        results[encoding] = np.mean([run_fold(args, dataset, encoding, train_idx, val_idx)
+                                     for train_idx, val_idx in folds], axis=0)
+
+    print('{:>8} {:>12} {:>14} {:>14} {:>10} {:>8}'.format('encoding', 'input size', 'input MB/batch',
+                                                           'train ms/batch', 'val acc', 'val AUROC'))
+    for encoding, (batch_time, input_bytes, accuracy, auroc) in results.items():
+        print('{:>8} {:>12} {:>14.2f} {:>14.1f} {:>9.1f}% {:>8.3f}'.format(
+            encoding, dataloader.input_size(dataset.shape, encoding), input_bytes / 1e6, batch_time * 1e3, accuracy, auroc))
+
+    events, summary = results['events'], results['summary']
+    print('summary encoding: {:.1f}x less input memory, {:.1f}x faster training steps'.format(
+        events[1] / summary[1], events[0] / summary[0]))
@@ -0,0 +1,131 @@
+# Benchmark of the ICD-9 branch of LSTMPlusCNN and LogisticRegression: the former dense layers over one-hot codes
+# against the nn.EmbeddingBag layers over (codes, offsets) bags in models.py
+#
+# Usage:
+#   python3 benchmarks/icd9_layer_benchmark.py --num-codes 4037 --codes-per-stay 12
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+import torch.nn as nn
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT_DIR, 'source'))
+from dataloader import dense_feats
+from models import LSTMPlusCNN, LogisticRegression
+
+
+class DenseLogisticRegression(nn.Module):
+    # LogisticRegression as it was before the codes were passed as bags
+    def __init__(self, feature_size):
+        super(DenseLogisticRegression, self).__init__()
+        self.fc = nn.Linear(feature_size, 1)
+        self.sigmoid = nn.Sigmoid()
+    def forward(self, feats):
+        return self.sigmoid(self.fc(feats.float()))
+
+
+class DenseHead(nn.Module):
+    # final layer of LSTMPlusCNN as it was before the codes were passed as bags
+    def __init__(self, linear_features, feature_len):
+        super(DenseHead, self).__init__()
+        self.fc = nn.Linear(linear_features + feature_len, 2)
+    def forward(self, x, feats):
+        return self.fc(torch.cat((x, feats), dim=1))
+
+
+class BagHead(nn.Module):
+    # final layer of LSTMPlusCNN taking the codes as bags
+    def __init__(self, model):
+        super(BagHead, self).__init__()
+        self.fc = model.fc
+        self.icd9 = model.icd9
+    def forward(self, x, feats):
+        return self.fc(x) + self.icd9(*feats)
+
+
+def random_bags(batch_size, num_codes, codes_per_stay, generator):
+    lengths = torch.randint(1, 2 * codes_per_stay, (batch_size,), generator=generator)
+    codes = torch.cat([torch.randperm(num_codes, generator=generator)[:n].sort().values for n in lengths])
+    return codes, torch.cumsum(lengths, 0) - lengths
+
+
+def time_steps(model, inputs, num_steps):
+    # mean seconds of one forward + backward pass, and the bytes of parameter gradients it leaves
+    for _ in range(3):
+        model.zero_grad(set_to_none=True)
+        model(*inputs).sum().backward()
+    start = time.perf_counter()
+    for _ in range(num_steps):
+        model.zero_grad(set_to_none=True)
+        model(*inputs).sum().backward()
+    seconds = (time.perf_counter() - start) / num_steps
+
+    grad_bytes = 0
+    for param in model.parameters():
+        grad = param.grad
+        if grad is None:
+            continue
+        if grad.is_sparse:
+            grad = grad.coalesce()
+            grad_bytes += grad.values().nelement() * grad.values().element_size() + grad.indices().nelement() * grad.indices().element_size()
+        else:
+            grad_bytes += grad.nelement() * grad.element_size()
+    return seconds, grad_bytes
+
+
+def report(name, dense, bag, bag_sparse):
+    print('{}:'.format(name))
+    for label, (seconds, grad_bytes) in (('dense', dense), ('bag', bag), ('bag, sparse grad', bag_sparse)):
+        print('  {:17s} {:9.1f} us/step  {:10d} gradient bytes  speedup {:.1f}x'.format(
+            label, seconds * 1e6, grad_bytes, dense[0] / seconds))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-codes', type=int, default=4037)
+    parser.add_argument('--codes-per-stay', type=int, default=12)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--input-len', type=int, default=48)
+    parser.add_argument('--num-steps', type=int, default=200)
+    args = parser.parse_args()
+
+    generator = torch.Generator().manual_seed(0)
+    feats = random_bags(args.batch_size, args.num_codes, args.codes_per_stay, generator)
+    dense = dense_feats(feats, args.num_codes)
+
+    # LogisticRegression, with the dense layer holding the same weights as the bag layer
+    bag_model = LogisticRegression(args.num_codes)
+    bag_sparse_model = LogisticRegression(args.num_codes, sparse_grad=True)
+    bag_sparse_model.load_state_dict(bag_model.state_dict())
+    dense_model = DenseLogisticRegression(args.num_codes)
+    with torch.no_grad():
+        dense_model.fc.weight.copy_(bag_model.fc.weight.T)
+        dense_model.fc.bias.copy_(bag_model.bias)
+    delta = (dense_model(dense) - bag_model(feats)).abs().max().item()
+    print('LogisticRegression max |dense - bag| output difference: {:.2e}'.format(delta))
+    report('LogisticRegression forward/backward',
+           time_steps(dense_model, (dense,), args.num_steps),
+           time_steps(bag_model, (feats,), args.num_steps),
+           time_steps(bag_sparse_model, (feats,), args.num_steps))
+
+    # final layer of LSTMPlusCNN, fed with the flattened CNN output
+    linear_features = 3*(args.input_len - 2)//2
+    x = torch.randn(args.batch_size, linear_features, generator=generator)
+    model = LSTMPlusCNN(input_size=1, input_len=args.input_len, feature_len=args.num_codes, hidden_size=1)
+    sparse_model = LSTMPlusCNN(input_size=1, input_len=args.input_len, feature_len=args.num_codes, hidden_size=1, sparse_grad=True)
+    sparse_model.load_state_dict(model.state_dict())
+    bag_head, bag_sparse_head = BagHead(model), BagHead(sparse_model)
+    dense_head = DenseHead(linear_features, args.num_codes)
+    with torch.no_grad():
+        dense_head.fc.weight.copy_(torch.cat((model.fc.weight, model.icd9.weight.T), dim=1))
+        dense_head.fc.bias.copy_(model.fc.bias)
+    delta = (dense_head(x, dense.float()) - bag_head(x, feats)).abs().max().item()
+    print('LSTMPlusCNN fc max |dense - bag| output difference: {:.2e}'.format(delta))
+    report('LSTMPlusCNN fc forward/backward',
+           time_steps(dense_head, (x, dense.float()), args.num_steps),
+           time_steps(bag_head, (x, feats), args.num_steps),
+           time_steps(bag_sparse_head, (x, feats), args.num_steps))
@@ -0,0 +1,90 @@
+# Compares the CPU inference latency and throughput of a checkpoint run eagerly in fp32 with the artifacts export.py
+# makes of it: TorchScript in fp32 and with int8 dynamic quantization of the LSTM and Linear layers, and ONNX in fp32
+# and int8 when onnx and onnxruntime are installed. Every model scores the same batches of 1, 64 and 512 stays of
+# --data-dir (cycling through the stays if there are fewer), and the median time of --repeats runs of a batch is
+# reported after a warm-up run, with the largest probability difference from eager fp32 on those batches.
+#
+# Usage:
+#   python3 benchmarks/inference_benchmark.py --checkpoint source/checkpoints/lstm-cnn/fold-1.pt --data-dir data --threads 1
+
+import warnings
+warnings.simplefilter(action='ignore', category=FutureWarning)
+
+import argparse
+import importlib.util
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT_DIR, 'source'))
+import dataloader
+import inference
+from checkpoint import load_checkpoint
+
+BATCH_SIZES = (1, 64, 512)
+
+
+def batches(dataset, encoding):
+    collate = dataloader.ENCODINGS[encoding]
+    return {size: collate([dataset[i % len(dataset)] for i in range(size)], dataset.shape) for size in BATCH_SIZES}
+
+def median_seconds(model, batch, repeats):
+    inference.predict(model, batch) # warm-up
+    times = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        inference.predict(model, batch)
+        times.append(time.perf_counter() - start_time)
+    return float(np.median(times))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', required=True, help='model checkpoint saved by training.kfold')
+    parser.add_argument('--data-dir', default=os.path.join(ROOT_DIR, 'data'))
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads())
+    parser.add_argument('--repeats', type=int, default=20)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    model, checkpoint = load_checkpoint(args.checkpoint)
+    eager = inference.ReadmissionProbability(model).eval()
+    dataset = dataloader.get_dataset(args.data_dir)
+    test_batches = batches(dataset, checkpoint['encoding'])
+
+    variants = [('torchscript', False), ('torchscript', True)]
+    if importlib.util.find_spec('onnx') is not None and importlib.util.find_spec('onnxruntime') is not None:
+        variants += [('onnx', False), ('onnx', True)]
+    else:
+        print('onnx or onnxruntime is not installed, skipping the ONNX artifacts')
+
+    models = {'eager fp32': (eager, None)}
+    with tempfile.TemporaryDirectory() as directory:
+        for format, quantize in variants:
+            path = os.path.join(directory, '{}{}'.format(format, '-int8' if quantize else ''))
+            inference.export(model, checkpoint, test_batches[BATCH_SIZES[0]], path, format, quantize)
+            artifact, _ = inference.load_exported(path, args.threads)
+            models['{} {}'.format(format, 'int8' if quantize else 'fp32')] = (artifact, os.path.getsize(path))
+
+        print('{} model, {} encoding, {} threads, median of {} runs'.format(checkpoint['model'], checkpoint['encoding'],
+                                                                            args.threads, args.repeats))
+        print('{:<18}{:>9}{:>12}'.format('model', 'MB', 'max delta') +
+              ''.join('{:>32}'.format('batch {}: ms (stays/s) speedup'.format(size)) for size in BATCH_SIZES))
+        reference = {size: inference.predict(eager, batch).numpy() for size, batch in test_batches.items()}
+        eager_seconds = {}
+        for name, (scorer, size_bytes) in models.items():
+            delta = max(inference.max_probability_delta(reference[size], inference.predict(scorer, batch).numpy())
+                        for size, batch in test_batches.items())
+            columns = []
+            for size, batch in test_batches.items():
+                seconds = median_seconds(scorer, batch, args.repeats)
+                eager_seconds.setdefault(size, seconds)
+                columns.append('{:>8.2f} ({:>6.0f}) {:>4.2f}x'.format(seconds * 1e3, size / seconds,
+                                                                     eager_seconds[size] / seconds))
+            print('{:<18}{:>9}{:>12.2e}'.format(name, '{:.1f}'.format(size_bytes / 1e6) if size_bytes else '-', delta) +
+                  ''.join('{:>32}'.format(column) for column in columns))
@@ -0,0 +1,69 @@
+# Times the k-fold cross-validation of training.kfold run one fold after another (workers=1, torch using all
+# threads) against the folds run at the same time in fold processes that each get a slice of the CPUs and share
+# the dataset. Both runs must produce a history record for every fold and epoch.
+#
+# Usage:
+#   python3 benchmarks/kfold_benchmark.py --data-dir data --model lstm-cnn --folds 5 --epochs 2 --workers 5
+
+import argparse
+import os
+import resource
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT_DIR, 'source'))
+import dataloader
+import training
+
+
+NAMES = {'lstm': 'ReadmissionLSTM', 'lstm-cnn': 'LSTMPlusCNN', 'logistic': 'LogisticRegression'}
+
+
+def dataset_bytes(dataset):
+    arrays = [dataset.x.values, dataset.x.counts, dataset.x.offsets, dataset.feats.indices, dataset.feats.offsets]
+    return sum(np.asarray(array).nbytes for array in arrays)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data-dir', default=os.path.join(ROOT_DIR, 'data'))
+    parser.add_argument('--model', choices=list(NAMES), default='lstm-cnn')
+    parser.add_argument('--encoding', choices=list(dataloader.ENCODINGS), default='events')
+    parser.add_argument('--hidden-size', type=int, default=128)
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--epochs', type=int, default=2)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    dataset = dataloader.get_dataset(args.data_dir)
+    kwargs = {} if args.model == 'logistic' else {'hidden_size': args.hidden_size}
+    build_model = training.model_builder(NAMES[args.model], dataset, args.encoding, **kwargs)
+    criterion = nn.BCELoss() if args.model == 'logistic' else nn.CrossEntropyLoss()
+    loader_kwargs = {} if args.model == 'logistic' else {'encoding': args.encoding}
+    print('{} stays, dims {}, {:.1f} MB of events and codes, model {}, {} folds of {} epochs, {} CPUs'.format(
+        len(dataset), dataset.shape, dataset_bytes(dataset) / 1e6, args.model, args.folds, args.epochs,
+        len(training.cpu_slices(1)[0])))
+
+    results = {}
+    for workers in (1, args.workers):
+        torch.manual_seed(args.seed)
+        start_time = time.perf_counter()
+        history = training.kfold(build_model, dataset, criterion, k_folds=args.folds, n_epochs=args.epochs,
+                                 batch_size=args.batch_size, verbose=False, workers=workers, **loader_kwargs)
+        results[workers] = time.perf_counter() - start_time
+        assert sorted(history[['fold', 'epoch']].tolist()) == [(fold, epoch) for fold in range(args.folds)
+                                                              for epoch in range(args.epochs)]
+        print('{:>2} worker(s): {:8.1f}s, mean test acc {:.1f}%'.format(workers, results[workers],
+                                                                     np.nanmean(history['test_acc'])))
+
+    # peak resident memory of the largest fold process, which holds no copy of the shared dataset
+    print('peak RSS: main process {:.0f} MB, largest fold process {:.0f} MB'.format(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1e3))
+    print('{} fold processes: {:.2f}x the speed of the serial loop'.format(args.workers, results[1] / results[args.workers]))
@@ -0,0 +1,122 @@
+# Benchmark of the cohort labeling of preprocess_mp.py Section II against the original implementation, which sorted
+# all chart events to find every patient's first event and looped over the patients with several stays.
+# Both are run on synthetic cohorts of increasing size and must find the same exclusions and positive labels.
+#
+# Usage:
+#   python3 benchmarks/labeling_benchmark.py --num-stays 1000 10000 60000
+
+import argparse
+import datetime
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT_DIR, 'data_cleaning'))
+import preprocess_mp
+
+
+def loop_find_exclusions(chart_events, icu_stays, patients):
+    # Section II as it was before vectorization
+    unique_chart_event_patients = chart_events.sort_values(by=['charttime']).drop_duplicates(subset='subject_id', keep='first')
+    less_than_eighteen = unique_chart_event_patients.merge(patients, left_on='subject_id', right_on='subject_id')
+    charttime_s = less_than_eighteen['charttime'].values.astype('datetime64[s]')
+    dob_s = less_than_eighteen['dob'].values.astype('datetime64[s]')
+    less_than_eighteen['age'] = ((charttime_s - dob_s).astype(np.int64)/86400//365).astype(np.int64)
+    less_than_eighteen = less_than_eighteen[less_than_eighteen.age < 18]['subject_id'].to_list()
+
+    thirty_day_dead_pos = icu_stays.merge(patients, left_on='subject_id', right_on='subject_id')
+    thirty_day_dead_pos['time_diff'] = thirty_day_dead_pos['dod'] - thirty_day_dead_pos["outtime"]
+    died_in_icu = thirty_day_dead_pos[thirty_day_dead_pos.time_diff <= datetime.timedelta(0)]['subject_id'].to_list()
+    thirty_day_dead_pos = thirty_day_dead_pos[thirty_day_dead_pos.time_diff > datetime.timedelta(0)]
+    thirty_day_dead_pos = thirty_day_dead_pos[thirty_day_dead_pos.time_diff <= datetime.timedelta(30)]['icustay_id'].to_list()
+
+    multi_icu = icu_stays[icu_stays.duplicated(subset='subject_id', keep=False)].reset_index()
+    multi_icu = multi_icu.sort_values(['outtime'])
+    pos_returned_in_thirty = []
+    for pid, group in multi_icu.groupby('subject_id'):
+        intimes = pd.to_datetime(group['intime']).dt.date.unique().tolist()
+        outtimes = pd.to_datetime(group['outtime']).dt.date.unique().tolist()
+        icu_stay_ids = group['icustay_id'].tolist()[:-1]
+        assert len(icu_stay_ids) == len(intimes[1:])
+        diff = np.subtract(intimes[1:], outtimes[:-1])
+        if any(x < datetime.timedelta(30) for x in diff):
+            for index, x in enumerate(diff):
+                if x < datetime.timedelta(30): pos_returned_in_thirty.append(icu_stay_ids[index])
+
+    return died_in_icu + less_than_eighteen, pos_returned_in_thirty + thirty_day_dead_pos
+
+
+def vectorized_find_exclusions(chart_events, icu_stays, patients):
+    return preprocess_mp.find_exclusions(preprocess_mp.first_chart_events(chart_events), icu_stays, patients)
+
+
+def synthetic_cohort(num_stays, events_per_stay, rng):
+    # Patients with one to four stays, at least a day apart, some of them back within 30 days, some children and
+    # some who die during or shortly after a stay
+    num_patients = num_stays * 2 // 5
+    subject_ids = rng.integers(0, num_patients, num_stays)
+    subject_ids[:num_patients] = np.arange(num_patients)
+    subject_ids = np.sort(subject_ids)
+    stay_number = np.arange(num_stays) - np.searchsorted(subject_ids, subject_ids)
+
+    start = pd.Timestamp('2100-01-01') + pd.to_timedelta(rng.integers(0, 3650, num_patients), 'D')
+    lengths = pd.to_timedelta(rng.integers(10, 400, num_stays), 'h')
+    gaps = pd.to_timedelta(rng.integers(1, 90, num_stays) * (stay_number > 0), 'D')
+    # every stay starts a gap after the end of the one before, so the intimes add up per patient
+    offsets = pd.Series((lengths + gaps).values).groupby(subject_ids).cumsum().to_numpy() - lengths.values
+    intime = start[subject_ids] + pd.to_timedelta(offsets)
+    outtime = intime + lengths
+    icu_stays = pd.DataFrame({'subject_id': subject_ids, 'hadm_id': np.arange(num_stays) + 100000,
+                              'icustay_id': np.arange(num_stays) + 200000, 'intime': intime, 'outtime': outtime})
+    icu_stays = icu_stays.sample(frac=1, random_state=0).reset_index(drop=True)
+
+    last_outtime = icu_stays.groupby('subject_id')['outtime'].max().sort_index()
+    dies = rng.random(num_patients) < 0.3
+    dod = last_outtime.to_numpy() + pd.to_timedelta(rng.integers(-3, 60, num_patients), 'D')
+    patients = pd.DataFrame({'subject_id': np.arange(num_patients),
+                             'dob': start - pd.to_timedelta(rng.integers(5 * 365, 90 * 365, num_patients), 'D'),
+                             'dod': np.where(dies, dod, np.datetime64('NaT'))})
+    patients['dod'] = pd.to_datetime(patients['dod'])
+
+    stays = np.repeat(np.arange(num_stays), events_per_stay)
+    chart_events = pd.DataFrame({'subject_id': subject_ids[stays], 'icustay_id': stays + 200000,
+                                 'charttime': intime[stays] + pd.to_timedelta(rng.random(len(stays)) * lengths.values[stays])})
+    return chart_events.sample(frac=1, random_state=1).reset_index(drop=True), icu_stays, patients
+
+
+def time_labeling(find_exclusions, chart_events, icu_stays, patients, repeats):
+    times = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        result = find_exclusions(chart_events, icu_stays, patients)
+        times.append(time.perf_counter() - start_time)
+    return min(times), result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-stays', type=int, nargs='+', default=[1000, 10000, 60000])
+    parser.add_argument('--events-per-stay', type=int, default=100)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print('{:>10} {:>12} {:>12} {:>12} {:>8}'.format('stays', 'events', 'loop (s)', 'grouped (s)', 'speedup'))
+    for num_stays in args.num_stays:
+        chart_events, icu_stays, patients = synthetic_cohort(num_stays, args.events_per_stay, rng)
+
+        loop_time, (loop_remove, loop_pos) = time_labeling(loop_find_exclusions, chart_events, icu_stays, patients, args.repeats)
+        grouped_time, (remove, pos) = time_labeling(vectorized_find_exclusions, chart_events, icu_stays, patients, args.repeats)
+
+        # the same patients are removed and the same stays labelled positive
+        assert set(remove) == set(loop_remove)
+        assert set(pos) == set(loop_pos)
+        labels = chart_events['icustay_id'].isin(pos)
+        assert labels.equals(chart_events['icustay_id'].isin(loop_pos))
+
+        print('{:>10} {:>12} {:>12.3f} {:>12.3f} {:>7.1f}x'.format(num_stays, len(chart_events), loop_time, grouped_time,
+                                                                   loop_time / grouped_time))
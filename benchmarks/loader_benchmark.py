@@ -0,0 +1,102 @@
+# Measures how close training gets to pure model compute with the DataLoader workers of dataloader.load_data:
+# the time per epoch of training a model on batches collated beforehand (the compute time), and of training it on
+# the loader with 0 (collation in series with the model) and every --num-workers workers, each keeping
+# --prefetch-factor batches ready. The first epoch with workers includes starting them and is reported apart.
+# Reported with every setting are the time spent waiting for batches and the memory private to the workers, which
+# stays small as they index the shared event and code stores instead of copying them.
+#
+# Usage:
+#   python3 benchmarks/loader_benchmark.py --data-dir data --num-workers 0 2 4 --epochs 3
+#   python3 benchmarks/loader_benchmark.py --data-dir data --encoding summary --prefetch-factor 4
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT_DIR, 'source'))
+import dataloader
+import instrumentation
+from models import LSTMPlusCNN
+from training import run_epoch, subset_weighted_random_sampler
+
+
+def private_memory_mb():
+    # memory private to each child process of this one, such as the DataLoader workers (Linux only)
+    memory = []
+    for children in glob.glob('/proc/self/task/*/children'):
+        with open(children) as f:
+            for pid in f.read().split():
+                try:
+                    with open('/proc/{}/smaps_rollup'.format(pid)) as smaps:
+                        fields = dict(line.split(':', 1) for line in smaps if ':' in line)
+                except OSError:
+                    continue
+                memory.append(sum(int(fields[name].split()[0]) for name in ('Private_Clean', 'Private_Dirty')) / 1e3)
+    return memory
+
+def build_model(args, dataset):
+    torch.manual_seed(0)
+    return LSTMPlusCNN(input_size=dataloader.input_size(dataset.shape, args.encoding), input_len=dataset.shape[1],
+                       feature_len=dataset.num_codes, hidden_size=args.hidden_size)
+
+def train(args, dataset, batches):
+    # seconds of every epoch over batches and the seconds spent waiting for them
+    model = build_model(args, dataset)
+    optimizer = torch.optim.Adam(model.parameters(), lr=0.002)
+    seconds, waits = [], []
+    for _ in range(args.epochs):
+        instrumentation.enable()
+        start_time = time.perf_counter()
+        run_epoch(model, batches, nn.CrossEntropyLoss(), optimizer)
+        seconds.append(time.perf_counter() - start_time)
+        waits.append(instrumentation.trace()['phases']['train.data_wait']['wall'])
+        instrumentation.disable()
+    return seconds, waits
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data-dir', default=os.path.join(ROOT_DIR, 'data'))
+    parser.add_argument('--encoding', choices=list(dataloader.ENCODINGS), default='events')
+    parser.add_argument('--hidden-size', type=int, default=128)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--epochs', type=int, default=3)
+    parser.add_argument('--num-workers', type=int, nargs='+', default=[0, 2, 4])
+    parser.add_argument('--prefetch-factor', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads())
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    dataset = dataloader.get_dataset(args.data_dir)
+    idx = np.arange(len(dataset))
+    print('{} stays, dims {}, {} threads, {} CPUs'.format(len(dataset), dataset.shape, args.threads, os.cpu_count()))
+
+    # the same stays the loaders draw, collated before the clock starts
+    torch.manual_seed(0)
+    loader, _ = dataloader.load_data(subset_weighted_random_sampler(dataset, idx), [], batch_size=args.batch_size,
+                                     dataset=dataset, encoding=args.encoding)
+    collated = list(loader)
+    seconds, _ = train(args, dataset, collated)
+    compute_seconds = np.median(seconds)
+    print('{:<24}{:8.2f}s per epoch'.format('model compute', compute_seconds))
+
+    for num_workers in args.num_workers:
+        torch.manual_seed(0)
+        loader, _ = dataloader.load_data(subset_weighted_random_sampler(dataset, idx), [], batch_size=args.batch_size,
+                                         dataset=dataset, encoding=args.encoding, num_workers=num_workers,
+                                         prefetch_factor=args.prefetch_factor)
+        seconds, waits = train(args, dataset, loader)
+        steady = seconds[1:] or seconds
+        workers_memory = private_memory_mb() if num_workers else []
+        print('{:<24}{:8.2f}s per epoch ({:.2f}x compute), first epoch {:.2f}s, waiting {:.2f}s per epoch{}'.format(
+            '{} workers'.format(num_workers), np.median(steady), np.median(steady) / compute_seconds, seconds[0],
+            np.median(waits[1:] or waits),
+            ', {:.0f} MB private per worker'.format(np.mean(workers_memory)) if workers_memory else ''))
+        del loader
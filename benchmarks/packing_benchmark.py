@@ -0,0 +1,109 @@
+# Compares training on padded batches, where the LSTMs run over all hours of every stay including the hours
+# repeated as padding after a short stay, with packed batches of only the real hours of every stay, batched by
+# length (dataloader.load_data(packed=True, bucketing=True)): training time per epoch, the share of LSTM steps
+# that are padding and validation accuracy and AUROC of the same model trained on the same folds.
+#
+# Usage:
+#   python3 benchmarks/packing_benchmark.py --data-dir data --model lstm-cnn --epochs 5
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+from sklearn.metrics import roc_auc_score
+from sklearn.model_selection import KFold
+from torch.utils.data import SubsetRandomSampler
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT_DIR, 'source'))
+import dataloader
+from models import LSTMPlusCNN, ReadmissionLSTM
+
+
+def build_model(name, dataset, encoding, hidden_size):
+    size = dataloader.input_size(dataset.shape, encoding)
+    if name == 'lstm':
+        return ReadmissionLSTM(input_size=size, input_len=dataset.shape[1], hidden_size=hidden_size)
+    return LSTMPlusCNN(input_size=size, input_len=dataset.shape[1], feature_len=dataset.num_codes, hidden_size=hidden_size)
+
+
+def forward(model, x, feats, masks):
+    if isinstance(model, ReadmissionLSTM):
+        return model(x, masks)
+    return model(x, feats, masks)
+
+
+def lstm_steps(x):
+    # hours of all stays of a batch the LSTMs run over
+    if isinstance(x, nn.utils.rnn.PackedSequence):
+        return len(x.data)
+    return x.shape[0] * x.shape[1]
+
+
+def run_fold(args, dataset, packed, train_idx, val_idx):
+    torch.manual_seed(args.seed)
+    train_loader, val_loader = dataloader.load_data(SubsetRandomSampler(train_idx), list(val_idx),
+                                                    batch_size=args.batch_size, dataset=dataset,
+                                                    encoding=args.encoding, packed=packed, bucketing=packed)
+    model = build_model(args.model, dataset, args.encoding, args.hidden_size)
+    optimizer = torch.optim.Adam(model.parameters(), lr=0.002)
+    criterion = nn.CrossEntropyLoss()
+
+    epoch_times, steps = [], 0
+    for epoch in range(args.epochs):
+        model.train()
+        start_time = time.perf_counter()
+        for x, feats, masks, y in train_loader:
+            optimizer.zero_grad()
+            loss = criterion(forward(model, x, feats, masks), y)
+            loss.backward()
+            optimizer.step()
+            steps += lstm_steps(x)
+        epoch_times.append(time.perf_counter() - start_time)
+
+    model.eval()
+    probs, labels = [], []
+    with torch.no_grad():
+        for x, feats, masks, y in val_loader:
+            probs.append(forward(model, x, feats, masks)[:, 1])
+            labels.append(y)
+    probs, labels = torch.cat(probs).numpy(), torch.cat(labels).numpy()
+
+    accuracy = ((probs > 0.5) == labels).mean() * 100
+    auroc = roc_auc_score(labels, probs) if len(np.unique(labels)) == 2 else float('nan')
+    return np.mean(epoch_times), steps / args.epochs, accuracy, auroc
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data-dir', default=os.path.join(ROOT_DIR, 'data'))
+    parser.add_argument('--model', choices=['lstm', 'lstm-cnn'], default='lstm-cnn')
+    parser.add_argument('--encoding', choices=list(dataloader.ENCODINGS), default='events')
+    parser.add_argument('--hidden-size', type=int, default=128)
+    parser.add_argument('--epochs', type=int, default=5)
+    parser.add_argument('--folds', type=int, default=3)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    dataset = dataloader.get_dataset(args.data_dir)
+    folds = list(KFold(n_splits=args.folds, shuffle=True, random_state=args.seed).split(np.arange(len(dataset))))
+    print('{} stays, dims {}, mean length {:.1f} hours, model {}, {} folds of {} epochs'.format(
+        len(dataset), dataset.shape, dataset.lengths.mean(), args.model, args.folds, args.epochs))
+
+    results = {}
+    for name, packed in (('padded', False), ('packed', True)):
+        results[name] = np.mean([run_fold(args, dataset, packed, train_idx, val_idx)
+                                 for train_idx, val_idx in folds], axis=0)
+
+    print('{:>8} {:>12} {:>14} {:>10} {:>10}'.format('batches', 's/epoch', 'LSTM steps', 'val acc', 'val AUROC'))
+    for name, (epoch_time, steps, accuracy, auroc) in results.items():
+        print('{:>8} {:>12.2f} {:>14.0f} {:>9.1f}% {:>10.3f}'.format(name, epoch_time, steps, accuracy, auroc))
+
+    padded, packed = results['padded'], results['packed']
+    print('packed batches: {:.0f}% fewer LSTM steps, {:.2f}x faster epochs'.format(
+        100 * (1 - packed[1] / padded[1]), padded[0] / packed[0]))
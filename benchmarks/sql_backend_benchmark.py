@@ -0,0 +1,153 @@
+# Compares the pandas preprocessing of data_cleaning/preprocess_mp.py with the SQL backend of
+# data_cleaning/preprocess_sql.py on the same MIMIC III subset: every backend runs as a script in its own directory,
+# followed by events_to_list.py, and the wall time, CPU time and peak RSS of every section are read from their traces
+# (see source/instrumentation.py). The SQL backend is run once for every --threads setting, as the engine runs its
+# scans, joins and sorts on that many threads.
+#
+# The outputs of every run are checked against those of the pandas run: the chart_events frame, pids, evids, labels,
+# ICD-9 code store and event store counts and offsets must be equal, and the float columns (the normalized values and
+# the normalization statistics, whose sums the engine accumulates in a different order) equal to --rtol.
+#
+# Without --subset-path, a synthetic extract of --patients patients (see synthetic_mimic.py) is generated and sampled
+# whole with data_sampling/datasampler.py, so the comparison runs without access to MIMIC III.
+#
+# Usage:
+#   python3 benchmarks/sql_backend_benchmark.py --patients 2000 --threads 1 4
+#   python3 benchmarks/sql_backend_benchmark.py --subset-path mimic3_subset/ --sql-args="--memory-limit 2GB"
+
+import warnings
+warnings.simplefilter(action='ignore', category=FutureWarning)
+
+import argparse
+import json
+import os
+import pickle
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+PREPROCESS = os.path.join(ROOT_DIR, 'data_cleaning', 'preprocess_mp.py')
+PREPROCESS_SQL = os.path.join(ROOT_DIR, 'data_cleaning', 'preprocess_sql.py')
+EVENTS_TO_LIST = os.path.join(ROOT_DIR, 'data_cleaning', 'events_to_list.py')
+# outputs compared value by value, read with pickle.load
+PICKLES = ['icu_stays.pickle', 'evids.pickle', 'readmit_labels.pickle', 'categories.pickle']
+
+
+def synthetic_subset(work_dir, num_patients, seed):
+    sys.path.insert(0, os.path.join(ROOT_DIR, 'benchmarks'))
+    from synthetic_mimic import generate
+    num_stays, _ = generate(os.path.join(work_dir, 'mimic', ''), num_patients, seed)
+    subprocess.run([sys.executable, os.path.join(ROOT_DIR, 'data_sampling', 'datasampler.py'), '--project-dir', work_dir,
+                    '--mimic-path', 'mimic/', '--subset-path', 'subset/', '--sample-size', str(num_stays)],
+                   check=True, stdout=subprocess.DEVNULL)
+    return os.path.join(work_dir, 'subset', '')
+
+def run(script, out_dir, options):
+    # runs script and events_to_list.py in out_dir and returns the wall seconds of the script and the stages of both
+    # traces
+    os.makedirs(out_dir, exist_ok=True)
+    start_time = time.perf_counter()
+    subprocess.run([sys.executable, script, *options, '--trace', 'preprocess.json'], cwd=out_dir, check=True,
+                   stdout=subprocess.DEVNULL)
+    seconds = time.perf_counter() - start_time
+    subprocess.run([sys.executable, EVENTS_TO_LIST, '--trace', 'events.json'], cwd=out_dir, check=True,
+                   stdout=subprocess.DEVNULL)
+    stages = []
+    for name in ('preprocess.json', 'events.json'):
+        with open(os.path.join(out_dir, name)) as f:
+            stages.extend(json.load(f)['stages'])
+    return seconds, stages
+
+def load(path, name):
+    with open(os.path.join(path, name), 'rb') as f:
+        return pickle.load(f)
+
+def compare_outputs(reference, path, rtol):
+    # the outputs of path that differ from those of reference
+    differences = []
+    expected, actual = load(reference, 'chart_events_df.pickle'), load(path, 'chart_events_df.pickle')
+    if list(expected.columns) != list(actual.columns) or not (expected.dtypes == actual.dtypes).all():
+        differences.append('chart_events columns or dtypes')
+    elif len(expected) != len(actual):
+        differences.append('chart_events rows')
+    else:
+        for col in expected.columns:
+            expected_col, actual_col = expected[col].to_numpy(), actual[col].to_numpy()
+            if expected_col.dtype.kind == 'f':
+                equal = np.allclose(expected_col, actual_col, rtol=rtol, atol=rtol, equal_nan=True)
+            else:
+                equal = np.array_equal(expected_col, actual_col)
+            if not equal:
+                differences.append('chart_events.' + col)
+
+    differences.extend(name for name in PICKLES if load(reference, name) != load(path, name))
+
+    expected, actual = load(reference, 'preprocessing.pickle'), load(path, 'preprocessing.pickle')
+    expected_stats, actual_stats = expected.pop('event_label_stats'), actual.pop('event_label_stats')
+    if (expected != actual or expected_stats['itemid'] != actual_stats['itemid']
+            or not all(np.allclose(expected_stats[key], actual_stats[key], rtol=rtol, equal_nan=True) for key in ('mean', 'std'))):
+        differences.append('preprocessing.pickle')
+
+    for name in ('icd9/indices.npy', 'icd9/offsets.npy', 'events/counts.npy', 'events/offsets.npy', 'events/lengths.npy'):
+        if not np.array_equal(np.load(os.path.join(reference, name)), np.load(os.path.join(path, name))):
+            differences.append(name)
+    with open(os.path.join(reference, 'icd9', 'vocab.json')) as expected, open(os.path.join(path, 'icd9', 'vocab.json')) as actual:
+        if json.load(expected) != json.load(actual):
+            differences.append('icd9/vocab.json')
+    if not np.allclose(np.load(os.path.join(reference, 'events', 'values.npy')), np.load(os.path.join(path, 'events', 'values.npy')),
+                       rtol=rtol, atol=rtol, equal_nan=True):
+        differences.append('events/values.npy')
+    return differences
+
+def peak_rss(stages):
+    # of the preprocessing, without events_to_list.py, which is the same after both backends
+    return max(stage['peak_rss_mb'] for stage in stages if not stage['name'].startswith('events_to_list'))
+
+def report(name, seconds, stages):
+    print('\n{}: {:.2f}s, peak RSS {:.0f} MB'.format(name, seconds, peak_rss(stages)))
+    for stage in stages:
+        print('  {:<40}{:8.3f}s wall {:8.3f}s cpu {:8.0f} MB peak RSS'.format(stage['name'], stage['wall'], stage['cpu'],
+                                                                            stage['peak_rss_mb']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--subset-path', help='MIMIC III subset to preprocess; a synthetic one by default')
+    parser.add_argument('--patients', type=int, default=2000, help='patients of the synthetic subset')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--threads', type=int, nargs='+', default=[os.cpu_count()], help='threads of the SQL engine')
+    parser.add_argument('--sql-args', default='', help='more options of preprocess_sql.py, e.g. "--memory-limit 2GB"')
+    parser.add_argument('--rtol', type=float, default=1e-4, help='tolerance of the float outputs')
+    parser.add_argument('--work-dir', help='directory to keep the outputs in; a temporary directory by default')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        work_dir = os.path.abspath(args.work_dir or temp_dir)
+        subset_path = os.path.abspath(args.subset_path) + '/' if args.subset_path else synthetic_subset(work_dir, args.patients, args.seed)
+        print('subset', subset_path, 'CHARTEVENTS', 'columns' if os.path.isdir(subset_path + 'CHARTEVENTS') else 'csv')
+
+        reference = os.path.join(work_dir, 'pandas')
+        seconds, stages = run(PREPROCESS, reference, ['--mimic-path', subset_path])
+        report('pandas', seconds, stages)
+        results = [('pandas', seconds, peak_rss(stages), [])]
+
+        for threads in args.threads:
+            name = 'sql, {} threads'.format(threads)
+            out_dir = os.path.join(work_dir, 'sql-{}'.format(threads))
+            seconds, stages = run(PREPROCESS_SQL, out_dir,
+                                  ['--mimic-path', subset_path, '--threads', str(threads), *shlex.split(args.sql_args)])
+            report(name, seconds, stages)
+            results.append((name, seconds, peak_rss(stages),
+                            compare_outputs(reference, out_dir, args.rtol)))
+
+    print('\n{:<20}{:>10}{:>16}  outputs'.format('backend', 'seconds', 'peak RSS'))
+    for name, seconds, peak_rss, differences in results:
+        print('{:<20}{:>9.2f}s{:>13.0f} MB  {}'.format(name, seconds, peak_rss,
+                                                      'reference' if name == 'pandas' else
+                                                      'differ: ' + ', '.join(differences) if differences else 'same'))
@@ -0,0 +1,117 @@
+# Measures hour-by-hour scoring with a streaming.SessionStore of thousands of open stays: --stays stays of --data-dir
+# (cycling through the stays if there are fewer) are opened and fed their hours one at a time, in calls of
+# --batch-size stays, for --hours hours. Reported are the latency of an update call and per stay update at the first
+# and the last hour, which should be the same as an update does not depend on the hours before, the latency of
+# single-stay updates with all stays open, and for comparison the time per stay of rescoring the whole window with
+# the bidirectional LSTMPlusCNN of the same hidden size, as scoring every hour without carried state does.
+# The probabilities after the last hour are checked against StreamingLSTM.forward over all hours at once.
+#
+# Usage:
+#   python3 benchmarks/streaming_benchmark.py --data-dir data --stays 5000 --batch-size 256
+#   python3 benchmarks/streaming_benchmark.py --data-dir data --checkpoint source/checkpoints/streaming/fold-1.pt
+
+import argparse
+import os
+import resource
+import sys
+import time
+
+import numpy as np
+import torch
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT_DIR, 'source'))
+import dataloader
+from checkpoint import load_checkpoint
+from models import LSTMPlusCNN, StreamingLSTM
+from streaming import SessionStore
+
+
+def encoded_stays(dataset, num_stays, encoding, chunk_size=512):
+    # x of every stay as encoded by the collate function of encoding, and its code bag
+    collate = dataloader.ENCODINGS[encoding]
+    xs, codes = [], []
+    for start in range(0, num_stays, chunk_size):
+        items = [dataset[i % len(dataset)] for i in range(start, min(start + chunk_size, num_stays))]
+        xs.append(collate(items, dataset.shape)[0])
+        codes.extend(item[1] for item in items)
+    return torch.cat(xs), codes
+
+def percentiles(seconds):
+    return '{:7.2f} ms median, {:7.2f} ms p99'.format(np.median(seconds) * 1e3, np.percentile(seconds, 99) * 1e3)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data-dir', default=os.path.join(ROOT_DIR, 'data'))
+    parser.add_argument('--checkpoint', help='StreamingLSTM checkpoint; an untrained model is used without one')
+    parser.add_argument('--encoding', choices=list(dataloader.ENCODINGS), default='events')
+    parser.add_argument('--hidden-size', type=int, default=128)
+    parser.add_argument('--stays', type=int, default=5000)
+    parser.add_argument('--hours', type=int, default=48)
+    parser.add_argument('--batch-size', type=int, default=256, help='stays updated per call')
+    parser.add_argument('--single-updates', type=int, default=1000)
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads())
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    dataset = dataloader.get_dataset(args.data_dir)
+    if args.checkpoint is not None:
+        model, checkpoint = load_checkpoint(args.checkpoint)
+        encoding = checkpoint['encoding']
+    else:
+        torch.manual_seed(0)
+        encoding = args.encoding
+        model = StreamingLSTM(input_size=dataloader.input_size(dataset.shape, encoding), feature_len=dataset.num_codes,
+                              hidden_size=args.hidden_size)
+    model.eval()
+    hours = min(args.hours, dataset.shape[1])
+    x, codes = encoded_stays(dataset, args.stays, encoding)
+    print('{} open stays, {} hours, {} stays per update call, {} threads'.format(args.stays, hours, args.batch_size,
+                                                                                 args.threads))
+
+    store = SessionStore(model, dataset.shape, encoding, capacity=1024)
+    for stay in range(args.stays):
+        store.open(stay, codes[stay])
+
+    call_seconds = {}
+    probs = np.zeros(args.stays, dtype=np.float32)
+    for hour in range(hours):
+        call_seconds[hour] = []
+        for start in range(0, args.stays, args.batch_size):
+            stays = list(range(start, min(start + args.batch_size, args.stays)))
+            start_time = time.perf_counter()
+            probs[stays] = store.update(stays, x[stays, hour])
+            call_seconds[hour].append(time.perf_counter() - start_time)
+
+    for hour in (0, hours - 1):
+        print('hour {:>2}: update call {}, {:6.1f} us per stay update'.format(
+            hour + 1, percentiles(call_seconds[hour]), np.sum(call_seconds[hour]) / args.stays * 1e6))
+
+    # the stays are fed one more hour, one stay per call, with all of them open
+    single_seconds = []
+    for stay in np.random.default_rng(0).choice(args.stays, min(args.single_updates, args.stays), replace=False):
+        start_time = time.perf_counter()
+        store.update([stay], x[[stay], hours - 1])
+        single_seconds.append(time.perf_counter() - start_time)
+    print('single-stay update: {}'.format(percentiles(single_seconds)))
+
+    # rescoring the whole window of a batch of stays at every hour, without carried state
+    window_model = LSTMPlusCNN(input_size=dataloader.input_size(dataset.shape, encoding), input_len=dataset.shape[1],
+                               feature_len=dataset.num_codes, hidden_size=model.lstm.hidden_size).eval()
+    batch = dataloader.ENCODINGS[encoding]([dataset[i % len(dataset)] for i in range(args.batch_size)], dataset.shape)
+    with torch.no_grad():
+        window_model(*batch[:3])
+        start_time = time.perf_counter()
+        window_model(*batch[:3])
+        window_seconds = time.perf_counter() - start_time
+    print('rescoring the {}-hour window with LSTMPlusCNN: {:6.1f} us per stay update'.format(
+        dataset.shape[1], window_seconds / args.batch_size * 1e6))
+
+    # the probabilities after the last hour match scoring all hours at once
+    check = list(range(min(args.stays, 256)))
+    with torch.no_grad():
+        feats = dataloader.code_bags([codes[stay] for stay in check])
+        reference = model(x[check, :hours], feats, None)[:, -1].numpy()
+    print('max probability delta to StreamingLSTM.forward: {:.2e}'.format(np.abs(probs[check] - reference).max()))
+    print('peak RSS {:.0f} MB'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3))
@@ -0,0 +1,242 @@
+# Generates a synthetic MIMIC III extract laid out like the real one: PATIENTS.csv, ICUSTAYS.csv, DIAGNOSES_ICD.csv,
+# D_ITEMS.csv and CHARTEVENTS.csv with the columns and upper-case headers of the MIMIC III csv files, so it can be fed
+# to data_sampling/datasampler.py and from there to the rest of the pipeline. No real patient data is used.
+#
+# The chart events use the real itemids the preprocessing knows: those of itemid_to_category_num and the ones
+# label_change maps onto them, plus a few real uncategorized itemids that the preprocessing drops. Every category is
+# charted at its own rate per hour of a stay (CATEGORY_RATES: vital signs hourly, GCS components and temperature
+# every few hours, weight and height about daily), drawn per hour from a Poisson distribution, so the number of events
+# per hour and category varies like it does in MIMIC. Pulmonary artery pressures are only charted for a share of the
+# stays. Stay lengths are log-normal with a median of about two days, patients have one or more stays, some of them
+# within 30 days of the one before, and some patients are under 18 or die in or after their stay, so the exclusions
+# and both kinds of positive readmission labels occur.
+#
+# Usage:
+#   python3 benchmarks/synthetic_mimic.py --out synthetic_mimic/ --patients 2000 --seed 0
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT_DIR, 'data_cleaning'))
+from preprocess_mp import category_dict, itemid_to_category_num, label_change
+
+# events per hour, mean and std of valuenum of every category of preprocess_mp.category_dict
+CATEGORY_RATES = {
+    'Temperature': (0.3, 37.0, 0.7),
+    'Respiratory': (1.2, 19.0, 5.0),
+    'Heart Rate': (1.1, 88.0, 16.0),
+    'BP sys': (1.6, 120.0, 20.0),
+    'BP dias': (1.6, 62.0, 12.0),
+    'Capillary Refill Rate': (0.25, 1.0, 0.3),
+    'Glucose': (0.2, 135.0, 40.0),
+    'pH': (0.15, 7.38, 0.06),
+    'PAP sys': (1.0, 36.0, 10.0),
+    'PAP dias': (1.0, 16.0, 6.0),
+    'GCS': (0.9, 4.5, 1.2),
+    'Weight': (0.04, 82.0, 22.0),
+    'Height': (0.01, 169.0, 10.0),
+}
+# share of the stays with a pulmonary artery catheter, the only ones with PAP events
+PAP_SHARE = 0.15
+# real itemids outside the categories (code status, precautions, ...), charted with a value and dropped by the
+# preprocessing
+UNCATEGORIZED_ITEMIDS = [128, 550, 742, 1125, 31, 80, 1337, 224080]
+UNCATEGORIZED_RATE = 6.0
+# share of the chart events without a numeric value, and without an icustay_id
+MISSING_VALUE_SHARE = 0.03
+MISSING_STAY_SHARE = 0.005
+
+# common ICD-9 diagnoses of MIMIC III; the rest of the vocabulary is made of synthetic codes
+COMMON_ICD9_CODES = ['4019', '4280', '42731', '41401', '5849', '25000', '2724', '51881', '5990', '53081', '2720',
+                     'V053', 'V290', '2859', '2449', '486', '2851', '2762', '496', '99592', 'V5861', '0389', '5070',
+                     'V3000', '3051', '40390', '311', '412', '2875', '41071']
+NUM_ICD9_CODES = 5000
+ICD9_CODES_PER_ADMISSION = 9
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def category_itemids():
+    # the itemids charted for every category number, including those label_change maps to another itemid
+    itemids = {}
+    for itemid, category_num in itemid_to_category_num.items():
+        itemids.setdefault(category_num, []).append(itemid)
+    for itemid, new_itemid in label_change.items():
+        if new_itemid in itemid_to_category_num and itemid not in itemid_to_category_num:
+            itemids[itemid_to_category_num[new_itemid]].append(itemid)
+    return {category_num: np.array(sorted(ids)) for category_num, ids in itemids.items()}
+
+def generate_patients(rng, num_patients):
+    subject_ids = np.arange(1, num_patients + 1)
+    # a tenth of the patients are newborns, the others adults of 18 to 90 at their first stay
+    ages = np.where(rng.random(num_patients) < 0.1, 0, rng.integers(18, 90, num_patients))
+    first_intime = pd.Timestamp('2100-01-01') + pd.to_timedelta(rng.integers(0, 3650, num_patients), 'D')
+    dob = (first_intime - pd.to_timedelta(ages * 365 + rng.integers(0, 365, num_patients), 'D')).normalize()
+    return pd.DataFrame({'subject_id': subject_ids, 'dob': dob, 'first_intime': first_intime})
+
+def generate_stays(rng, patients):
+    num_patients = len(patients)
+    stays_per_patient = rng.geometric(0.7, num_patients)
+    subject_ids = np.repeat(patients['subject_id'].to_numpy(), stays_per_patient)
+    stay_numbers = np.arange(len(subject_ids)) - np.repeat(np.cumsum(stays_per_patient) - stays_per_patient,
+                                                           stays_per_patient)
+
+    # hours of every stay, log-normal with a median of 48 hours
+    hours = np.clip(np.round(rng.lognormal(np.log(48), 0.9, len(subject_ids))), 4, 30 * 24).astype(np.int64)
+    # days from a stay to the next, a fifth of them within 30 days
+    gaps = np.where(rng.random(len(subject_ids)) < 0.2, rng.integers(1, 30, len(subject_ids)),
+                    rng.integers(30, 1500, len(subject_ids)))
+    intimes, outtimes = [], []
+    next_intime = None
+    for subject_id, stay_number, stay_hours, gap in zip(subject_ids, stay_numbers, hours, gaps):
+        if stay_number == 0:
+            next_intime = patients['first_intime'].iloc[subject_id - 1]
+        intime = next_intime + pd.Timedelta(minutes=int(rng.integers(0, 60)))
+        outtime = intime + pd.Timedelta(hours=int(stay_hours))
+        intimes.append(intime)
+        outtimes.append(outtime)
+        next_intime = outtime.normalize() + pd.Timedelta(days=int(gap))
+
+    stays = pd.DataFrame({'subject_id': subject_ids, 'hadm_id': 100001 + np.arange(len(subject_ids)),
+                          'icustay_id': 200001 + np.arange(len(subject_ids)),
+                          'intime': intimes, 'outtime': outtimes, 'hours': hours})
+    stays['los'] = (stays['hours'] / 24).round(4)
+    return stays
+
+def generate_deaths(rng, patients, stays):
+    # 8% of the patients die in their last stay, 5% within 30 days of it and 12% later
+    last_outtime = stays.groupby('subject_id')['outtime'].max().reindex(patients['subject_id']).to_numpy()
+    last_intime = stays.groupby('subject_id')['intime'].max().reindex(patients['subject_id']).to_numpy()
+    draw = rng.random(len(patients))
+    dod = pd.Series(pd.NaT, index=patients.index, dtype='datetime64[ns]')
+    in_icu = draw < 0.08
+    dod[in_icu] = pd.to_datetime(last_intime[in_icu]).normalize()
+    within_thirty = (draw >= 0.08) & (draw < 0.13)
+    dod[within_thirty] = (pd.to_datetime(last_outtime[within_thirty]).normalize() +
+                          pd.to_timedelta(rng.integers(1, 30, within_thirty.sum()), 'D'))
+    later = (draw >= 0.13) & (draw < 0.25)
+    dod[later] = (pd.to_datetime(last_outtime[later]).normalize() +
+                  pd.to_timedelta(rng.integers(31, 2000, later.sum()), 'D'))
+    return dod
+
+def generate_chart_events(rng, stays):
+    # the events of all stays, category by category, as columns in stay and time order
+    itemids = category_itemids()
+    stay_of_hour = np.repeat(np.arange(len(stays)), stays['hours'].to_numpy())
+    hour_of_stay = np.arange(len(stay_of_hour)) - np.repeat(np.cumsum(stays['hours'].to_numpy()) - stays['hours'].to_numpy(),
+                                                            stays['hours'].to_numpy())
+    has_pap = rng.random(len(stays)) < PAP_SHARE
+
+    columns = {'stay': [], 'seconds': [], 'itemid': [], 'valuenum': []}
+    for category, category_num in category_dict.items():
+        rate, mean, std = CATEGORY_RATES[category]
+        counts = rng.poisson(rate, len(stay_of_hour))
+        if category.startswith('PAP'):
+            counts[~has_pap[stay_of_hour]] = 0
+        hours = np.repeat(np.arange(len(stay_of_hour)), counts)
+        values = rng.normal(mean, std, len(hours))
+        if category == 'GCS':
+            values = np.clip(np.round(values), 1, 6)
+        columns['stay'].append(stay_of_hour[hours])
+        columns['seconds'].append(hour_of_stay[hours] * 3600 + rng.integers(0, 3600, len(hours)))
+        columns['itemid'].append(rng.choice(itemids[category_num], len(hours)))
+        columns['valuenum'].append(np.round(values, 2))
+
+    counts = rng.poisson(UNCATEGORIZED_RATE, len(stay_of_hour))
+    hours = np.repeat(np.arange(len(stay_of_hour)), counts)
+    columns['stay'].append(stay_of_hour[hours])
+    columns['seconds'].append(hour_of_stay[hours] * 3600 + rng.integers(0, 3600, len(hours)))
+    columns['itemid'].append(rng.choice(UNCATEGORIZED_ITEMIDS, len(hours)))
+    columns['valuenum'].append(np.round(rng.normal(0, 1, len(hours)), 2))
+
+    columns = {name: np.concatenate(parts) for name, parts in columns.items()}
+    order = np.lexsort((columns['seconds'], columns['stay']))
+    stay = columns['stay'][order]
+    charttime = (stays['intime'].to_numpy()[stay] + columns['seconds'][order].astype('timedelta64[s]'))
+    valuenum = columns['valuenum'][order]
+    valuenum[rng.random(len(valuenum)) < MISSING_VALUE_SHARE] = np.nan
+    icustay_id = stays['icustay_id'].to_numpy()[stay].astype(np.float64)
+    icustay_id[rng.random(len(icustay_id)) < MISSING_STAY_SHARE] = np.nan
+
+    return pd.DataFrame({
+        'ROW_ID': np.arange(1, len(stay) + 1),
+        'SUBJECT_ID': stays['subject_id'].to_numpy()[stay],
+        'HADM_ID': stays['hadm_id'].to_numpy()[stay],
+        'ICUSTAY_ID': pd.array(icustay_id, dtype='Int64'),
+        'ITEMID': columns['itemid'][order],
+        'CHARTTIME': pd.to_datetime(charttime).strftime(DATE_FORMAT),
+        'STORETIME': (pd.to_datetime(charttime) + pd.Timedelta(minutes=5)).strftime(DATE_FORMAT),
+        'CGID': rng.integers(14000, 21000, len(stay)),
+        'VALUE': np.where(np.isnan(valuenum), 'Other/Remarks', valuenum.astype(str)),
+        'VALUENUM': valuenum,
+        'VALUEUOM': '',
+        'WARNING': '',
+        'ERROR': '',
+        'RESULTSTATUS': '',
+        'STOPPED': '',
+    })
+
+def generate_diagnoses(rng, stays):
+    vocab = COMMON_ICD9_CODES + ['{:05d}'.format(code) for code in
+                                 rng.choice(100000, NUM_ICD9_CODES - len(COMMON_ICD9_CODES), replace=False)]
+    # Zipf-like frequencies, the common codes first
+    weights = 1 / np.arange(1, len(vocab) + 1)
+    counts = np.maximum(rng.poisson(ICD9_CODES_PER_ADMISSION, len(stays)), 1)
+    admission = np.repeat(np.arange(len(stays)), counts)
+    codes = rng.choice(len(vocab), len(admission), p=weights / weights.sum())
+    seq_num = np.arange(len(admission)) - np.repeat(np.cumsum(counts) - counts, counts) + 1
+    return pd.DataFrame({'ROW_ID': np.arange(1, len(admission) + 1),
+                         'SUBJECT_ID': stays['subject_id'].to_numpy()[admission],
+                         'HADM_ID': stays['hadm_id'].to_numpy()[admission],
+                         'SEQ_NUM': seq_num, 'ICD9_CODE': np.array(vocab)[codes]})
+
+def generate(out_path, num_patients, seed=0):
+    # Writes a synthetic extract of num_patients patients to out_path. Returns the number of stays and chart events
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_path, exist_ok=True)
+
+    patients = generate_patients(rng, num_patients)
+    stays = generate_stays(rng, patients)
+    dod = generate_deaths(rng, patients, stays)
+
+    pd.DataFrame({'ROW_ID': patients['subject_id'], 'SUBJECT_ID': patients['subject_id'],
+                  'GENDER': rng.choice(['M', 'F'], len(patients)), 'DOB': patients['dob'].dt.strftime(DATE_FORMAT),
+                  'DOD': dod.dt.strftime(DATE_FORMAT), 'DOD_HOSP': dod.dt.strftime(DATE_FORMAT),
+                  'DOD_SSN': dod.dt.strftime(DATE_FORMAT), 'EXPIRE_FLAG': dod.notna().astype(int)}
+                 ).to_csv(os.path.join(out_path, 'PATIENTS.csv'), index=False)
+
+    pd.DataFrame({'ROW_ID': np.arange(1, len(stays) + 1), 'SUBJECT_ID': stays['subject_id'],
+                  'HADM_ID': stays['hadm_id'], 'ICUSTAY_ID': stays['icustay_id'], 'DBSOURCE': 'metavision',
+                  'FIRST_CAREUNIT': 'MICU', 'LAST_CAREUNIT': 'MICU', 'FIRST_WARDID': 52, 'LAST_WARDID': 52,
+                  'INTIME': stays['intime'].dt.strftime(DATE_FORMAT), 'OUTTIME': stays['outtime'].dt.strftime(DATE_FORMAT),
+                  'LOS': stays['los']}).to_csv(os.path.join(out_path, 'ICUSTAYS.csv'), index=False)
+
+    generate_diagnoses(rng, stays).to_csv(os.path.join(out_path, 'DIAGNOSES_ICD.csv'), index=False)
+
+    itemids = sorted(set(itemid_to_category_num) | set(label_change) | set(UNCATEGORIZED_ITEMIDS))
+    pd.DataFrame({'ROW_ID': np.arange(1, len(itemids) + 1), 'ITEMID': itemids,
+                  'LABEL': ['item {}'.format(itemid) for itemid in itemids], 'LINKSTO': 'chartevents'}
+                 ).to_csv(os.path.join(out_path, 'D_ITEMS.csv'), index=False)
+
+    chart_events = generate_chart_events(rng, stays)
+    chart_events.to_csv(os.path.join(out_path, 'CHARTEVENTS.csv'), index=False)
+    return len(stays), len(chart_events)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--out', default='synthetic_mimic/')
+    parser.add_argument('--patients', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    start_time = time.monotonic()
+    num_stays, num_events = generate(args.out, args.patients, args.seed)
+    print('{} patients, {} stays, {} chart events written to {} in {:.1f}s'.format(
+        args.patients, num_stays, num_events, args.out, time.monotonic() - start_time))
@@ -3,60 +3,172 @@ warnings.simplefilter(action='ignore', category=FutureWarning)
 
 import numpy as np
 import pandas as pd
+import argparse
 import datetime
+import glob
+import json
+import os
 import pickle
+import shutil
+import sys
 import time
-import multiprocessing as mp
-from p_tqdm import p_imap
-
-def create_event_list(group):
-    events = []
-    for j in range(48):
-        events.append([])
-        for k in range(13):
-            events[j].append([])
-            events[j][k] = group.loc[(group.hours_from_beginning==j) & (group.category_num==k)]['event_label_norm'].values.tolist()
-    return events
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'source'))
+import instrumentation
+
+NUM_HOURS = 48
+NUM_CATEGORIES = 13
+
+def build_event_store(chart_events):
+    # Builds the event store arrays in one sweep over chart_events sorted by icustay_id, hours_from_beginning and
+    # category_num: every event's (stay, hour, category) cell is computed at once, the events per cell are counted
+    # with a single bincount and, as the rows are already in cell order, the values need no reordering.
+    # Events without a category or outside the 48 hours are skipped, as they have no cell.
+    # Memory is a few arrays with one entry per event plus the counts, with one entry per cell.
+    stays = chart_events['icustay_id'].to_numpy()
+    hours = chart_events['hours_from_beginning'].to_numpy()
+    categories = chart_events['category_num'].to_numpy()
+
+    # stay index of every event from the positions where icustay_id changes
+    stay_idx = np.zeros(len(stays), dtype=np.int64)
+    np.cumsum(stays[1:] != stays[:-1], out=stay_idx[1:])
+    num_stays = int(stay_idx[-1]) + 1 if len(stays) else 0
+
+    in_cell = (hours >= 0) & (hours < NUM_HOURS) & (categories >= 0) & (categories < NUM_CATEGORIES)
+    cells = (stay_idx[in_cell] * NUM_HOURS + hours[in_cell].astype(np.int64)) * NUM_CATEGORIES + categories[in_cell].astype(np.int64)
+
+    values = chart_events['event_label_norm'].to_numpy(dtype=np.float32)[in_cell]
+    counts = np.bincount(cells, minlength=num_stays * NUM_HOURS * NUM_CATEGORIES).astype(np.int32)
+    counts = counts.reshape(num_stays, NUM_HOURS, NUM_CATEGORIES)
+    offsets = np.zeros(num_stays + 1, dtype=np.int64)
+    np.cumsum(counts.sum(axis=(1, 2)), out=offsets[1:])
+
+    return values, counts, offsets
+
+def stay_lengths(chart_events):
+    # Number of real hours of every stay, in stay order: the hours up to the last hour before the padding copies,
+    # which preprocess_mp.py marks with hours_from_end -1
+    real_events = chart_events[chart_events['hours_from_end'] >= 0]
+    return (real_events.groupby('icustay_id')['hours_from_beginning'].max() + 1).to_numpy(dtype=np.int32)
+
+def save_event_store(values, counts, offsets, path, lengths=None):
+    # Writes the events as flat memory-mappable arrays (see EventStore in source/dataloader.py):
+    # float32 values in (stay, hour, category, event) order, int32 counts per (stay, hour, category),
+    # int64 offsets of every stay into values and int32 real hours of every stay, with the dims of the events
+    # in meta.json
+    os.makedirs(path, exist_ok=True)
+
+    np.save(os.path.join(path, 'values.npy'), values)
+    np.save(os.path.join(path, 'counts.npy'), counts)
+    np.save(os.path.join(path, 'offsets.npy'), offsets)
+    if lengths is not None:
+        np.save(os.path.join(path, 'lengths.npy'), lengths)
+
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'shape': [*counts.shape, int(counts.max())]}, f)
+
+def write_npy(raw_path, path, dtype, shape):
+    # Writes the raw array bytes in raw_path behind an .npy header, without reading them into memory
+    with open(path, 'wb') as f, open(raw_path, 'rb') as raw:
+        np.lib.format.write_array_header_1_0(f, {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                                                 'fortran_order': False, 'shape': shape})
+        shutil.copyfileobj(raw, f)
+    os.remove(raw_path)
+
+def save_event_store_parts(part_paths, path):
+    # Builds and saves the event store from the chart_events partitions written by preprocess_mp.py --stream,
+    # one partition at a time: values and counts are appended to the files as they are built and only the
+    # offsets, with one entry per stay, are kept in memory
+    os.makedirs(path, exist_ok=True)
+    values_path, counts_path = os.path.join(path, 'values.raw'), os.path.join(path, 'counts.raw')
+
+    offsets = [np.zeros(1, dtype=np.int64)]
+    lengths = []
+    num_stays = 0
+    max_num_events = 0
+    with open(values_path, 'wb') as values_file, open(counts_path, 'wb') as counts_file:
+        for part_path in part_paths:
+            with open(part_path, 'rb') as f:
+                chart_events = pickle.load(f)
+            chart_events = chart_events.sort_values(['icustay_id', 'hours_from_beginning', 'category_num'])
+
+            hour_is_48 = chart_events.loc[chart_events.hours_from_beginning == 47]['icustay_id'].unique()
+            assert len(hour_is_48) == (len(chart_events['icustay_id'].unique()))
+
+            values, counts, part_offsets = build_event_store(chart_events)
+            values.tofile(values_file)
+            counts.tofile(counts_file)
+            offsets.append(part_offsets[1:] + offsets[-1][-1])
+            lengths.append(stay_lengths(chart_events))
+            num_stays += len(counts)
+            max_num_events = max(max_num_events, int(counts.max()))
+            print(part_path, len(counts), 'stays')
+
+    offsets = np.concatenate(offsets)
+    write_npy(values_path, os.path.join(path, 'values.npy'), np.float32, (int(offsets[-1]),))
+    write_npy(counts_path, os.path.join(path, 'counts.npy'), np.int32, (num_stays, NUM_HOURS, NUM_CATEGORIES))
+    np.save(os.path.join(path, 'offsets.npy'), offsets)
+    np.save(os.path.join(path, 'lengths.npy'), np.concatenate(lengths))
+
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'shape': [num_stays, NUM_HOURS, NUM_CATEGORIES, max_num_events]}, f)
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--trace', help='json file to write the time and memory of every step to')
+    parser.add_argument('--trace-memory', action='store_true', help='also trace Python allocations with tracemalloc')
+    args = parser.parse_args()
+
     start_time = time.monotonic()
+    if args.trace is not None:
+        instrumentation.enable(memory=args.trace_memory)
+    stage = instrumentation.stage
+
+    # partitions written by preprocess_mp.py --stream
+    part_paths = sorted(glob.glob(os.path.join('chart_events_df', 'part-*.pickle')))
+
+    if part_paths:
+        print('creating events list from {} partitions...'.format(len(part_paths)))
+        with stage('events_to_list.build_and_save_parts', partitions=len(part_paths)):
+            save_event_store_parts(part_paths, 'events')
+    else:
+        with stage('events_to_list.read'):
+            with open('chart_events_df.pickle', 'rb') as f:
+                chart_events = pickle.load(f)
 
-    with open('chart_events_df.pickle', 'rb') as f:
-        chart_events = pickle.load(f)
+        # labels = chart_events[['icustay_id', 'readmit_label']].drop_duplicates(subset='icustay_id').sort_values('icustay_id')
 
-    # labels = chart_events[['icustay_id', 'readmit_label']].drop_duplicates(subset='icustay_id').sort_values('icustay_id')
+        # with open('readmit_labels.pickle', 'wb') as f:
+        #     pickle.dump(labels['readmit_label'].to_list(), f)
 
-    # with open('readmit_labels.pickle', 'wb') as f:
-    #     pickle.dump(labels['readmit_label'].to_list(), f)
-    
-    chart_events = chart_events.sort_values(['icustay_id', 'hours_from_beginning', 'category_num'])
+        with stage('events_to_list.sort', rows=len(chart_events)):
+            chart_events = chart_events.sort_values(['icustay_id', 'hours_from_beginning', 'category_num'])
 
-    hour_is_48 = chart_events.loc[chart_events.hours_from_beginning == 47]['icustay_id'].unique()
-    print(len(hour_is_48))
+        hour_is_48 = chart_events.loc[chart_events.hours_from_beginning == 47]['icustay_id'].unique()
+        print(len(hour_is_48))
 
-    print(len(chart_events['icustay_id'].unique()))
+        print(len(chart_events['icustay_id'].unique()))
 
-    assert len(hour_is_48) == (len(chart_events['icustay_id'].unique()))
+        assert len(hour_is_48) == (len(chart_events['icustay_id'].unique()))
 
 
 
-    print('creating events list...')
-    events = []
-    iter = p_imap(create_event_list, [data for icu_stay, data in chart_events.groupby('icustay_id')], num_cpus=10) #10 cpus for Karl's computer
-    
-    for result in iter:
-        events.append(result)
+        print('creating events list...')
+        with stage('events_to_list.build', rows=len(chart_events)):
+            values, counts, offsets = build_event_store(chart_events)
 
-    print('events list done!')
-    # max_len for MIMIC-III demo is 48
-    # final output should have shape (len_pids, 48, 13, max_len) 
-    print(events)
+        print('events list done!')
+        # max_len for MIMIC-III demo is 48
+        # final output should have shape (len_pids, 48, 13, max_len) 
 
-    print('pickling events...')
-    with open('events.pickle', 'wb') as f:
-        pickle.dump(events, f)
+        print('saving events...')
+        with stage('events_to_list.save'):
+            save_event_store(values, counts, offsets, 'events', stay_lengths(chart_events))
 
-    print('done pickling events!')
+    print('done saving events!')
 
     end_time = time.monotonic()
-    print(datetime.timedelta(seconds=end_time - start_time))
\ No newline at end of file
+    print(datetime.timedelta(seconds=end_time - start_time))
+    if args.trace is not None:
+        print(instrumentation.summary())
+        instrumentation.save(args.trace)
@@ -3,152 +3,198 @@ warnings.simplefilter(action='ignore', category=FutureWarning)
 
 import numpy as np
 import pandas as pd
-from sklearn.preprocessing import MultiLabelBinarizer
+import argparse
 import datetime
+import glob
+import json
+import os
 import pickle
+import sys
 import time
-from tqdm import tqdm
-import multiprocessing as mp
-
-
-def process_icustay(last_hour_data):
-    hours_from_beginning = last_hour_data.iloc[0]['hours_from_beginning']
-    full_fake_data = pd.DataFrame()
-    max_row_id = 330641192
-    for i in range(int(hours_from_beginning) + 1, 48):
-        fake_data = last_hour_data.copy().reset_index()
-        fake_data['hours_from_beginning'] = i
-        fake_data['hours_from_end'] = -1
-        fake_data['row_id'] = range(max_row_id + 1, max_row_id + 1 + len(fake_data.index))
-        full_fake_data = full_fake_data.append(fake_data)
-        max_row_id += len(fake_data.index)
-    return full_fake_data
-    
-
-
-if __name__ == '__main__':
-    start_time = time.monotonic()
-
-    mimic_path = 'mimic3_subset/'
-
-    icu_stays = pd.read_csv(mimic_path + 'ICUSTAYS.csv', header=0, parse_dates=['intime', 'outtime'])
-    patients = pd.read_csv(mimic_path + 'PATIENTS.csv', header=0, parse_dates=['dob', 'dod', 'dod_hosp', 'dod_ssn'])
-    icd_9 = pd.read_csv(mimic_path + 'DIAGNOSES_ICD.csv', header=0)
-    chart_events = pd.read_csv(mimic_path + 'CHARTEVENTS.csv', header=0,
-                            usecols=['row_id', 'subject_id', 'hadm_id', 'icustay_id', 'itemid', 'charttime', 'valuenum'],
-                            parse_dates=['charttime']) #with this config, 56 bytes per row
-    #d_items = pd.read_csv(mimic_path + 'D_ITEMS.csv', header=0)
-
-    category_dict = {'Temperature': 0,
-                    'Respiratory': 1,
-                    'Heart Rate': 2,
-                    'BP sys': 3,
-                    'BP dias': 4,
-                    'Capillary Refill Rate': 5,
-                    'Glucose': 6,
-                    'pH': 7,
-                    'PAP sys': 8,
-                    'PAP dias': 9,
-                    'GCS': 10,
-                    'Weight': 11,
-                    'Height': 12}
-
-    # To create following dictionaries: Add categories information from excel file (see category_exploration.py) and remove any non-categorized events
-    # categories = pd.read_excel('unique_ce_labels.xlsx').dropna(subset='category')
-    # chart_events = chart_events.merge(categories[['event_label', 'category', 'label_change']], left_on='event_label', right_on='event_label').dropna(subset='category')
-
-    # Create label change dict with (itemid, new_item_id) referencing categories
-    # hardcoded with reference to the following, where categories is imported from category_exploration.py output file unique_ce_labels.xlsx
-    # change_reqd = categories.loc[~categories['label_change'].isna()][['event_label', 'label_change', 'itemid']]
-    # print(change_reqd.head(20))
-
-    label_change = {
-        8549:220045, #HR Alarm [High] -> Heart Rate
-        5815:220045, #HR Alarm [Low] -> Heart Rate
-        220047:220045, #Heart Rate Alarm - Low -> Heart Rate
-        220046:220045, #Heart rate Alarm - High -> Heart Rate
-
-        220050:51, #Arterial Blood Pressure systolic -> Arterial BP [Systolic]
-        5813:51, #ABP Alarm [Low] -> Arterial BP [Systolic]
-        8547:51, #ABP Alarm [High] -> Arterial BP [Systolic]
-        220056:51, #Arterial Blood Pressure Alarm - Low -> Arterial BP [Systolic]
-        220058:51, #Arterial Blood Pressure Alarm - High -> Arterial BP [Systolic]
-        225309:51, #ART BP Systolic -> Arterial BP [Systolic]
-        6701:51, #Arterial BP #2 [Systolic] -> Arterial BP [Systolic]
-        227538:51, #ART Blood Pressure Alarm - Low -> Arterial BP [Systolic]
-        
-        220051:8368, #Arterial Blood Pressure diastolic -> Arterial BP [Diastolic]
-        225310:8368, #ART BP Diastolic -> Arterial BP [Diastolic]
-        8555:8368, #Arterial BP #2 [Diastolic] -> Arterial BP [Diastolic]
-    }
-
-    # # Create dict from itemid to category
-    # categories['category_num'] = categories['category'].map(category_dict)
-    # item_id_to_category = categories.set_index('itemid')['category_num'].to_dict()
-    # print(item_id_to_category)
-
-    itemid_to_category_num = {
-        220045: 2, 220210: 1, 220277: 5, 646: 5, 220179: 3, 
-        220180: 4, 51: 3, 8368: 4, 8549: 2, 5815: 2, 5820: 5, 
-        8554: 5, 5819: 1, 8553: 1, 8551: 3, 5817: 3, 581: 11, 
-        455: 3, 8441: 4, 220050: 3, 220051: 4, 113: 2, 223753: 10, 
-        5813: 3, 8547: 3, 220739: 10, 223900: 10, 223901: 10, 
-        223761: 0, 184: 10, 723: 10, 454: 10, 198: 10, 5814: 2, 
-        8548: 2, 220074: 2, 677: 0, 678: 0, 8448: 9, 492: 8, 807: 6, 
-        676: 0, 679: 0, 615: 1, 219: 1, 220047: 2, 220046: 2, 223770: 5,
-        223769: 5, 224161: 1, 224162: 1, 226253: 5, 225664: 6, 
-        811: 6, 619: 1, 220293: 1, 220292: 1, 8552: 8, 5818: 8, 
-        614: 1, 224689: 1, 1529: 6, 223751: 3, 223752: 3, 780: 7, 
-        1126: 7, 224688: 1, 220056: 3, 220058: 3, 225309: 3, 225310: 4, 
-        224639: 11, 226531: 11, 762: 11, 226512: 11, 220734: 7, 
-        226537: 6, 226707: 12, 226730: 12, 223762: 0, 6701: 3, 
-        8555: 4, 220060: 9, 220059: 8, 227538: 3, 220066: 8, 220063: 8}
-
-    ################# I. Drop Empty Rows and Consolidate Data from Other Tables
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'source'))
+import instrumentation
+
+
+category_dict = {'Temperature': 0,
+                'Respiratory': 1,
+                'Heart Rate': 2,
+                'BP sys': 3,
+                'BP dias': 4,
+                'Capillary Refill Rate': 5,
+                'Glucose': 6,
+                'pH': 7,
+                'PAP sys': 8,
+                'PAP dias': 9,
+                'GCS': 10,
+                'Weight': 11,
+                'Height': 12}
+
+# To create following dictionaries: Add categories information from excel file (see category_exploration.py) and remove any non-categorized events
+# categories = pd.read_excel('unique_ce_labels.xlsx').dropna(subset='category')
+# chart_events = chart_events.merge(categories[['event_label', 'category', 'label_change']], left_on='event_label', right_on='event_label').dropna(subset='category')
+
+# Create label change dict with (itemid, new_item_id) referencing categories
+# hardcoded with reference to the following, where categories is imported from category_exploration.py output file unique_ce_labels.xlsx
+# change_reqd = categories.loc[~categories['label_change'].isna()][['event_label', 'label_change', 'itemid']]
+# print(change_reqd.head(20))
+
+label_change = {
+    8549:220045, #HR Alarm [High] -> Heart Rate
+    5815:220045, #HR Alarm [Low] -> Heart Rate
+    220047:220045, #Heart Rate Alarm - Low -> Heart Rate
+    220046:220045, #Heart rate Alarm - High -> Heart Rate
+
+    220050:51, #Arterial Blood Pressure systolic -> Arterial BP [Systolic]
+    5813:51, #ABP Alarm [Low] -> Arterial BP [Systolic]
+    8547:51, #ABP Alarm [High] -> Arterial BP [Systolic]
+    220056:51, #Arterial Blood Pressure Alarm - Low -> Arterial BP [Systolic]
+    220058:51, #Arterial Blood Pressure Alarm - High -> Arterial BP [Systolic]
+    225309:51, #ART BP Systolic -> Arterial BP [Systolic]
+    6701:51, #Arterial BP #2 [Systolic] -> Arterial BP [Systolic]
+    227538:51, #ART Blood Pressure Alarm - Low -> Arterial BP [Systolic]
+    
+    220051:8368, #Arterial Blood Pressure diastolic -> Arterial BP [Diastolic]
+    225310:8368, #ART BP Diastolic -> Arterial BP [Diastolic]
+    8555:8368, #Arterial BP #2 [Diastolic] -> Arterial BP [Diastolic]
+}
+
+# # Create dict from itemid to category
+# categories['category_num'] = categories['category'].map(category_dict)
+# item_id_to_category = categories.set_index('itemid')['category_num'].to_dict()
+# print(item_id_to_category)
+
+itemid_to_category_num = {
+    220045: 2, 220210: 1, 220277: 5, 646: 5, 220179: 3, 
+    220180: 4, 51: 3, 8368: 4, 8549: 2, 5815: 2, 5820: 5, 
+    8554: 5, 5819: 1, 8553: 1, 8551: 3, 5817: 3, 581: 11, 
+    455: 3, 8441: 4, 220050: 3, 220051: 4, 113: 2, 223753: 10, 
+    5813: 3, 8547: 3, 220739: 10, 223900: 10, 223901: 10, 
+    223761: 0, 184: 10, 723: 10, 454: 10, 198: 10, 5814: 2, 
+    8548: 2, 220074: 2, 677: 0, 678: 0, 8448: 9, 492: 8, 807: 6, 
+    676: 0, 679: 0, 615: 1, 219: 1, 220047: 2, 220046: 2, 223770: 5,
+    223769: 5, 224161: 1, 224162: 1, 226253: 5, 225664: 6, 
+    811: 6, 619: 1, 220293: 1, 220292: 1, 8552: 8, 5818: 8, 
+    614: 1, 224689: 1, 1529: 6, 223751: 3, 223752: 3, 780: 7, 
+    1126: 7, 224688: 1, 220056: 3, 220058: 3, 225309: 3, 225310: 4, 
+    224639: 11, 226531: 11, 762: 11, 226512: 11, 220734: 7, 
+    226537: 6, 226707: 12, 226730: 12, 223762: 0, 6701: 3, 
+    8555: 4, 220060: 9, 220059: 8, 227538: 3, 220066: 8, 220063: 8}
+
+CHART_EVENT_COLS = ['row_id', 'subject_id', 'hadm_id', 'icustay_id', 'itemid', 'charttime', 'valuenum']
+
+# dtypes of the chart_events columns from section I on: int32 ids, int16 hours (the window keeps hours 0-47), int8
+# categories and labels and float32 values, 38 bytes per row at the end of section V. Columns a section only
+# needs for itself are kept out of the frame, hadm_id is dropped in section I as no later section uses it, and the
+# sections that drop rows renumber them, so the frame's index takes no memory
+CHART_EVENT_DTYPES = {'row_id': np.int32, 'subject_id': np.int32, 'icustay_id': np.int32, 'itemid': np.int32,
+                      'valuenum': np.float32, 'category_num': np.int8, 'readmit_label': np.int8,
+                      'event_label_norm': np.float32, 'hours_from_end': np.int16, 'hours_from_beginning': np.int16}
+# category_num of the events of itemids without a category, which are kept for windowing but left out of the
+# event store by events_to_list.py
+UNCATEGORIZED = -1
+# rows of CHARTEVENTS.csv parsed at a time when it is read whole
+READ_CHUNK_SIZE = 1_000_000
+
+
+def read_chart_events(mimic_path, chunksize=None):
+    # with chunksize, an iterator over frames of chunksize rows
+    if os.path.isdir(mimic_path + 'CHARTEVENTS'):
+        return read_chart_event_columns(mimic_path + 'CHARTEVENTS', chunksize)
+    # hadm_id and icustay_id may be empty in CHARTEVENTS.csv and are read as floats until section I drops those rows.
+    # The whole file is parsed in chunks as well, as the parser's buffers of the whole file take more than the frame
+    dtypes = {col: CHART_EVENT_DTYPES[col] for col in ('row_id', 'subject_id', 'itemid', 'valuenum')}
+    chunks = pd.read_csv(mimic_path + 'CHARTEVENTS.csv', header=0, usecols=CHART_EVENT_COLS, dtype=dtypes,
+                         parse_dates=['charttime'], chunksize=chunksize or READ_CHUNK_SIZE) #with this config, 40 bytes per row
+    if chunksize is None:
+        return pd.concat(chunks, ignore_index=True)
+    return chunks
+
+def compact_chart_events(chart_events):
+    # chart_events with the columns of CHART_EVENT_DTYPES in those dtypes
+    dtypes = {col: dtype for col, dtype in CHART_EVENT_DTYPES.items()
+              if col in chart_events.columns and chart_events[col].dtype != dtype}
+    return chart_events.astype(dtypes) if dtypes else chart_events
+
+def frame_mb(chart_events):
+    return chart_events.memory_usage(deep=True).sum() / 1e6
+
+def record_frame(chart_events):
+    # rows and size of chart_events at the end of a section, added to the section's stage when tracing
+    if instrumentation.enabled():
+        instrumentation.annotate(rows=len(chart_events), frame_mb=frame_mb(chart_events))
+
+def read_chart_event_columns(path, chunksize=None):
+    # Columnar CHARTEVENTS written by data_sampling/datasampler.py: one typed .npy file per column, memory-mapped,
+    # so only the rows of a chunk are read and no dates are parsed (with this config, 28 bytes per row)
+    columns = {col: np.load(os.path.join(path, col + '.npy'), mmap_mode='r') for col in CHART_EVENT_COLS}
+    num_rows = len(columns['row_id'])
+    # the columns read are handed to the frame without another copy
+    if chunksize is None:
+        return pd.DataFrame({col: np.array(column) for col, column in columns.items()}, copy=False)
+    return (pd.DataFrame({col: np.array(column[start:start + chunksize]) for col, column in columns.items()}, copy=False)
+            for start in range(0, num_rows, chunksize))
+
+
+################# I. Drop Empty Rows and Consolidate Data from Other Tables
+
+def clean_chart_events(chart_events, icu_stays, label_change=label_change, itemid_to_category_num=itemid_to_category_num):
     #1. Drop chartevents entry where we don't have a number in value_num or an icustay_id to reference
-    chart_events = chart_events.dropna(subset=['valuenum'])
-    chart_events = chart_events.dropna(subset=['icustay_id'])
+    keep = chart_events['valuenum'].notna() & chart_events['icustay_id'].notna()
 
     #2. Drop chartevents for which we don't have icu_stays data
-    chart_events = chart_events[chart_events['subject_id'].isin(set(icu_stays['subject_id']))]
+    keep &= chart_events['subject_id'].isin(set(icu_stays['subject_id']))
+
+    # the rows and columns kept are copied once
+    chart_events = chart_events.loc[keep.to_numpy(), chart_events.columns != 'hadm_id'].reset_index(drop=True)
+    chart_events = compact_chart_events(chart_events)
 
     #3. Replace any labels referenced in label_change
 
     # print(chart_events.loc[chart_events.itemid == 8549].head(10))
     # print(chart_events.loc[chart_events.itemid == 5820].head(1)) #should NOT be empty
     # print(chart_events.loc[chart_events.row_id == 235308484]) #item should be 8549
-    chart_events['itemid'] = chart_events['itemid'].map(label_change).fillna(chart_events['itemid'])
+    chart_events['itemid'] = chart_events['itemid'].replace(label_change)
     # print(chart_events.loc[chart_events.itemid == 8549].head(10)) #should be empty
     # print(chart_events.loc[chart_events.itemid == 5820].head(1)) #should NOT be empty, should have 5820
     # print(chart_events.loc[chart_events.row_id == 235308484]) #itemid should be 220045
 
 
     #4. Add category_num for later category sorting
-    chart_events['category_num'] = chart_events['itemid'].map(itemid_to_category_num)
+    chart_events['category_num'] = chart_events['itemid'].map(itemid_to_category_num).fillna(UNCATEGORIZED).astype(np.int8)
     # print(chart_events.loc[chart_events.itemid == 51]['category_num']) #should all be category_num of 3
 
-    ################ II. Clean Data of Excluded Patients and Label Readmission Decision
+    return chart_events
+
+
+################ II. Clean Data of Excluded Patients and Label Readmission Decision
+
+def first_chart_events(chart_events):
+    # earliest chart event (subject_id, charttime) of every patient, from one grouped min over the events
+    return chart_events.groupby('subject_id', as_index=False)['charttime'].min()
 
-    ### A. Finding those below age 18 
+def find_under_eighteen(first_events, patients):
+    ### A. Finding those below age 18
 
-    #1. Find earliest chart event for every patient in chartevents
-    unique_chart_event_patients = chart_events.sort_values(by=['charttime']).drop_duplicates(subset='subject_id', keep='first')
+    #1. Earliest chart event for every patient in chartevents is given by first_chart_events
     #2. Add patients information (crucially, dob) to the less_than_eighteen df
-    less_than_eighteen = unique_chart_event_patients.merge(patients, left_on='subject_id', right_on='subject_id')
+    less_than_eighteen = first_events.merge(patients[['subject_id', 'dob']], left_on='subject_id', right_on='subject_id')
     #3. Calculate age col using calculate_age function
     #less_than_eighteen['age'] = less_than_eighteen.apply(lambda row: calculate_age(row['dob'], row['charttime']), axis=1) #event.year - born.year - ((event.month, event.day) < (born.month, born.day))
-    # below prevents int64 overflow, confirmed to same result as apply example above, just a quicker calculation
-    less_than_eighteen['age'] = ((less_than_eighteen['charttime'].values  - less_than_eighteen['dob'].values).astype(np.int64)/8.64e13//365).astype(np.int64) 
+    # below prevents int64 overflow, confirmed to same result as apply example above, just a quicker calculation.
+    # times are taken in seconds, as pandas may parse them to ns or us depending on the version
+    charttime_s = less_than_eighteen['charttime'].values.astype('datetime64[s]')
+    dob_s = less_than_eighteen['dob'].values.astype('datetime64[s]')
+    less_than_eighteen['age'] = ((charttime_s - dob_s).astype(np.int64)/86400//365).astype(np.int64)
     #print(less_than_eighteen['age'].head(20))
     #4. Create series with list of pids for patients less than 18 years old
-    less_than_eighteen = less_than_eighteen[less_than_eighteen.age < 18]['subject_id'].to_list()
-
+    return less_than_eighteen[less_than_eighteen.age < 18]['subject_id'].to_list()
 
+def find_deaths(icu_stays, patients):
     ### B. Find those who die in ICU and those who die w/in 30 days
 
     #1. Merge icu_stays with patients and calculate time_diff
-    thirty_day_dead_pos = icu_stays.merge(patients, left_on='subject_id', right_on='subject_id')
+    thirty_day_dead_pos = icu_stays[['subject_id', 'icustay_id', 'outtime']].merge(patients[['subject_id', 'dod']], left_on='subject_id', right_on='subject_id')
     thirty_day_dead_pos['time_diff'] = thirty_day_dead_pos['dod'] - thirty_day_dead_pos["outtime"]
 
     #2. First find all that died in icu for later removal. be sure to also remove from thirty_day_dead_pos before next step
@@ -158,112 +204,117 @@ if __name__ == '__main__':
     #3. Then find all who died within 30 days of discharge
     thirty_day_dead_pos = thirty_day_dead_pos[thirty_day_dead_pos.time_diff <= datetime.timedelta(30)]['icustay_id'].to_list()
 
+    return died_in_icu, thirty_day_dead_pos
+
+def find_returned_in_thirty(icu_stays):
     ### C. Find patients with multiple stays w/in 30 days
 
-    #1. Create df with only duplicate visits for the same subject_id
-    multi_icu = icu_stays[icu_stays.duplicated(subset='subject_id', keep=False)].reset_index()
+    #1. Sort every patient's stays by outtime, so the stays of a patient are sequential
+    stays = icu_stays[['subject_id', 'icustay_id', 'intime', 'outtime']].sort_values(['subject_id', 'outtime'])
 
-    #2. Sort by outtime to ensure when we pull from groupby that visits are sequential. don't need pid sort, groupby will handle
-    multi_icu = multi_icu.sort_values(['outtime'])
+    #2. Put the intime of every patient's next stay next to the outtime of the stay before. The last stay of a patient
+    # (and the only stay of patients with one stay) has no next stay and gets NaT
+    next_intime = stays.groupby('subject_id')['intime'].shift(-1)
 
-    pos_returned_in_thirty = [] #list of icustay_ids
+    #3. Find the days between leaving and returning the icu, compared by date. If one stay is less than 30 days before
+    # another stay, the earlier stay required readmission and is positive
+    diff = next_intime.dt.normalize() - stays['outtime'].dt.normalize()
+    return stays.loc[diff < datetime.timedelta(30), 'icustay_id'].to_list()
 
-    #3. Find the time between leaving and returning the icu for the stays for each patient with mult stays
-    for pid, group in multi_icu.groupby('subject_id'):
-        intimes = pd.to_datetime(group['intime']).dt.date.unique().tolist()
-        outtimes = pd.to_datetime(group['outtime']).dt.date.unique().tolist()
-        icu_stay_ids = group['icustay_id'].tolist()[:-1] #if one stay is 30 hours before another stay, the earlier stay required readmission and is positive
-        assert len(icu_stay_ids) == len(intimes[1:])
-        diff = np.subtract(intimes[1:], outtimes[:-1])
-        if any(x < datetime.timedelta(30) for x in diff):
-            for index, x in enumerate(diff):
-                if x < datetime.timedelta(30): pos_returned_in_thirty.append(icu_stay_ids[index])
+def find_exclusions(first_events, icu_stays, patients):
+    # first_events holds the earliest chart event (subject_id, charttime) of every patient, see first_chart_events.
+    # Returns the subject_ids to remove and the icustay_ids with a positive readmission label
+    less_than_eighteen = find_under_eighteen(first_events, patients)
+    died_in_icu, thirty_day_dead_pos = find_deaths(icu_stays, patients)
+    pos_returned_in_thirty = find_returned_in_thirty(icu_stays)
 
     ### D. Remove as appropriate and add readmission label
     remove = died_in_icu + less_than_eighteen
     pos = pos_returned_in_thirty + thirty_day_dead_pos
 
-    chart_events = chart_events[~chart_events['subject_id'].isin(remove)]
-    chart_events['readmit_label'] = chart_events['icustay_id'].isin(pos).astype(int)
-    print("after removing dead or young: ", len(chart_events['icustay_id'].unique()))
+    return remove, pos
+
+def label_chart_events(chart_events, remove, pos):
+    chart_events = chart_events[~chart_events['subject_id'].isin(remove)].reset_index(drop=True)
+    chart_events['readmit_label'] = chart_events['icustay_id'].isin(pos).astype(np.int8)
+    return chart_events
+
 
-    ############### III. Normalize event value as standard deviation from mean on a per-event_label basis
+############### III. Normalize event value as standard deviation from mean on a per-event_label basis
 
-    # 1. Calculate average and std by itemid
-    chart_events['event_label_mean'] = chart_events.groupby('itemid')['valuenum'].transform('mean')
-    chart_events['event_label_std'] = chart_events.groupby('itemid')['valuenum'].transform('std')
+def normalize_chart_events(chart_events, event_label_stats):
+    # event_label_stats holds the 'mean' and 'std' of valuenum of every itemid
 
-    # 2. norm to zero mean and scaled to std. Drop unnecessary columns
-    chart_events['event_label_norm'] = (chart_events['valuenum'] - chart_events['event_label_mean']) / chart_events['event_label_std']
-    chart_events = chart_events.drop(columns=['event_label_mean', 'event_label_std'])
+    # norm to zero mean and scaled to std
+    event_label_mean = chart_events['itemid'].map(event_label_stats['mean'])
+    event_label_std = chart_events['itemid'].map(event_label_stats['std'])
+    chart_events['event_label_norm'] = ((chart_events['valuenum'] - event_label_mean) / event_label_std).astype(np.float32)
+    return chart_events
 
-    ################ IV. Chunk by hours before the last chart event
 
-    # 1. Get the last event for each patient and add as column to chart_events
-    latest_events = chart_events[['subject_id', 'icustay_id', 'charttime']].sort_values(['charttime']).drop_duplicates(subset='icustay_id', keep='last').rename(columns={'charttime': 'latest_time'})
-    chart_events = chart_events.merge(latest_events[['icustay_id', 'latest_time']], left_on='icustay_id', right_on='icustay_id')
+################ IV. Chunk by hours before the last chart event
+
+def window_chart_events(chart_events):
+    # 1. Get the time of the last event of every stay, for every event
+    latest_time = chart_events.groupby('icustay_id')['charttime'].transform('max')
 
     # 2. Get the number of hours from the end of the icustay per patient
-    chart_events['hours_from_end'] = (chart_events['latest_time'] - chart_events['charttime']).dt.total_seconds() // 3600
+    hours_from_end = (latest_time - chart_events['charttime']).dt.total_seconds() // 3600
+
+    # 3. Drop all events outside of 48 hours. The hours left fit the int16 of hours_from_end
+    in_window = (hours_from_end < 48).to_numpy()
+    chart_events = chart_events[in_window].assign(hours_from_end=hours_from_end[in_window].astype(np.int16))
+    chart_events = chart_events.sort_values(['icustay_id', 'hours_from_end', 'category_num'], ignore_index=True)
+    return chart_events
+
 
-    # 3. Drop all events outside of 48 hours
-    chart_events = chart_events[chart_events['hours_from_end'] < 48].sort_values(['icustay_id', 'hours_from_end', 'category_num'])
+################ V. Pad patients with less than 48 hours of data
 
+def pad_last_hour(last_hour_data):
+    # Repeats the last-hour events of every stay once for each following hour up to hour 47, for all stays at once.
+    # The copies get hours_from_end -1 and keep the row_id of the event they copy until the caller assigns new ones
+    num_copies = (47 - last_hour_data['hours_from_beginning']).astype(np.int64).to_numpy()
+    rows = np.repeat(np.arange(len(last_hour_data)), num_copies)
+    copy_numbers = np.arange(len(rows)) - np.repeat(np.cumsum(num_copies) - num_copies, num_copies) + 1
 
-    ################ V. Pad patients with less than 48 hours of data
+    padding = last_hour_data.iloc[rows].reset_index(drop=True)
+    padding['hours_from_beginning'] = (padding['hours_from_beginning'] + copy_numbers).astype(np.int16)
+    padding['hours_from_end'] = np.full(len(padding), -1, dtype=np.int16)
+    return padding
+
+def pad_chart_events(chart_events, first_row_id):
+    # the copies get new row_ids counting up from first_row_id
 
     ### A. Find patients with less than 48 hours of data
 
     # 1. Add hours_from_beginning to this new subset of events ocurring in the last 48 hours. For some events, not all hours will be represented,
     # but these hours are about to be padded.
-    chart_events['max_hours_from_end'] = chart_events.groupby('icustay_id')['hours_from_end'].transform('max')
-    chart_events['hours_from_beginning'] = chart_events['max_hours_from_end'] - chart_events['hours_from_end']
-    chart_events = chart_events.drop(columns=['max_hours_from_end'])
+    max_hours_from_end = chart_events.groupby('icustay_id')['hours_from_end'].transform('max')
+    chart_events['hours_from_beginning'] = (max_hours_from_end - chart_events['hours_from_end']).astype(np.int16)
 
     # 2. Get patients with at least one occurrence of 47
     full_time_stays = chart_events.loc[chart_events['hours_from_end'] == 47]['icustay_id'].unique()
 
     # 3. Get patients who aren't in the above list and find their max hours from beginning
     stays_to_expand = chart_events[~chart_events['icustay_id'].isin(full_time_stays)]
-    print(len(stays_to_expand['icustay_id'].unique()))
-    #the following line takes only the events that occur when hours from end is 0, aka from the last hour, and then groups them by icustay_id
-    last_stays_to_expand = stays_to_expand.loc[stays_to_expand.hours_from_end == 0].groupby('icustay_id')
-    print(last_stays_to_expand.ngroups)
-    print('adding duplicated hour...')
-    print("length of chart_events before adding duplicates: ", len(chart_events))
-    # 4. Add data on patient by patient basis
-    max_row_id = chart_events['row_id'].max()
-    #print(max_row_id)
-    
-    pool = mp.Pool(10) #for Karl's computer
-    
-    results = []
-    for result in tqdm(pool.imap_unordered(process_icustay, (data for icustay_id, data in last_stays_to_expand), chunksize=10), total=len(last_stays_to_expand)):
-        chart_events = pd.concat([chart_events, result], ignore_index=True)
-    pool.close()
-    pool.join()
-    
+    #the following line takes only the events that occur when hours from end is 0, aka from the last hour
+    last_stays_to_expand = stays_to_expand.loc[stays_to_expand.hours_from_end == 0]
 
-    print('done adding duplicated hour!')
-    print("this is the number of stays with something at 47 hours from beginning. it should be 7331!", len(chart_events.loc[chart_events.hours_from_beginning == 47]['icustay_id'].unique()))
-    print("this is the length of chart_events. it should be more than before!", len(chart_events))
+    # 4. Add the copies of all stays in one step
+    padding = pad_last_hour(last_stays_to_expand)
+    padding['row_id'] = np.arange(first_row_id, first_row_id + len(padding), dtype=np.int32)
+    chart_events = pd.concat([chart_events, padding], ignore_index=True)
 
-    print(chart_events['readmit_label'].sum()) #confirm ratio positive to total
-    print(chart_events.shape) # confirm ratio positive to total
+    return chart_events.sort_values(['icustay_id', 'hours_from_beginning', 'category_num'], ignore_index=True)
 
-    chart_events = chart_events.sort_values(['icustay_id', 'hours_from_beginning', 'category_num'])
 
-    with open('chart_events_df.pickle', 'wb') as f:
-        pickle.dump(chart_events, f)
+############### VI. Collect ICD-9 data as sparse per-icustay lists of code indices
 
-    ############### VI. Collect ICD-9 data and one-hot encode it on a per-icustay basis
-
-    #create dict of unique icd9 codes with arbitrary labels
-    unique_icd9s = dict((code, num) for num, code in enumerate(set(icd_9['icd9_code'].values)))
+def write_icd9_codes(icd_9, icu_stays, icustay_ids):
+    # icustay_ids are the sorted ids of the stays in the chart events
 
     #add col of icustay_id to icd_9
     icd_9 = icd_9.merge(icu_stays[['hadm_id', 'icustay_id']], left_on='hadm_id', right_on='hadm_id')
-    icd_9['icd_label'] = icd_9['icd9_code'].map(unique_icd9s)
 
     #check if icd_9's icustay_ids are in chart_events and vice versa
     #if icd9's ids not in chart_events, drop
@@ -276,29 +327,252 @@ if __name__ == '__main__':
     # print('ce not idc9:\n', ce_not_icd9)
     # print('in both: ', in_both)
 
-    icd9_in_ce = icd_9.loc[icd_9['icustay_id'].isin(chart_events['icustay_id'])]
-
-    one_hot = icd9_in_ce.sort_values('icustay_id').groupby('icustay_id')['icd9_code'].apply(list).reset_index().set_index('icustay_id')
+    icd9_in_ce = icd_9.loc[icd_9['icustay_id'].isin(icustay_ids)]
+
+    #1. Create the vocabulary of codes. Sorted, so a code's index is the column it had in the former one-hot encoding
+    icd9_vocab = sorted(icd9_in_ce['icd9_code'].dropna().unique())
+
+    #2. Replace codes by their vocabulary index and keep each code once per stay, sorted by stay and index
+    icd9_per_icustay = pd.DataFrame({'icustay_id': icd9_in_ce['icustay_id'].values,
+                                     'code': pd.Categorical(icd9_in_ce['icd9_code'], categories=icd9_vocab).codes})
+    icd9_per_icustay = icd9_per_icustay[icd9_per_icustay['code'] >= 0].drop_duplicates().sort_values(['icustay_id', 'code'])
+
+    #3. Offsets of every stay into the code indices (CSR layout): the codes of stay i are indices[offsets[i]:offsets[i + 1]]
+    codes_per_icustay = icd9_per_icustay.groupby('icustay_id').size()
+    icd9_offsets = np.zeros(len(codes_per_icustay) + 1, dtype=np.int64)
+    np.cumsum(codes_per_icustay.values, out=icd9_offsets[1:])
+
+    #assert that the sorted icustay values with codes are exactly the same as the sorted list from chart_events
+    assert len(codes_per_icustay) == len(icustay_ids)
+    assert codes_per_icustay.index.tolist() == list(icustay_ids)
+
+    save_icd9_codes(icd9_per_icustay['code'].to_numpy(dtype=np.int32), icd9_offsets, icd9_vocab)
+
+def save_icd9_codes(indices, offsets, vocab):
+    # the code store read by CodeStore in source/dataloader.py
+    os.makedirs('icd9', exist_ok=True)
+    np.save('icd9/indices.npy', indices)
+    np.save('icd9/offsets.npy', offsets)
+    with open('icd9/vocab.json', 'w') as f:
+        json.dump([str(code) for code in vocab], f)
+
+
+############### Streaming mode
+# CHARTEVENTS.csv is read in chunks of chunk_size rows, and at most one chunk or one partition of
+# stays_per_partition stays is held in memory at a time:
+#   1. every chunk is cleaned (section I) and its rows are appended to the partition of their icustay_id. Partitions
+#      are ranges of icustay_ids, so the stays are in sorted order partition after partition. On the way, the first
+#      chart event of every patient, the largest row_id and the count, mean and sum of squared deviations (m2) of
+#      valuenum per (subject_id, itemid) are accumulated
+#   2. exclusions and labels are found from the small tables (section II) and the per-itemid normalization
+#      statistics are combined from the moments of the patients that are kept (section III)
+#   3. every partition is labelled, normalized, windowed and padded on its own (sections II-V) and written to
+#      chart_events_df/part-NNNNN.pickle, which events_to_list.py reads one after another
+
+def chunk_moments(chart_events):
+    moments = chart_events.groupby(['subject_id', 'itemid'])['valuenum'].agg(['count', 'mean', 'var']).reset_index()
+    moments['m2'] = (moments['var'] * (moments['count'] - 1)).fillna(0)
+    return moments.drop(columns=['var'])
+
+def combine_moments(moments, keys):
+    # Combines the (count, mean, m2) rows of equal keys into one row per key: the combined m2 is the sum of the
+    # rows' m2 plus every row's count times the squared distance of its mean to the combined mean
+    moments = moments.assign(total=moments['count'] * moments['mean'])
+    grouped = moments.groupby(keys)
+    count = grouped['count'].transform('sum')
+    mean = grouped['total'].transform('sum') / count
+    moments['m2'] = moments['m2'] + moments['count'] * (moments['mean'] - mean) ** 2
+    moments['count'] = count
+    moments['mean'] = mean
+    return moments.groupby(keys, as_index=False).agg(count=('count', 'first'), mean=('mean', 'first'), m2=('m2', 'sum'))
+
+def append_frame(path, frame):
+    with open(path, 'ab') as f:
+        pickle.dump(frame, f)
+
+def read_frames(path):
+    frames = []
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                frames.append(pickle.load(f))
+            except EOFError:
+                return pd.concat(frames, ignore_index=True)
+
+def preprocess_streaming(mimic_path, icu_stays, patients, chunk_size, stays_per_partition):
+    # Returns the sorted icustay_ids and the readmission label of every stay written out, and the normalization
+    # statistics
+    for path in glob.glob('chart_events_raw/part-*.pickle') + glob.glob('chart_events_df/part-*.pickle'):
+        os.remove(path)
+    os.makedirs('chart_events_raw', exist_ok=True)
+    os.makedirs('chart_events_df', exist_ok=True)
+
+    # first icustay_id of every partition
+    partition_starts = np.sort(icu_stays['icustay_id'].unique())[::stays_per_partition]
+
+    first_events = []
+    moments = None
+    max_row_id = 0
+
+    ### 1. Clean every chunk and split it into partitions
+    for i, chunk in enumerate(read_chart_events(mimic_path, chunksize=chunk_size)):
+        chunk = clean_chart_events(chunk, icu_stays)
+        print('chunk {}: {} events'.format(i, len(chunk)))
+        if len(chunk) == 0:
+            continue
+
+        first_events = [first_chart_events(pd.concat(first_events + [first_chart_events(chunk)]))]
+        moments = chunk_moments(chunk) if moments is None else combine_moments(pd.concat([moments, chunk_moments(chunk)]), ['subject_id', 'itemid'])
+        max_row_id = max(max_row_id, chunk['row_id'].max())
+
+        partitions = np.searchsorted(partition_starts, chunk['icustay_id'].to_numpy(), side='right') - 1
+        for p, part in chunk.groupby(np.maximum(partitions, 0)):
+            append_frame('chart_events_raw/part-{:05d}.pickle'.format(p), part)
+
+    ### 2. Exclusions, labels and normalization statistics of the kept patients
+    remove, pos = find_exclusions(first_events[0], icu_stays, patients)
+    moments = combine_moments(moments[~moments['subject_id'].isin(remove)], ['itemid'])
+    event_label_stats = pd.DataFrame({'mean': moments['mean'].to_numpy(),
+                                      'std': np.sqrt(moments['m2'] / (moments['count'] - 1)).to_numpy()},
+                                     index=moments['itemid'])
+
+    ### 3. Process every partition on its own
+    icustay_ids, readmit_labels = [], []
+    next_row_id = max_row_id + 1
+    for p in range(len(partition_starts)):
+        raw_path = 'chart_events_raw/part-{:05d}.pickle'.format(p)
+        if not os.path.isfile(raw_path):
+            continue
+        chart_events = label_chart_events(read_frames(raw_path), remove, pos)
+        os.remove(raw_path)
+        if len(chart_events) == 0:
+            continue
+
+        chart_events = normalize_chart_events(chart_events, event_label_stats)
+        chart_events = window_chart_events(chart_events)
+        num_events = len(chart_events)
+        chart_events = pad_chart_events(chart_events, next_row_id)
+        next_row_id += len(chart_events) - num_events
+
+        stay_labels = chart_events.drop_duplicates(subset='icustay_id')
+        icustay_ids.extend(stay_labels['icustay_id'].to_list())
+        readmit_labels.extend(stay_labels['readmit_label'].to_list())
+
+        with open('chart_events_df/part-{:05d}.pickle'.format(p), 'wb') as f:
+            pickle.dump(chart_events, f)
+        print('partition {}/{}: {} stays'.format(p + 1, len(partition_starts), len(stay_labels)))
+
+    os.rmdir('chart_events_raw')
+    return icustay_ids, readmit_labels, event_label_stats
+
+
+############### Preprocessing of new stays
+# The statistics and mappings new stays must be preprocessed with to be scored by a model trained on this data
+# (see score.py), saved to preprocessing.pickle and from there into the model checkpoints
+
+def preprocessing_config(event_label_stats):
+    return {'event_label_stats': {'itemid': event_label_stats.index.to_list(),
+                                  'mean': event_label_stats['mean'].to_list(),
+                                  'std': event_label_stats['std'].to_list()},
+            'label_change': dict(label_change),
+            'itemid_to_category_num': dict(itemid_to_category_num)}
+
+def event_label_stats_frame(config):
+    stats = config['event_label_stats']
+    return pd.DataFrame({'mean': stats['mean'], 'std': stats['std']}, index=stats['itemid'])
 
-    #print(one_hot.head(10))
 
-    mlb = MultiLabelBinarizer()
-
-    res = pd.DataFrame(mlb.fit_transform(one_hot['icd9_code']),
-                    columns=mlb.classes_,
-                    index=one_hot.index)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mimic-path', default='mimic3_subset/')
+    parser.add_argument('--stream', action='store_true',
+                        help='process CHARTEVENTS.csv out of core, in chunks of rows and partitions of stays')
+    parser.add_argument('--chunk-size', type=int, default=5_000_000,
+                        help='rows of CHARTEVENTS.csv read at a time in streaming mode')
+    parser.add_argument('--stays-per-partition', type=int, default=2_000,
+                        help='stays processed at a time in streaming mode')
+    parser.add_argument('--trace', help='json file to write the time and memory of every section to')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='also trace Python allocations with tracemalloc, which slows preprocessing down')
+    args = parser.parse_args()
 
-    #print(res.transpose().head(10))
+    start_time = time.monotonic()
+    if args.trace is not None:
+        instrumentation.enable(memory=args.trace_memory)
+    stage = instrumentation.stage
 
-    dict_test = res.transpose().to_dict(orient='list')
-    #print(dict_test)
+    mimic_path = args.mimic_path
 
-    #assert that the sorted icustay values in the dictionary are exactly the same as the sorted list from chart_events
-    assert len(dict_test) == len(chart_events['icustay_id'].unique())
-    assert list(dict_test.keys()) == chart_events['icustay_id'].unique().tolist()
+    with stage('preprocess_mp.read_tables'):
+        icu_stays = pd.read_csv(mimic_path + 'ICUSTAYS.csv', header=0, parse_dates=['intime', 'outtime'])
+        patients = pd.read_csv(mimic_path + 'PATIENTS.csv', header=0, parse_dates=['dob', 'dod', 'dod_hosp', 'dod_ssn'])
+        # the codes are strings such as '0389' and 'V053', the keys of the vocabulary write_icd9_codes builds
+        icd_9 = pd.read_csv(mimic_path + 'DIAGNOSES_ICD.csv', header=0, dtype={'icd9_code': str})
+    #d_items = pd.read_csv(mimic_path + 'D_ITEMS.csv', header=0)
 
-    with open('icd9_per_icustay.pickle', 'wb') as f:
-        pickle.dump(list(dict_test.values()), f)
+    if args.stream:
+        # peak memory is set by --chunk-size and --stays-per-partition instead of the size of CHARTEVENTS.csv
+        with stage('preprocess_mp.stream'):
+            icustay_ids, readmit_labels, event_label_stats = preprocess_streaming(mimic_path, icu_stays, patients, args.chunk_size, args.stays_per_partition)
+        print("stays after removing dead or young and windowing: ", len(icustay_ids))
+    else:
+        with stage('preprocess_mp.read_chart_events'):
+            chart_events = read_chart_events(mimic_path)
+            record_frame(chart_events)
+
+        ################# I. Drop Empty Rows and Consolidate Data from Other Tables
+        with stage('preprocess_mp.I_clean'):
+            chart_events = clean_chart_events(chart_events, icu_stays)
+            record_frame(chart_events)
+
+        ################ II. Clean Data of Excluded Patients and Label Readmission Decision
+
+        with stage('preprocess_mp.II_label'):
+            remove, pos = find_exclusions(first_chart_events(chart_events), icu_stays, patients)
+
+            chart_events = label_chart_events(chart_events, remove, pos)
+            record_frame(chart_events)
+        print("after removing dead or young: ", len(chart_events['icustay_id'].unique()))
+
+        ############### III. Normalize event value as standard deviation from mean on a per-event_label basis
+
+        with stage('preprocess_mp.III_normalize'):
+            # Calculate average and std by itemid
+            event_label_stats = chart_events.groupby('itemid')['valuenum'].agg(['mean', 'std'])
+            chart_events = normalize_chart_events(chart_events, event_label_stats)
+            record_frame(chart_events)
+
+        ################ IV. Chunk by hours before the last chart event
+        with stage('preprocess_mp.IV_window'):
+            chart_events = window_chart_events(chart_events)
+            record_frame(chart_events)
+
+        ################ V. Pad patients with less than 48 hours of data
+        print('adding duplicated hour...')
+        print("length of chart_events before adding duplicates: ", len(chart_events))
+        with stage('preprocess_mp.V_pad'):
+            # new row_ids follow the largest existing one
+            chart_events = pad_chart_events(chart_events, chart_events['row_id'].max() + 1)
+            record_frame(chart_events)
+
+        print('done adding duplicated hour!')
+        print("this is the number of stays with something at 47 hours from beginning. it should be 7331!", len(chart_events.loc[chart_events.hours_from_beginning == 47]['icustay_id'].unique()))
+        print("this is the length of chart_events. it should be more than before!", len(chart_events))
+
+        print(chart_events['readmit_label'].sum()) #confirm ratio positive to total
+        print(chart_events.shape) # confirm ratio positive to total
+
+        with stage('preprocess_mp.write_chart_events'):
+            with open('chart_events_df.pickle', 'wb') as f:
+                pickle.dump(chart_events, f)
+
+        stay_labels = chart_events.drop_duplicates(subset='icustay_id')
+        icustay_ids = stay_labels['icustay_id'].to_list()
+        readmit_labels = stay_labels['readmit_label'].to_list()
+
+    ############### VI. Collect ICD-9 data as sparse per-icustay lists of code indices
+    with stage('preprocess_mp.VI_icd9'):
+        write_icd9_codes(icd_9, icu_stays, icustay_ids)
 
     del icd_9
     del icu_stays
@@ -306,25 +580,37 @@ if __name__ == '__main__':
 
     ############### VII. Create lists of pids, evids and events
 
-    # 1. Create pids, evids, and readmit_label pickles
+    # 1. Create pids, evids, and readmit_label pickles. readmit_labels holds one label per stay, in the order of the
+    # stays in the event store. The per-event pids and evids grow with the data and aren't written in streaming mode
 
-    with open('icu_stays.pickle', 'wb') as f:
-        pickle.dump(chart_events['icustay_id'].to_list(), f)
+    with stage('preprocess_mp.VII_write'):
+        if not args.stream:
+            # the frame is freed before the lists of Python ints are built
+            pids, evids = chart_events['icustay_id'].to_numpy(), chart_events['row_id'].to_numpy()
+            del chart_events, stay_labels
 
-    with open('evids.pickle', 'wb') as f:
-        pickle.dump(chart_events['row_id'].to_list(), f)
+            with open('icu_stays.pickle', 'wb') as f:
+                pickle.dump(pids.tolist(), f)
 
-    with open('readmit_labels.pickle', 'wb') as f:
-        pickle.dump(chart_events['readmit_label'].to_list(), f)
+            with open('evids.pickle', 'wb') as f:
+                pickle.dump(evids.tolist(), f)
 
-    # 2. Create categories pickle
-    with open('categories.pickle', 'wb') as f:
-        pickle.dump(category_dict, f)
+        with open('readmit_labels.pickle', 'wb') as f:
+            pickle.dump(readmit_labels, f)
 
-    # 3. Create events pickle using events_to_list
+        # 2. Create categories pickle
+        with open('categories.pickle', 'wb') as f:
+            pickle.dump(category_dict, f)
+
+        # 3. Save the normalization statistics and label mappings, to preprocess new stays the same way
+        with open('preprocessing.pickle', 'wb') as f:
+            pickle.dump(preprocessing_config(event_label_stats), f)
+
+    # 4. Create events pickle using events_to_list
     # conduct this using events_to_list.py to avoid memory issues
 
     end_time = time.monotonic()
     print(datetime.timedelta(seconds=end_time - start_time))
-
-
+    if args.trace is not None:
+        print(instrumentation.summary())
+        instrumentation.save(args.trace)
@@ -0,0 +1,345 @@
+import warnings
+warnings.simplefilter(action='ignore', category=FutureWarning)
+
+import duckdb
+import numpy as np
+import pandas as pd
+import argparse
+import datetime
+import os
+import pickle
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'source'))
+import instrumentation
+from preprocess_mp import (CHART_EVENT_COLS, UNCATEGORIZED, category_dict, itemid_to_category_num,
+                           label_change, preprocessing_config, save_icd9_codes)
+
+# Sections I-VI of preprocess_mp.py as queries on DuckDB, an in-process SQL engine: CHARTEVENTS is scanned once, in
+# parallel and with the filters of section I pushed into the scan, and the sections after it are joins and grouped
+# aggregates the engine runs without materializing every step. Tables with one row per event are only built for the
+# cleaned events of section I and the windowed events of section IV. They are kept compressed in a scratch database
+# file, which is removed at the end, and the engine spills its joins and sorts to disk past --memory-limit.
+# The outputs are the same files preprocess_mp.py writes, in the same order and dtypes, for events_to_list.py to read.
+#
+# Usage:
+#   python3 preprocess_sql.py --mimic-path mimic3_subset/
+#   python3 preprocess_sql.py --mimic-path mimic3_subset/ --memory-limit 4GB --threads 8
+
+# column types of the tables read with the engine's CSV reader, as preprocess_mp.py parses them
+CHART_EVENT_TYPES = {'row_id': 'INTEGER', 'subject_id': 'INTEGER', 'hadm_id': 'INTEGER', 'icustay_id': 'INTEGER',
+                     'itemid': 'INTEGER', 'charttime': 'TIMESTAMP', 'valuenum': 'FLOAT'}
+ICU_STAY_TYPES = {'subject_id': 'INTEGER', 'hadm_id': 'INTEGER', 'icustay_id': 'INTEGER', 'intime': 'TIMESTAMP',
+                  'outtime': 'TIMESTAMP'}
+PATIENT_TYPES = {'subject_id': 'INTEGER', 'dob': 'TIMESTAMP', 'dod': 'TIMESTAMP'}
+DIAGNOSIS_TYPES = {'hadm_id': 'INTEGER', 'icd9_code': 'VARCHAR'}
+
+
+def connect(database, memory_limit=None, threads=None, temp_dir=None):
+    con = duckdb.connect(database)
+    if memory_limit is not None:
+        con.execute("SET memory_limit = '{}'".format(memory_limit))
+    if threads is not None:
+        con.execute('SET threads = {}'.format(threads))
+    if temp_dir is not None:
+        con.execute("SET temp_directory = '{}'".format(temp_dir))
+    return con
+
+def read_csv(path, types):
+    # a scan of the columns in types of a CSV file, for a FROM clause
+    return "read_csv('{}', header = true, types = {})".format(path, types)
+
+def count(con, table):
+    return con.execute('SELECT count(*) FROM {}'.format(table)).fetchone()[0]
+
+def record_table(con, table):
+    # rows of table at the end of a section, added to the section's stage when tracing
+    if instrumentation.enabled():
+        instrumentation.annotate(rows=count(con, table))
+
+def register_tables(con, mimic_path):
+    # Views of the small tables and of CHARTEVENTS. The columnar CHARTEVENTS written by data_sampling/datasampler.py
+    # is scanned from its memory-mapped columns, through a frame that holds them without a copy
+    con.execute('CREATE VIEW icu_stays AS SELECT subject_id, hadm_id, icustay_id, intime, outtime FROM {}'.format(
+        read_csv(mimic_path + 'ICUSTAYS.csv', ICU_STAY_TYPES)))
+    con.execute('CREATE VIEW patients AS SELECT subject_id, dob, dod FROM {}'.format(
+        read_csv(mimic_path + 'PATIENTS.csv', PATIENT_TYPES)))
+    con.execute('CREATE VIEW diagnoses AS SELECT hadm_id, icd9_code FROM {}'.format(
+        read_csv(mimic_path + 'DIAGNOSES_ICD.csv', DIAGNOSIS_TYPES)))
+
+    if os.path.isdir(mimic_path + 'CHARTEVENTS'):
+        path = mimic_path + 'CHARTEVENTS'
+        columns = pd.DataFrame({col: np.load(os.path.join(path, col + '.npy'), mmap_mode='r') for col in CHART_EVENT_COLS},
+                               copy=False)
+        con.register('chart_event_columns', columns)
+        con.execute('CREATE VIEW raw_chart_events AS SELECT * FROM chart_event_columns')
+    else:
+        con.execute('CREATE VIEW raw_chart_events AS SELECT * FROM {}'.format(
+            read_csv(mimic_path + 'CHARTEVENTS.csv', CHART_EVENT_TYPES)))
+
+    # the label and category mappings of preprocess_mp.py as one table to join with: the itemid every itemid of
+    # either mapping is replaced by and the category of that one. Other itemids are kept and have no category
+    itemids = sorted(set(label_change) | set(itemid_to_category_num))
+    new_itemids = [label_change.get(itemid, itemid) for itemid in itemids]
+    con.register('item_mapping', pd.DataFrame({
+        'itemid': np.array(itemids, dtype=np.int32), 'new_itemid': np.array(new_itemids, dtype=np.int32),
+        'category_num': np.array([itemid_to_category_num.get(itemid, UNCATEGORIZED) for itemid in new_itemids],
+                                 dtype=np.int8)}))
+
+
+################# I. Drop Empty Rows and Consolidate Data from Other Tables
+
+def clean_chart_events(con):
+    # The events are kept in the order of the file, numbered by pos: preprocess_mp.py sorts them stably, so pos breaks
+    # the ties of its sort keys. The scan with the filter of step 1 keeps that order and is materialized before the
+    # joins, which don't, even the semi join of step 2 once it runs on several threads
+
+    #1. Drop chartevents entry where we don't have a number in value_num or an icustay_id to reference
+    con.execute('''
+        CREATE TABLE kept_chart_events AS
+        SELECT row_id, subject_id, icustay_id, itemid, charttime, valuenum
+        FROM raw_chart_events
+        WHERE valuenum IS NOT NULL AND icustay_id IS NOT NULL''')
+
+    #2. Drop chartevents for which we don't have icu_stays data
+    #3. Replace any labels referenced in label_change
+    #4. Add category_num for later category sorting
+    con.execute('''
+        CREATE TABLE chart_events AS
+        SELECT e.row_id, e.subject_id, e.icustay_id, coalesce(m.new_itemid, e.itemid) AS itemid, e.charttime,
+               e.valuenum, coalesce(m.category_num, {})::TINYINT AS category_num, e.rowid AS pos
+        FROM kept_chart_events e
+        LEFT JOIN item_mapping m ON e.itemid = m.itemid
+        WHERE e.subject_id IN (SELECT subject_id FROM icu_stays)'''.format(UNCATEGORIZED))
+    con.execute('DROP TABLE kept_chart_events')
+
+
+################ II. Clean Data of Excluded Patients and Label Readmission Decision
+
+def find_exclusions(con):
+    # Tables remove, of the subject_ids to remove, and pos, of the icustay_ids with a positive readmission label
+
+    ### A. Finding those below age 18, at their earliest chart event, with the age in whole years of 365 days
+    con.execute('''
+        CREATE TABLE under_eighteen AS
+        SELECT f.subject_id
+        FROM (SELECT subject_id, min(charttime) AS charttime FROM chart_events GROUP BY subject_id) f
+        JOIN patients p ON f.subject_id = p.subject_id
+        WHERE floor((epoch(f.charttime) - epoch(p.dob)) / 86400 / 365) < 18''')
+
+    ### B. Find those who die in ICU and those who die w/in 30 days
+    con.execute('''
+        CREATE TABLE stay_deaths AS
+        SELECT s.subject_id, s.icustay_id, p.dod <= s.outtime AS died_in_icu,
+               p.dod > s.outtime AND p.dod <= s.outtime + INTERVAL 30 DAY AS died_in_thirty
+        FROM icu_stays s JOIN patients p ON s.subject_id = p.subject_id''')
+
+    ### C. Find patients with multiple stays w/in 30 days, comparing the dates of leaving and of the next stay
+    con.execute('''
+        CREATE TABLE returned_in_thirty AS
+        SELECT icustay_id
+        FROM (SELECT icustay_id, outtime,
+                     lead(intime) OVER (PARTITION BY subject_id ORDER BY outtime) AS next_intime
+              FROM icu_stays)
+        WHERE next_intime::DATE - outtime::DATE < 30''')
+
+    ### D. Remove as appropriate and add readmission label
+    con.execute('''
+        CREATE TABLE remove AS
+        SELECT subject_id FROM stay_deaths WHERE died_in_icu
+        UNION SELECT subject_id FROM under_eighteen''')
+    con.execute('''
+        CREATE TABLE pos AS
+        SELECT icustay_id FROM returned_in_thirty
+        UNION SELECT icustay_id FROM stay_deaths WHERE died_in_thirty''')
+
+
+############### III. Normalize event value as standard deviation from mean on a per-event_label basis
+
+def find_event_label_stats(con):
+    # mean and std of valuenum of every itemid over the events of the patients kept, as float32 like the pandas path.
+    # itemids with one event have no std and get NaN
+    return con.execute('''
+        SELECT itemid, avg(valuenum)::FLOAT AS mean, coalesce(stddev_samp(valuenum), 'NaN')::FLOAT AS std
+        FROM chart_events
+        WHERE subject_id NOT IN (SELECT subject_id FROM remove)
+        GROUP BY itemid ORDER BY itemid''').df().set_index('itemid')
+
+
+################ IV. Chunk by hours before the last chart event
+
+def window_chart_events(con):
+    # the events of the patients kept, labelled (II), normalized in float32 (III) and windowed to the 48 hours before
+    # the last event of every stay (IV), in one pass over chart_events
+    con.execute('''
+        CREATE TABLE windowed_chart_events AS
+        SELECT e.row_id, e.subject_id, e.icustay_id, e.itemid, e.charttime, e.valuenum, e.category_num,
+               (e.icustay_id IN (SELECT icustay_id FROM pos))::TINYINT AS readmit_label,
+               (e.valuenum - s.mean) / s.std AS event_label_norm,
+               ((epoch_us(l.latest_time) - epoch_us(e.charttime)) // 3600000000)::SMALLINT AS hours_from_end, e.pos
+        FROM chart_events e
+        JOIN event_label_stats s ON e.itemid = s.itemid
+        JOIN (SELECT icustay_id, max(charttime) AS latest_time FROM chart_events GROUP BY icustay_id) l
+          ON e.icustay_id = l.icustay_id
+        WHERE e.subject_id NOT IN (SELECT subject_id FROM remove)
+          AND epoch_us(l.latest_time) - epoch_us(e.charttime) < 48 * 3600000000''')
+    con.execute('DROP TABLE chart_events')
+
+
+################ V. Pad patients with less than 48 hours of data
+
+def padded_chart_events(con):
+    # The events with their hours_from_beginning and, for stays with less than 48 hours, the events of their last hour
+    # repeated once for every following hour up to hour 47, with hours_from_end -1. The copies get new row_ids
+    # counting up from the largest row_id of the window, in the order preprocess_mp.py adds them in, and all rows are
+    # in the order of chart_events_df.pickle
+    return con.execute('''
+        WITH events AS (
+            SELECT w.*, (max(w.hours_from_end) OVER (PARTITION BY w.icustay_id) - w.hours_from_end)::SMALLINT
+                        AS hours_from_beginning, 0 AS copy
+            FROM windowed_chart_events w),
+        copies AS (
+            SELECT * REPLACE (unnest(generate_series(1, 47 - hours_from_beginning)) AS copy)
+            FROM events
+            WHERE hours_from_end = 0 AND hours_from_beginning < 47),
+        padding AS (
+            SELECT * REPLACE (
+                ((SELECT max(row_id) FROM windowed_chart_events)
+                  + row_number() OVER (ORDER BY icustay_id, category_num, pos, copy))::INTEGER AS row_id,
+                -1::SMALLINT AS hours_from_end, (hours_from_beginning + copy)::SMALLINT AS hours_from_beginning)
+            FROM copies)
+        SELECT row_id, subject_id, icustay_id, itemid, charttime, valuenum, category_num, readmit_label,
+               event_label_norm, hours_from_end, hours_from_beginning
+        FROM (SELECT * FROM events UNION ALL SELECT * FROM padding)
+        ORDER BY icustay_id, hours_from_beginning, category_num, pos, copy''').df()
+
+
+############### VI. Collect ICD-9 data as sparse per-icustay lists of code indices
+
+def write_icd9_codes(con, icustay_ids):
+    # icustay_ids are the sorted ids of the stays in the chart events. The vocabulary is sorted, so a code's index is
+    # the column it had in the former one-hot encoding, and every code is kept once per stay
+    con.register('event_stays', pd.DataFrame({'icustay_id': icustay_ids}))
+    con.execute('''
+        CREATE TABLE stay_codes AS
+        SELECT DISTINCT s.icustay_id, d.icd9_code
+        FROM diagnoses d JOIN icu_stays s ON d.hadm_id = s.hadm_id
+        WHERE s.icustay_id IN (SELECT icustay_id FROM event_stays) AND d.icd9_code IS NOT NULL''')
+    icd9_vocab = [code for code, in con.execute('SELECT DISTINCT icd9_code FROM stay_codes ORDER BY icd9_code').fetchall()]
+    codes = con.execute('''
+        SELECT c.icustay_id, v.code
+        FROM stay_codes c
+        JOIN (SELECT icd9_code, (row_number() OVER (ORDER BY icd9_code) - 1)::INTEGER AS code
+              FROM (SELECT DISTINCT icd9_code FROM stay_codes)) v ON c.icd9_code = v.icd9_code
+        ORDER BY c.icustay_id, v.code''').fetchnumpy()
+
+    # offsets of every stay into the code indices (CSR layout): the codes of stay i are indices[offsets[i]:offsets[i + 1]]
+    stays_with_codes, codes_per_icustay = np.unique(codes['icustay_id'], return_counts=True)
+    icd9_offsets = np.zeros(len(codes_per_icustay) + 1, dtype=np.int64)
+    np.cumsum(codes_per_icustay, out=icd9_offsets[1:])
+
+    #assert that the sorted icustay values with codes are exactly the same as the sorted list from chart_events
+    assert stays_with_codes.tolist() == list(icustay_ids)
+
+    save_icd9_codes(np.asarray(codes['code'], dtype=np.int32), icd9_offsets, icd9_vocab)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mimic-path', default='mimic3_subset/')
+    parser.add_argument('--database', default='preprocess_sql.duckdb',
+                        help="scratch DuckDB database file to build the tables in, or ':memory:' to keep them in memory")
+    parser.add_argument('--memory-limit', help="memory the engine may use before spilling to disk, e.g. '4GB'")
+    parser.add_argument('--threads', type=int, help='threads of the engine, by default one per CPU')
+    parser.add_argument('--temp-dir', help='directory the engine spills to')
+    parser.add_argument('--trace', help='json file to write the time and memory of every section to')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='also trace Python allocations with tracemalloc, which slows preprocessing down')
+    args = parser.parse_args()
+
+    start_time = time.monotonic()
+    if args.trace is not None:
+        instrumentation.enable(memory=args.trace_memory)
+    stage = instrumentation.stage
+
+    # a database left by an interrupted run is started over
+    for path in (args.database, args.database + '.wal'):
+        if args.database != ':memory:' and os.path.isfile(path):
+            os.remove(path)
+    con = connect(args.database, args.memory_limit, args.threads, args.temp_dir)
+    register_tables(con, args.mimic_path)
+
+    ################# I. Drop Empty Rows and Consolidate Data from Other Tables
+    with stage('preprocess_sql.I_clean'):
+        clean_chart_events(con)
+        record_table(con, 'chart_events')
+
+    ################ II. Clean Data of Excluded Patients and Label Readmission Decision
+    with stage('preprocess_sql.II_label'):
+        find_exclusions(con)
+
+    ############### III. Normalize event value as standard deviation from mean on a per-event_label basis
+    with stage('preprocess_sql.III_normalize'):
+        event_label_stats = find_event_label_stats(con)
+        con.register('event_label_stats', event_label_stats.reset_index())
+
+    ################ IV. Chunk by hours before the last chart event
+    with stage('preprocess_sql.IV_window'):
+        window_chart_events(con)
+        record_table(con, 'windowed_chart_events')
+    print("length of chart_events before adding duplicates: ", count(con, 'windowed_chart_events'))
+
+    ################ V. Pad patients with less than 48 hours of data
+    with stage('preprocess_sql.V_pad'):
+        chart_events = padded_chart_events(con)
+        con.execute('DROP TABLE windowed_chart_events')
+        if instrumentation.enabled():
+            instrumentation.annotate(rows=len(chart_events))
+
+    print("stays with something at 47 hours from beginning: ", len(chart_events.loc[chart_events.hours_from_beginning == 47]['icustay_id'].unique()))
+    print("length of chart_events: ", len(chart_events))
+    print(chart_events['readmit_label'].sum()) #confirm ratio positive to total
+
+    with stage('preprocess_sql.write_chart_events'):
+        with open('chart_events_df.pickle', 'wb') as f:
+            pickle.dump(chart_events, f)
+
+    stay_labels = chart_events.drop_duplicates(subset='icustay_id')
+    icustay_ids = stay_labels['icustay_id'].to_list()
+    readmit_labels = stay_labels['readmit_label'].to_list()
+
+    ############### VI. Collect ICD-9 data as sparse per-icustay lists of code indices
+    with stage('preprocess_sql.VI_icd9'):
+        write_icd9_codes(con, icustay_ids)
+    con.close()
+    if args.database != ':memory:':
+        os.remove(args.database)
+
+    ############### VII. Create lists of pids, evids and events
+    with stage('preprocess_sql.VII_write'):
+        pids, evids = chart_events['icustay_id'].to_numpy(), chart_events['row_id'].to_numpy()
+        del chart_events, stay_labels
+
+        with open('icu_stays.pickle', 'wb') as f:
+            pickle.dump(pids.tolist(), f)
+
+        with open('evids.pickle', 'wb') as f:
+            pickle.dump(evids.tolist(), f)
+
+        with open('readmit_labels.pickle', 'wb') as f:
+            pickle.dump(readmit_labels, f)
+
+        with open('categories.pickle', 'wb') as f:
+            pickle.dump(category_dict, f)
+
+        with open('preprocessing.pickle', 'wb') as f:
+            pickle.dump(preprocessing_config(event_label_stats), f)
+
+    # the events pickle is built from chart_events_df.pickle by events_to_list.py, as after preprocess_mp.py
+
+    end_time = time.monotonic()
+    print(datetime.timedelta(seconds=end_time - start_time))
+    if args.trace is not None:
+        print(instrumentation.summary())
+        instrumentation.save(args.trace)
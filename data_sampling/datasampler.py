@@ -1,4 +1,10 @@
+import argparse
+import io
+import json
 import os
+import shutil
+from multiprocessing import Pool
+import numpy as np
 import pandas as pd
 from sklearn.utils.random import sample_without_replacement
 
@@ -11,16 +17,13 @@ SAMPLE_SIZE = 10_000
 MIMIC_III_PATH = './MIMIC III/'
 DATA_SUBSET_PATH = './M3_Subset/'
 
-os.chdir('/') # NOTE Set to correct project directory
+NUM_WORKERS = os.cpu_count()
+BLOCK_SIZE = 64 * 1024 * 1024 # bytes of CHARTEVENTS.csv parsed at a time by every worker
 
-assert os.path.isdir(MIMIC_III_PATH), f"{MIMIC_III_PATH} directory is missing"
-assert os.path.isfile(MIMIC_III_PATH + 'ICUSTAYS.csv'), "ICUSTAYS.csv file is missing"
-assert os.path.isfile(MIMIC_III_PATH + 'CHARTEVENTS.csv'), "CHARTEVENTS.csv file is missing"
-
-if not os.path.isdir(DATA_SUBSET_PATH):
-    os.mkdir(DATA_SUBSET_PATH)
-
-# STEP 1: RANDOMLY SAMPLE INDICES FROM ICUSTAYS
+CHART_EVENT_COLS = ['ROW_ID', 'SUBJECT_ID', 'HADM_ID', 'ICUSTAY_ID', 'ITEMID', 'CHARTTIME', 'VALUENUM']
+# dtypes of the columnar CHARTEVENTS written to the subset. Ids without a value are stored as -1
+CHART_EVENT_DTYPES = {'row_id': np.int32, 'subject_id': np.int32, 'hadm_id': np.int32, 'icustay_id': np.int32,
+                      'itemid': np.int32, 'charttime': 'datetime64[s]', 'valuenum': np.float32}
 
 
 def lower_columns(df):
@@ -31,45 +34,141 @@ def lower_columns(df):
     df.rename(columns=cols_dict, inplace=True)
 
 
-icu_stays = pd.read_csv(MIMIC_III_PATH + 'ICUSTAYS.csv', header=0, parse_dates=['INTIME', 'OUTTIME'])
-lower_columns(icu_stays)
+def line_aligned_ranges(path, num_ranges):
+    # Splits the file after its header line into num_ranges byte ranges of about equal size, each starting at the
+    # beginning of a line. Assumes no quoted field of the csv spans several lines, which holds for CHARTEVENTS.csv
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        f.readline()
+        bounds = [f.tell()]
+        for i in range(1, num_ranges):
+            f.seek(max(bounds[0] + (size - bounds[0]) * i // num_ranges - 1, bounds[-1]))
+            f.readline()
+            bounds.append(f.tell())
+        bounds.append(size)
+
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if start < end]
+
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        return f.readline().decode().strip().split(',')
+
+
+def extract_range(path, header, start, end, icustay_ids, part_path):
+    # Parses the lines of CHARTEVENTS.csv in [start, end) one block at a time, keeps the events of the sampled
+    # icustay_ids and saves them as one typed .npy file per column in part_path. Returns the number of events kept
+    frames = []
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while f.tell() < end:
+            block = f.read(min(BLOCK_SIZE, end - f.tell()))
+            if f.tell() < end:
+                block += f.readline() # complete the last line of the block
+
+            chunk = pd.read_csv(io.BytesIO(block), header=None, names=header, usecols=CHART_EVENT_COLS,
+                                dtype={'CHARTTIME': str})
+            lower_columns(chunk)
+            chunk = chunk.loc[chunk['icustay_id'].isin(icustay_ids)]
+            # dates are only parsed for the events that are kept
+            chunk['charttime'] = pd.to_datetime(chunk['charttime'], format='%Y-%m-%d %H:%M:%S')
+            frames.append(chunk)
+
+    chunk = pd.concat(frames, ignore_index=True)
+    os.makedirs(part_path, exist_ok=True)
+    for col, dtype in CHART_EVENT_DTYPES.items():
+        if np.dtype(dtype).kind == 'i':
+            column = chunk[col].fillna(-1).to_numpy().astype(dtype)
+        else:
+            column = chunk[col].to_numpy().astype(dtype)
+        np.save(os.path.join(part_path, col + '.npy'), column)
 
-subset_idx = sample_without_replacement(icu_stays.shape[0], SAMPLE_SIZE, random_state=RAND_SEED)
+    return len(chunk)
 
-# STEP 2: SUB-SAMPLE ICUSTAYS.CSV
 
-icu_stays = icu_stays.loc[subset_idx]
-icu_stays.to_csv(DATA_SUBSET_PATH + 'ICUSTAYS.csv', mode='w')
+def extract_chart_events(path, out_path, icustay_ids, num_workers=NUM_WORKERS):
+    # Filters CHARTEVENTS.csv on icustay_ids in parallel byte ranges and writes the kept events, in file order, as a
+    # columnar store to out_path: one memory-mappable .npy file per column (see CHART_EVENT_DTYPES) and meta.json
+    # with the columns and number of events. data_cleaning/preprocess_mp.py reads it instead of a CHARTEVENTS.csv
+    header = read_header(path)
+    # a few ranges per worker, so workers that finish early pick up the rest
+    ranges = line_aligned_ranges(path, num_workers * 4)
+    icustay_ids = np.asarray(icustay_ids)
 
-# STEP 3: SUB-SAMPLE CHARTEVENTS.CSV
+    parts_path = out_path + '.parts'
+    tasks = [(path, header, start, end, icustay_ids, os.path.join(parts_path, '{:05d}'.format(i)))
+             for i, (start, end) in enumerate(ranges)]
+    with Pool(num_workers) as pool:
+        num_events = pool.starmap(extract_range, tasks)
 
-CHUNK_SIZE = 10000000
-CHART_EVENT_COLS = ['ROW_ID', 'SUBJECT_ID', 'HADM_ID', 'ICUSTAY_ID', 'ITEMID', 'CHARTTIME', 'VALUENUM']
+    os.makedirs(out_path, exist_ok=True)
+    for col in CHART_EVENT_DTYPES:
+        column = np.concatenate([np.load(os.path.join(task[-1], col + '.npy')) for task in tasks])
+        np.save(os.path.join(out_path, col + '.npy'), column)
+    shutil.rmtree(parts_path)
 
-if os.path.isfile(DATA_SUBSET_PATH + 'CHARTEVENTS.csv'):
-    os.remove(DATA_SUBSET_PATH + 'CHARTEVENTS.csv')
+    with open(os.path.join(out_path, 'meta.json'), 'w') as f:
+        json.dump({'columns': list(CHART_EVENT_DTYPES), 'num_events': sum(num_events)}, f)
 
-with pd.read_csv(MIMIC_III_PATH + 'CHARTEVENTS.csv', usecols=CHART_EVENT_COLS, parse_dates=['CHARTTIME'], chunksize=CHUNK_SIZE) as reader:
-    for i, chunk in enumerate(reader):
-        lower_columns(chunk)
-        chunk = chunk.loc[chunk['icustay_id'].isin(icu_stays['icustay_id'])]
-        header = True if i == 0 else None
+    return sum(num_events)
 
-        chunk.to_csv(DATA_SUBSET_PATH + 'CHARTEVENTS.csv', header=header, mode='a')
 
-# STEP 4: (OPTIONAL) LOWERCASE COLUMNS FOR REMAINING FILES
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--project-dir', default='/', help='directory the MIMIC III and subset paths are relative to')
+    parser.add_argument('--mimic-path', default=MIMIC_III_PATH)
+    parser.add_argument('--subset-path', default=DATA_SUBSET_PATH)
+    parser.add_argument('--sample-size', type=int, default=SAMPLE_SIZE)
+    parser.add_argument('--seed', type=int, default=RAND_SEED)
+    parser.add_argument('--workers', type=int, default=NUM_WORKERS)
+    args = parser.parse_args()
 
-ALL_FILES_LOWER_COLUMNS = True
-OTHER_FILES = ['PATIENTS.csv', 'DIAGNOSES_ICD.csv', 'D_ITEMS.csv']
+    os.chdir(args.project_dir) # NOTE Set to correct project directory
+    MIMIC_III_PATH, DATA_SUBSET_PATH = args.mimic_path, args.subset_path
 
-if ALL_FILES_LOWER_COLUMNS:
-    for filename in OTHER_FILES:
-        df = None
+    assert os.path.isdir(MIMIC_III_PATH), f"{MIMIC_III_PATH} directory is missing"
+    assert os.path.isfile(MIMIC_III_PATH + 'ICUSTAYS.csv'), "ICUSTAYS.csv file is missing"
+    assert os.path.isfile(MIMIC_III_PATH + 'CHARTEVENTS.csv'), "CHARTEVENTS.csv file is missing"
 
-        if filename == 'PATIENTS.csv':
-            df = pd.read_csv(MIMIC_III_PATH + filename, header=0, parse_dates=['DOB', 'DOD', 'DOD_HOSP', 'DOD_SSN'])
-        else:
-            df = pd.read_csv(MIMIC_III_PATH + filename, header=0)
+    if not os.path.isdir(DATA_SUBSET_PATH):
+        os.mkdir(DATA_SUBSET_PATH)
+
+    # STEP 1: RANDOMLY SAMPLE INDICES FROM ICUSTAYS
+
+    icu_stays = pd.read_csv(MIMIC_III_PATH + 'ICUSTAYS.csv', header=0, parse_dates=['INTIME', 'OUTTIME'])
+    lower_columns(icu_stays)
+
+    subset_idx = sample_without_replacement(icu_stays.shape[0], args.sample_size, random_state=args.seed)
+
+    # STEP 2: SUB-SAMPLE ICUSTAYS.CSV
+
+    icu_stays = icu_stays.loc[subset_idx]
+    icu_stays.to_csv(DATA_SUBSET_PATH + 'ICUSTAYS.csv', mode='w', index=False)
+
+    # STEP 3: SUB-SAMPLE CHARTEVENTS.CSV INTO THE COLUMNAR CHARTEVENTS DIRECTORY
+
+    if os.path.isfile(DATA_SUBSET_PATH + 'CHARTEVENTS.csv'):
+        os.remove(DATA_SUBSET_PATH + 'CHARTEVENTS.csv')
+    if os.path.isdir(DATA_SUBSET_PATH + 'CHARTEVENTS'):
+        shutil.rmtree(DATA_SUBSET_PATH + 'CHARTEVENTS')
+
+    num_events = extract_chart_events(MIMIC_III_PATH + 'CHARTEVENTS.csv', DATA_SUBSET_PATH + 'CHARTEVENTS',
+                                      icu_stays['icustay_id'], num_workers=args.workers)
+    print(num_events, 'chart events sampled')
+
+    # STEP 4: (OPTIONAL) LOWERCASE COLUMNS FOR REMAINING FILES
+
+    ALL_FILES_LOWER_COLUMNS = True
+    OTHER_FILES = ['PATIENTS.csv', 'DIAGNOSES_ICD.csv', 'D_ITEMS.csv']
+
+    if ALL_FILES_LOWER_COLUMNS:
+        for filename in OTHER_FILES:
+            df = None
+
+            if filename == 'PATIENTS.csv':
+                df = pd.read_csv(MIMIC_III_PATH + filename, header=0, parse_dates=['DOB', 'DOD', 'DOD_HOSP', 'DOD_SSN'])
+            else:
+                df = pd.read_csv(MIMIC_III_PATH + filename, header=0)
 
-        lower_columns(df)
-        df.to_csv(DATA_SUBSET_PATH + filename, mode='w')
+            lower_columns(df)
+            df.to_csv(DATA_SUBSET_PATH + filename, mode='w', index=False)
@@ -0,0 +1,85 @@
+# Exports a model checkpoint saved by source/training.py (kfold(checkpoint_dir=...)) to a CPU inference artifact,
+# TorchScript or ONNX, optionally with its LSTM and Linear layers quantized dynamically to int8 (see
+# source/inference.py), and checks the artifact against the eager fp32 model on the held-out stays of the checkpoint's
+# fold: the largest difference of their readmission probabilities and the change of the AUROC.
+#
+# The artifact is traced with a batch of the data the model was trained on (--data-dir), which is also where the
+# held-out stays are read from. score.py scores new stays with an artifact given as --exported.
+#
+# Usage:
+#   python3 export.py --checkpoint source/checkpoints/lstm-cnn/fold-1.pt --data-dir data --quantize --out lstm-cnn-int8.pt
+#   python3 export.py --checkpoint source/checkpoints/lstm-cnn/fold-1.pt --data-dir data --format onnx --out lstm-cnn.onnx
+
+import warnings
+warnings.simplefilter(action='ignore', category=FutureWarning)
+
+import argparse
+import os
+import sys
+from functools import partial
+
+import numpy as np
+import torch
+from sklearn.metrics import roc_auc_score
+from torch.utils.data import DataLoader, Subset
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'source'))
+import dataloader
+import inference
+from checkpoint import load_checkpoint
+
+
+def held_out_probabilities(model, dataset, checkpoint, batch_size):
+    # readmission probabilities model gives the held-out stays of checkpoint, and their labels
+    # checkpoints saved before held_out was recorded are checked on all stays
+    idx = checkpoint.get('held_out') or range(len(dataset))
+    collate = partial(dataloader.ENCODINGS[checkpoint['encoding']], dims=dataset.shape)
+    probs, labels = [], []
+    for batch in DataLoader(Subset(dataset, list(idx)), batch_size=batch_size, collate_fn=collate):
+        probs.append(inference.predict(model, batch))
+        labels.append(batch[3])
+    return torch.cat(probs).numpy(), torch.cat(labels).numpy()
+
+def auroc(labels, probs):
+    return roc_auc_score(labels, probs) if len(np.unique(labels)) == 2 else float('nan')
+
+def check_equivalence(eager, artifact, dataset, checkpoint, batch_size):
+    reference, labels = held_out_probabilities(eager, dataset, checkpoint, batch_size)
+    probs, _ = held_out_probabilities(artifact, dataset, checkpoint, batch_size)
+    return {
+        'stays': len(labels),
+        'max_probability_delta': inference.max_probability_delta(reference, probs),
+        'eager_auroc': auroc(labels, reference),
+        'artifact_auroc': auroc(labels, probs),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', required=True, help='model checkpoint saved by training.kfold')
+    parser.add_argument('--data-dir', default=os.path.join(ROOT_DIR, 'data'),
+                        help='data the model was trained on, to trace it with and check the artifact on')
+    parser.add_argument('--format', choices=inference.FORMATS, default='torchscript')
+    parser.add_argument('--quantize', action='store_true', help='quantize the LSTM and Linear layers to int8')
+    parser.add_argument('--out', required=True)
+    parser.add_argument('--batch-size', type=int, default=256)
+    args = parser.parse_args()
+
+    model, checkpoint = load_checkpoint(args.checkpoint)
+    dataset = dataloader.get_dataset(args.data_dir)
+    if list(dataset.shape) != checkpoint['dims']:
+        raise SystemExit('{} holds stays of dims {}, but {} was trained on dims {}'.format(
+            args.data_dir, dataset.shape, args.checkpoint, checkpoint['dims']))
+
+    batch = dataloader.ENCODINGS[checkpoint['encoding']]([dataset[i] for i in range(min(8, len(dataset)))], dataset.shape)
+    inference.export(model, checkpoint, batch, args.out, args.format, args.quantize)
+    artifact, _ = inference.load_exported(args.out)
+    print('exported {} to {} ({}{}, {:.1f} MB)'.format(args.checkpoint, args.out, args.format,
+                                                        ', int8' if args.quantize else '', os.path.getsize(args.out) / 1e6))
+
+    check = check_equivalence(inference.ReadmissionProbability(model).eval(), artifact, dataset, checkpoint,
+                              args.batch_size)
+    print('{} held-out stays: max probability delta {:.2e}, AUROC {:.4f} eager fp32 vs {:.4f} exported ({:+.4f})'.format(
+        check['stays'], check['max_probability_delta'], check['eager_auroc'], check['artifact_auroc'],
+        check['artifact_auroc'] - check['eager_auroc']))
@@ -0,0 +1,268 @@
+# Runs the data pipeline data_sampling/datasampler.py -> data_cleaning/preprocess_mp.py (or preprocess_sql.py) -> data_cleaning/events_to_list.py
+# with a content-addressed cache of the outputs of every stage.
+#
+# The key of a stage is a hash of its inputs, its code, the config constants it uses and the package versions. Every
+# stage runs in its own directory in the cache, named after its key, so a stage whose key is in the cache is not run
+# again and the stages after it are only rerun if their own key changed. The inputs of a stage are the source files
+# (hashed by content once, then remembered by size and modification time) or the outputs of the stage before it
+# (identified by that stage's key).
+#
+# Usage:
+#   python3 pipeline.py --mimic-path "MIMIC III/" --out-dir data      # sample, preprocess and build the events
+#   python3 pipeline.py --subset-path mimic3_subset/ --out-dir data   # preprocess an existing subset
+#   python3 pipeline.py --subset-path mimic3_subset/ --stream --out-dir data
+#   python3 pipeline.py --subset-path mimic3_subset/ --backend sql --out-dir data   # preprocess with DuckDB
+
+import argparse
+import hashlib
+import importlib.metadata
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.path.join(ROOT_DIR, '.pipeline_cache')
+
+SAMPLER = os.path.join(ROOT_DIR, 'data_sampling', 'datasampler.py')
+PREPROCESS = os.path.join(ROOT_DIR, 'data_cleaning', 'preprocess_mp.py')
+PREPROCESS_SQL = os.path.join(ROOT_DIR, 'data_cleaning', 'preprocess_sql.py')
+EVENTS_TO_LIST = os.path.join(ROOT_DIR, 'data_cleaning', 'events_to_list.py')
+
+MIMIC_FILES = ['ICUSTAYS.csv', 'CHARTEVENTS.csv', 'PATIENTS.csv', 'DIAGNOSES_ICD.csv', 'D_ITEMS.csv']
+SUBSET_FILES = ['ICUSTAYS.csv', 'PATIENTS.csv', 'DIAGNOSES_ICD.csv']
+# outputs the models read, linked into --out-dir
+DATA_FILES = ['events', 'icd9', 'readmit_labels.pickle', 'categories.pickle', 'preprocessing.pickle']
+
+# module constants of every script that decide its output
+CONFIG_CONSTANTS = {
+    SAMPLER: ['CHART_EVENT_COLS', 'CHART_EVENT_DTYPES'],
+    PREPROCESS: ['category_dict', 'label_change', 'itemid_to_category_num', 'CHART_EVENT_COLS'],
+    PREPROCESS_SQL: ['category_dict', 'label_change', 'itemid_to_category_num', 'CHART_EVENT_COLS', 'CHART_EVENT_TYPES',
+                     'ICU_STAY_TYPES', 'PATIENT_TYPES', 'DIAGNOSIS_TYPES'],
+    EVENTS_TO_LIST: ['NUM_HOURS', 'NUM_CATEGORIES'],
+}
+
+
+def sha256(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class FileDigests:
+    # Content hashes of files, remembered by path, size and modification time so big source files are read only once
+
+    def __init__(self, path):
+        self.digests_path = path
+        self.digests = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.digests = json.load(f)
+
+    def file(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        known = self.digests.get(path)
+        if known is not None and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+            return known['sha256']
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 24), b''):
+                digest.update(block)
+        self.digests[path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest.hexdigest()}
+        return digest.hexdigest()
+
+    def path(self, path):
+        if not os.path.isdir(path):
+            return self.file(path)
+        return sha256({os.path.relpath(os.path.join(directory, name), path): self.file(os.path.join(directory, name))
+                       for directory, _, names in os.walk(path) for name in names})
+
+    def save(self):
+        with open(self.digests_path, 'w') as f:
+            json.dump(self.digests, f)
+
+
+def config_constants(script):
+    # the constants are read by importing the script, whose main code is behind a __main__ guard
+    spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(script))[0], script)
+    module = importlib.util.module_from_spec(spec)
+    sys.path.insert(0, os.path.dirname(script))
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(os.path.dirname(script))
+    return {name: getattr(module, name) for name in CONFIG_CONSTANTS[script]}
+
+
+class Stage:
+    # A script run with options in its own directory of the cache. options and the inputs' digests are part of the
+    # key, args (paths into the cache, numbers of workers) are not, as they don't change the output. links are
+    # linked into the stage's directory before the script runs, for scripts that read their input from there
+
+    def __init__(self, name, script, inputs, options=(), args=(), links=None):
+        self.name = name
+        self.script = script
+        self.inputs = inputs
+        self.options = list(options)
+        self.args = list(args)
+        self.links = links or {}
+
+    def key(self, digests):
+        return sha256({
+            'stage': self.name,
+            'code': digests.file(self.script),
+            'config': config_constants(self.script),
+            'options': self.options,
+            'inputs': self.inputs,
+            'versions': {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__},
+        })
+
+    def run(self, key, cache_dir):
+        # Returns the stage's directory in the cache, whether it was a cache hit and the seconds the stage took
+        # (when it was first run, for hits)
+        out_dir = os.path.join(cache_dir, '{}-{}'.format(self.name, key[:16]))
+        manifest_path = os.path.join(out_dir, 'manifest.json')
+        if os.path.isfile(manifest_path):
+            with open(manifest_path) as f:
+                return out_dir, True, json.load(f)['seconds']
+
+        # stages run in a temporary directory that is only renamed to its key once the script succeeded
+        work_dir = out_dir + '.tmp'
+        shutil.rmtree(work_dir, ignore_errors=True)
+        os.makedirs(work_dir)
+        for name, path in self.links.items():
+            os.symlink(path, os.path.join(work_dir, name))
+
+        start_time = time.monotonic()
+        subprocess.run([sys.executable, self.script, *self.options, *self.args], cwd=work_dir, check=True)
+        seconds = time.monotonic() - start_time
+
+        for name in self.links:
+            os.remove(os.path.join(work_dir, name))
+        with open(os.path.join(work_dir, 'manifest.json'), 'w') as f:
+            json.dump({'stage': self.name, 'key': key, 'script': os.path.relpath(self.script, ROOT_DIR),
+                       'options': self.options, 'inputs': self.inputs, 'seconds': seconds,
+                       'created': time.strftime('%Y-%m-%d %H:%M:%S')}, f, indent=2)
+        os.rename(work_dir, out_dir)
+        return out_dir, False, seconds
+
+
+def link_outputs(outputs, target_dir):
+    # Links the files the models read into target_dir. Only links left by earlier runs are replaced
+    os.makedirs(target_dir, exist_ok=True)
+    for name, path in outputs.items():
+        target = os.path.join(target_dir, name)
+        if os.path.lexists(target) and not os.path.islink(target):
+            raise SystemExit('{} exists and was not written by the pipeline; move it away first'.format(target))
+        if os.path.islink(target):
+            os.remove(target)
+        os.symlink(path, target)
+
+
+def run_pipeline(args):
+    # stages run in their own directories, so all paths handed to them are absolute
+    cache_dir = os.path.abspath(args.cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    digests = FileDigests(os.path.join(cache_dir, 'file_digests.json'))
+    report = []
+
+    def run(stage):
+        key = stage.key(digests)
+        digests.save()
+        out_dir, hit, seconds = stage.run(key, cache_dir)
+        report.append((stage.name, key, hit, seconds))
+        print('{:<12} {} {}'.format(stage.name, key[:16], 'cache hit' if hit else 'ran in {:.1f}s'.format(seconds)))
+        return out_dir, key
+
+    def trace_args(name):
+        # stages that run write their trace (see source/instrumentation.py) into --trace-dir; cache hits write none
+        if args.trace_dir is None:
+            return []
+        trace_dir = os.path.abspath(args.trace_dir)
+        os.makedirs(trace_dir, exist_ok=True)
+        return ['--trace', os.path.join(trace_dir, name + '.json')]
+
+    ### 1. Sample the subset of MIMIC III, unless an existing subset is given
+    if args.subset_path is not None:
+        subset_path = os.path.abspath(args.subset_path)
+        chart_events = 'CHARTEVENTS' if os.path.isdir(os.path.join(subset_path, 'CHARTEVENTS')) else 'CHARTEVENTS.csv'
+        subset_digest = {name: digests.path(os.path.join(subset_path, name)) for name in SUBSET_FILES + [chart_events]}
+    else:
+        mimic_path = os.path.abspath(args.mimic_path)
+        sampler = Stage('sample', SAMPLER,
+                        inputs={name: digests.file(os.path.join(mimic_path, name)) for name in MIMIC_FILES},
+                        options=['--sample-size', str(args.sample_size), '--seed', str(args.seed)],
+                        args=['--project-dir', '.', '--mimic-path', mimic_path + '/', '--subset-path', 'subset/',
+                              '--workers', str(args.workers)])
+        sampler_dir, subset_digest = run(sampler)
+        subset_path = os.path.join(sampler_dir, 'subset')
+
+    ### 2. Preprocess the chart events, labels and ICD-9 codes
+    if args.backend == 'sql':
+        # the SQL backend also runs code of preprocess_mp.py, and its output may change with the engine's version
+        preprocess = Stage('preprocess', PREPROCESS_SQL,
+                           inputs={'subset': subset_digest, 'preprocess_mp': digests.file(PREPROCESS),
+                                   'duckdb': importlib.metadata.version('duckdb')},
+                           args=['--mimic-path', subset_path + '/', *trace_args('preprocess')])
+    else:
+        options = ['--stream'] if args.stream else []
+        preprocess = Stage('preprocess', PREPROCESS, inputs={'subset': subset_digest}, options=options,
+                           args=['--mimic-path', subset_path + '/',
+                                 '--chunk-size', str(args.chunk_size), '--stays-per-partition', str(args.stays_per_partition),
+                                 *trace_args('preprocess')])
+    preprocess_dir, preprocess_key = run(preprocess)
+
+    ### 3. Build the event store
+    chart_events = 'chart_events_df' if args.stream else 'chart_events_df.pickle'
+    events = Stage('events', EVENTS_TO_LIST, inputs={'preprocess': preprocess_key}, args=trace_args('events'),
+                   links={chart_events: os.path.join(preprocess_dir, chart_events)})
+    events_dir, _ = run(events)
+
+    outputs = {name: os.path.join(preprocess_dir, name) for name in DATA_FILES}
+    outputs['events'] = os.path.join(events_dir, 'events')
+
+    ### 4. Report
+    num_hits = sum(hit for _, _, hit, _ in report)
+    saved = sum(seconds for _, _, hit, seconds in report if hit)
+    ran = sum(seconds for _, _, hit, seconds in report if not hit)
+    print('{} of {} stages from the cache, {:.1f}s saved, {:.1f}s run'.format(num_hits, len(report), saved, ran))
+
+    if args.out_dir is not None:
+        link_outputs(outputs, args.out_dir)
+        print('outputs linked into', args.out_dir)
+
+    return outputs
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(SAMPLER))
+    from datasampler import RAND_SEED, SAMPLE_SIZE, NUM_WORKERS
+
+    parser = argparse.ArgumentParser()
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--mimic-path', help='MIMIC III directory to sample from')
+    source.add_argument('--subset-path', help='existing MIMIC III subset to preprocess, skipping the sampling')
+    parser.add_argument('--sample-size', type=int, default=SAMPLE_SIZE)
+    parser.add_argument('--seed', type=int, default=RAND_SEED)
+    parser.add_argument('--workers', type=int, default=NUM_WORKERS)
+    parser.add_argument('--backend', choices=['pandas', 'sql'], default='pandas',
+                        help='preprocess with data_cleaning/preprocess_mp.py or with DuckDB in preprocess_sql.py')
+    parser.add_argument('--stream', action='store_true', help='preprocess in streaming mode')
+    parser.add_argument('--chunk-size', type=int, default=5_000_000)
+    parser.add_argument('--stays-per-partition', type=int, default=2_000)
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    parser.add_argument('--out-dir', help='directory to link the outputs into, e.g. data')
+    parser.add_argument('--trace-dir', help='directory to write the time and memory traces of the stages that run to')
+    args = parser.parse_args()
+    if args.stream and args.backend == 'sql':
+        parser.error('--stream is a mode of the pandas backend')
+
+    run_pipeline(args)
@@ -0,0 +1,170 @@
+# Scores new ICU stays with a model checkpoint saved by source/training.py (kfold(checkpoint_dir=...)), writing the
+# readmission probability of every stay to a csv.
+#
+# The stays are read from a directory laid out like the subsets data_cleaning/preprocess_mp.py reads (CHARTEVENTS.csv
+# or the CHARTEVENTS/ columns written by the sampler, ICUSTAYS.csv and DIAGNOSES_ICD.csv) and preprocessed with the
+# normalization statistics, label mappings and ICD-9 vocabulary saved in the checkpoint. As in the streaming mode of
+# preprocess_mp.py, the chart events and diagnoses are read in chunks of --chunk-size rows and split into partitions
+# of --stays-per-partition stays on disk, and every partition is preprocessed and run through the model in batches
+# of --batch-size stays on its own, so memory does not grow with the number of stays scored.
+#
+# Instead of a checkpoint, the stays can be scored with a TorchScript or ONNX artifact exported from one by export.py,
+# given as --exported.
+#
+# Usage:
+#   python3 score.py --checkpoint checkpoints/fold-1.pt --mimic-path new_stays/ --out readmission_probabilities.csv
+#   python3 score.py --exported lstm-cnn-int8.pt --mimic-path new_stays/ --out readmission_probabilities.csv
+
+import warnings
+warnings.simplefilter(action='ignore', category=FutureWarning)
+
+import argparse
+import os
+import resource
+import sys
+import tempfile
+import time
+from functools import partial
+
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import DataLoader
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'data_cleaning'))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'source'))
+import events_to_list
+import inference
+import preprocess_mp
+from checkpoint import load_checkpoint
+from dataloader import ENCODINGS, CodeStore, CustomDataset, EventStore, WithLengths, clip_events, packed_collate_fn
+
+
+def part_path(directory, table, partition):
+    return os.path.join(directory, '{}-{:05d}.pickle'.format(table, partition))
+
+def split_into_partitions(frame, partition_starts, directory, table):
+    # appends the rows of frame to the partition of their icustay_id
+    partitions = np.searchsorted(partition_starts, frame['icustay_id'].to_numpy(), side='right') - 1
+    for p, part in frame.groupby(np.maximum(partitions, 0)):
+        preprocess_mp.append_frame(part_path(directory, table, p), part)
+
+def partition_stays(mimic_path, icu_stays, config, vocab, chunk_size, partition_starts, directory):
+    # Cleans the chart events (section I of preprocess_mp.py) with the label mappings of config and maps the
+    # diagnoses of every stay to the vocabulary indices of vocab, chunk by chunk, into partitions of stays
+    for chunk in preprocess_mp.read_chart_events(mimic_path, chunksize=chunk_size):
+        chunk = preprocess_mp.clean_chart_events(chunk, icu_stays, config['label_change'], config['itemid_to_category_num'])
+        split_into_partitions(chunk, partition_starts, directory, 'chart_events')
+
+    vocab_index = {code: i for i, code in enumerate(vocab)}
+    # codes are matched as the strings preprocess_mp.py wrote to the vocabulary; unknown codes are dropped. They are
+    # read as strings, as a chunk of numeric codes would otherwise be read as numbers without their leading zeros
+    for chunk in pd.read_csv(os.path.join(mimic_path, 'DIAGNOSES_ICD.csv'), header=0, dtype={'icd9_code': str},
+                             chunksize=chunk_size):
+        chunk = chunk.merge(icu_stays[['hadm_id', 'icustay_id']], left_on='hadm_id', right_on='hadm_id')
+        codes = chunk['icd9_code'].dropna()
+        chunk = pd.DataFrame({'icustay_id': chunk.loc[codes.index, 'icustay_id'].to_numpy(),
+                              'code': codes.map(vocab_index).to_numpy()}).dropna()
+        split_into_partitions(chunk.astype({'code': np.int32}), partition_starts, directory, 'codes')
+
+def partition_dataset(chart_events, codes, checkpoint):
+    # Preprocesses the chart events of a partition as sections III-V of preprocess_mp.py and events_to_list.py do and
+    # returns the icustay_ids of its stays and a dataset of them
+    stats = preprocess_mp.event_label_stats_frame(checkpoint['preprocessing'])
+    chart_events = preprocess_mp.normalize_chart_events(chart_events, stats)
+    chart_events = preprocess_mp.window_chart_events(chart_events)
+    # the row_ids of the padding copies are not used
+    chart_events = preprocess_mp.pad_chart_events(chart_events, 0)
+    icustay_ids = chart_events['icustay_id'].unique()
+
+    values, counts, offsets = events_to_list.build_event_store(chart_events)
+    max_num_events = checkpoint['dims'][3]
+    if checkpoint['encoding'] == 'events':
+        # the events of every (stay, hour, category) beyond the most the model was trained with are dropped
+        values, counts, offsets = clip_events(values, counts, max_num_events)
+    events = EventStore(values, counts, offsets, shape=(len(counts), *counts.shape[1:], max_num_events),
+                        lengths=events_to_list.stay_lengths(chart_events))
+
+    codes = codes[codes['icustay_id'].isin(icustay_ids)].drop_duplicates().sort_values(['icustay_id', 'code'])
+    codes_per_stay = codes.groupby('icustay_id').size().reindex(icustay_ids, fill_value=0)
+    code_offsets = np.zeros(len(icustay_ids) + 1, dtype=np.int64)
+    np.cumsum(codes_per_stay.to_numpy(), out=code_offsets[1:])
+    demo_features = CodeStore(codes['code'].to_numpy(dtype=np.int32), code_offsets, num_codes=len(checkpoint['vocab']))
+
+    return icustay_ids, CustomDataset(events, demo_features, np.zeros(len(icustay_ids), dtype=np.int64))
+
+def score_dataset(model, dataset, encoding, batch_size, packed=False):
+    # probability of readmission of every stay of dataset, in batches of batch_size stays, from an exported artifact
+    # or the eager model wrapped in inference.ReadmissionProbability
+    collate = partial(ENCODINGS[encoding], dims=dataset.shape)
+    if packed:
+        collate = partial(packed_collate_fn, dims=dataset.shape, collate_fn=ENCODINGS[encoding])
+        dataset = WithLengths(dataset)
+    loader = DataLoader(dataset, batch_size=batch_size, collate_fn=collate)
+    probs = []
+    for batch in loader:
+        probs.append(inference.predict(model, batch))
+    return torch.cat(probs).numpy() if probs else np.zeros(0, dtype=np.float32)
+
+def score(args):
+    torch.set_num_threads(args.threads)
+    if args.exported is not None:
+        model, checkpoint = inference.load_exported(args.exported, args.threads)
+    else:
+        model, checkpoint = load_checkpoint(args.checkpoint)
+        model = inference.ReadmissionProbability(model).eval()
+    if checkpoint['preprocessing'] is None or checkpoint['vocab'] is None:
+        raise SystemExit('{} was trained on data without preprocessing.pickle or an icd9/ vocabulary; '
+                         'rerun data_cleaning/preprocess_mp.py and retrain to score new stays'.format(
+                             args.exported or args.checkpoint))
+    start_time = time.monotonic()
+
+    mimic_path = os.path.join(args.mimic_path, '')
+    icu_stays = pd.read_csv(mimic_path + 'ICUSTAYS.csv', header=0, usecols=['subject_id', 'hadm_id', 'icustay_id'])
+    partition_starts = np.sort(icu_stays['icustay_id'].unique())[::args.stays_per_partition]
+
+    num_stays = 0
+    with tempfile.TemporaryDirectory() as directory:
+        partition_stays(mimic_path, icu_stays, checkpoint['preprocessing'], checkpoint['vocab'], args.chunk_size,
+                        partition_starts, directory)
+        prepared_time = time.monotonic()
+
+        pd.DataFrame(columns=['icustay_id', 'readmission_probability']).to_csv(args.out, index=False)
+        for p in range(len(partition_starts)):
+            if not os.path.isfile(part_path(directory, 'chart_events', p)):
+                continue
+            chart_events = preprocess_mp.read_frames(part_path(directory, 'chart_events', p))
+            codes_path = part_path(directory, 'codes', p)
+            codes = preprocess_mp.read_frames(codes_path) if os.path.isfile(codes_path) else pd.DataFrame(
+                {'icustay_id': np.zeros(0, dtype=np.int64), 'code': np.zeros(0, dtype=np.int32)})
+
+            icustay_ids, dataset = partition_dataset(chart_events, codes, checkpoint)
+            probs = score_dataset(model, dataset, checkpoint['encoding'], args.batch_size, checkpoint['packed'])
+            pd.DataFrame({'icustay_id': icustay_ids, 'readmission_probability': probs}).to_csv(
+                args.out, mode='a', header=False, index=False)
+            num_stays += len(icustay_ids)
+            print('partition {}/{}: {} stays'.format(p + 1, len(partition_starts), len(icustay_ids)))
+
+    seconds = time.monotonic() - start_time
+    print('scored {} stays in {:.1f}s ({:.1f}s reading and partitioning): {:.1f} stays/sec, peak RSS {:.0f} MB'.format(
+        num_stays, seconds, prepared_time - start_time, num_stays / seconds,
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3))
+    return num_stays
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    model = parser.add_mutually_exclusive_group(required=True)
+    model.add_argument('--checkpoint', help='model checkpoint saved by training.kfold')
+    model.add_argument('--exported', help='TorchScript or ONNX artifact exported by export.py')
+    parser.add_argument('--mimic-path', required=True, help='directory of the stays to score')
+    parser.add_argument('--out', default='readmission_probabilities.csv')
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--chunk-size', type=int, default=5_000_000,
+                        help='rows of CHARTEVENTS.csv and DIAGNOSES_ICD.csv read at a time')
+    parser.add_argument('--stays-per-partition', type=int, default=2_000, help='stays preprocessed at a time')
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads())
+    args = parser.parse_args()
+
+    score(args)
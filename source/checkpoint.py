@@ -0,0 +1,49 @@
+# Checkpoints of trained models, holding everything score.py needs to score new stays with them:
+#   model       - class name, constructor arguments (the model's config) and weights
+#   encoding    - input encoding of the model, see dataloader.ENCODINGS
+#   packed      - whether the model was trained on packed sequences of the real hours of every stay
+#   dims        - dims of the training data; new stays are cut to its number of events per hour and category
+#   vocab       - ICD-9 code of every vocabulary index the model was trained with
+#   preprocessing - normalization statistics and label mappings of the training data, written by
+#                 data_cleaning/preprocess_mp.py to preprocessing.pickle (None for data preprocessed before that)
+#   held_out    - indices of the dataset stays the model was validated on, which export.py checks artifacts on
+# Everything but the weights is stored as plain lists and dicts, so checkpoints load with torch.load(weights_only=True)
+
+import os
+import pickle
+import torch
+
+from models import LogisticRegression, LSTMPlusCNN, ReadmissionLSTM, StreamingLSTM
+
+MODELS = {model.__name__: model for model in (LSTMPlusCNN, ReadmissionLSTM, StreamingLSTM, LogisticRegression)}
+
+def read_preprocessing(data_dir):
+    path = os.path.join(data_dir, 'preprocessing.pickle') if data_dir is not None else None
+    if path is None or not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+def save_checkpoint(path, model, dataset, encoding='events', packed=False, held_out=None, **extra):
+    # extra entries are saved alongside, such as the optimizer state and history a sweep trial resumes from
+    vocab = getattr(dataset.feats, 'vocab', None)
+    torch.save({
+        **extra,
+        'model': type(model).__name__,
+        'config': model.config,
+        'state_dict': model.state_dict(),
+        'encoding': encoding,
+        'packed': packed,
+        'dims': [int(dim) for dim in dataset.shape],
+        'vocab': list(vocab) if vocab is not None else None,
+        'preprocessing': read_preprocessing(dataset.data_dir),
+        'held_out': [int(i) for i in held_out] if held_out is not None else None,
+    }, path)
+
+def load_checkpoint(path):
+    # Returns the model, in eval mode, and the checkpoint
+    checkpoint = torch.load(path, map_location='cpu', weights_only=True)
+    model = MODELS[checkpoint['model']](**checkpoint['config'])
+    model.load_state_dict(checkpoint['state_dict'])
+    model.eval()
+    return model, checkpoint
@@ -1,42 +1,252 @@
 # Adapted with reference to HW3_RNN from CS598: Deep Learning for Healthcare, University of Illinois Urbana Champaign
 
+import json
+import math
+import os
 import pickle
+from functools import partial
+import numpy as np
 import torch
+from torch.nn.utils.rnn import pack_padded_sequence
 from torch.utils.data import Dataset
 from torch.utils.data import DataLoader
+from torch.utils.data import Sampler
+from torch.utils.data import get_worker_info
 
-# pids_f = open('../data/pids.pickle', 'rb')
-evids_f = open('../data/evids.pickle', 'rb')
-readmit_labels_f = open('../data/readmit_labels.pickle', 'rb')
-categories_f = open('../data/categories.pickle', 'rb')
-events_f = open('../data/events.pickle', 'rb')
-icd9_per_icustay_f = open('../data/icd9_per_icustay.pickle', 'rb')
-icu_stays_f = open('../data/icu_stays.pickle', 'rb')
-
-# pids = pickle.load(pids_f)
-evids = pickle.load(evids_f)
-readmit_labels = pickle.load(readmit_labels_f)
-categories = pickle.load(categories_f)
-events = pickle.load(events_f)
-demo_features = pickle.load(icd9_per_icustay_f)
-icu_stays = pickle.load(icu_stays_f)
-
-# pids_f.close()
-evids_f.close()
-readmit_labels_f.close()
-categories_f.close()
-events_f.close()
-icd9_per_icustay_f.close()
-icu_stays_f.close()
+import instrumentation
+
+DATA_DIR = '../data/'
+
+def flatten_events(events):
+    # Flattens the nested (patient, hour, category, event) lists into a flat float32 array of event values,
+    # a (patient, hour, category) array of event counts and the offset of every patient into the value array
+    num_hours = max(len(patient) for patient in events)
+    num_categories = max(len(hour) for patient in events for hour in patient)
+
+    counts = np.zeros((len(events), num_hours, num_categories), dtype=np.int32)
+    values = []
+    for i_patient, patient in enumerate(events):
+        for j_hour, hour in enumerate(patient):
+            counts[i_patient, j_hour, :len(hour)] = [len(category) for category in hour]
+            for category in hour:
+                values.extend(category)
+
+    values = np.array(values, dtype=np.float32)
+    offsets = np.zeros(len(events) + 1, dtype=np.int64)
+    np.cumsum(counts.sum(axis=(1, 2)), out=offsets[1:])
+
+    return values, counts, offsets
+
+def clip_events(values, counts, max_num_events):
+    # Keeps the first max_num_events events of every (stay, hour, category) of flat event values and counts, as
+    # flatten_events returns them. Returns the clipped values, counts and offsets
+    flat_counts = counts.ravel().astype(np.int64)
+    starts = np.cumsum(flat_counts) - flat_counts
+    ranks = np.arange(len(values)) - np.repeat(starts, flat_counts)
+    values = values[ranks < max_num_events]
+    counts = np.minimum(counts, max_num_events)
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts.sum(axis=(1, 2)), out=offsets[1:])
+    return values, counts, offsets
+
+def shared_array(array):
+    # array in shared memory, so other processes (see training.kfold) read it without copying it.
+    # Memory-mapped arrays are already shared between processes through the page cache and are kept as they are
+    if array is None or isinstance(array, np.memmap):
+        return array
+    return torch.from_numpy(np.ascontiguousarray(array)).share_memory_().numpy()
+
+def share_arrays(store, names):
+    # Moves the in-memory arrays names of store into read-only shared memory. The tensors holding them are kept in
+    # store.buffers, which is what the store pickles instead of the arrays (see store_state)
+    store.buffers = getattr(store, 'buffers', {})
+    for name in names:
+        array = getattr(store, name)
+        if array is None or isinstance(array, np.memmap) or name in store.buffers:
+            continue
+        store.buffers[name] = torch.from_numpy(np.ascontiguousarray(array)).share_memory_()
+        array = store.buffers[name].numpy()
+        array.flags.writeable = False
+        setattr(store, name, array)
+
+def store_state(store):
+    # State of an in-memory store for pickling. Arrays in shared memory are left out and rebuilt from their tensors,
+    # which torch.multiprocessing sends to spawned DataLoader workers as a handle to the shared memory instead of
+    # copying them into the pickle
+    state = dict(store.__dict__)
+    for name in state.get('buffers', {}):
+        state[name] = None
+    return state
+
+def restore_state(store, state):
+    store.__dict__.update(state)
+    for name, buffer in state.get('buffers', {}).items():
+        array = buffer.numpy()
+        array.flags.writeable = False
+        setattr(store, name, array)
+
+class EventStore:
+    # Columnar event storage written by data_cleaning/events_to_list.py:
+    #   values.npy  - float32 normalized event values of all stays, in (stay, hour, category, event) order
+    #   counts.npy  - int32 number of events per (stay, hour, category)
+    #   offsets.npy - int64 start of every stay in values, plus the total number of events
+    #   lengths.npy - int32 number of real hours of every stay; the hours after them repeat the last real hour
+    #   meta.json   - dims of the stored events, so they don't have to be recomputed from counts
+    # The files are memory-mapped, so reading a stay only loads the pages holding that stay.
+    # Stores written before lengths.npy existed count every stay as num_hours long
+
+    def __init__(self, values, counts, offsets, path=None, shape=None, lengths=None):
+        self.values = values
+        self.counts = counts
+        self.offsets = offsets
+        self.path = path
+        self.shape = shape if shape is not None else self.dims()
+        self.lengths = lengths if lengths is not None else np.full(len(counts), counts.shape[1], dtype=np.int32)
+
+    @classmethod
+    def load(cls, path):
+        arrays = [np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in ('values', 'counts', 'offsets')]
+        lengths_path = os.path.join(path, 'lengths.npy')
+        lengths = np.load(lengths_path) if os.path.isfile(lengths_path) else None
+        meta_path = os.path.join(path, 'meta.json')
+        if os.path.isfile(meta_path):
+            with open(meta_path) as f:
+                return cls(*arrays, path=path, shape=tuple(json.load(f)['shape']), lengths=lengths)
+        # stores written before meta.json existed get their dims from counts; only events_to_list.py writes meta.json
+        return cls(*arrays, path=path, lengths=lengths)
+
+    @classmethod
+    def from_lists(cls, events):
+        return cls(*flatten_events(events))
+
+    def share_memory(self):
+        share_arrays(self, ('values', 'counts', 'offsets', 'lengths'))
+        return self
+
+    def dims(self):
+        num_patients, max_num_hours, max_num_categories = self.counts.shape
+        max_num_events = int(self.counts.max())
+
+        return num_patients, max_num_hours, max_num_categories, max_num_events
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __getitem__(self, index):
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return self.values[start:end], self.counts[index]
+
+    def __getstate__(self):
+        # memory-mapped stores are sent to DataLoader workers as their path and re-opened there
+        if self.path is None:
+            return store_state(self)
+        return {'path': self.path, 'shape': self.shape}
+
+    def __setstate__(self, state):
+        if 'values' in state:
+            restore_state(self, state)
+        else:
+            self.__dict__.update(EventStore.load(state['path']).__dict__)
+
+class CodeStore:
+    # ICD-9 codes of every stay written by data_cleaning/preprocess_mp.py, stored in CSR layout:
+    #   indices.npy - int32 vocabulary index of every code of a stay, sorted, in stay order
+    #   offsets.npy - int64 start of every stay in indices, plus the total number of codes
+    #   vocab.json  - the ICD-9 code of every vocabulary index
+
+    def __init__(self, indices, offsets, vocab=None, num_codes=None, path=None):
+        self.indices = indices
+        self.offsets = offsets
+        self.vocab = vocab
+        self.num_codes = num_codes if num_codes is not None else len(vocab)
+        self.path = path
+
+    @classmethod
+    def load(cls, path):
+        indices = np.load(os.path.join(path, 'indices.npy'), mmap_mode='r')
+        offsets = np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
+        with open(os.path.join(path, 'vocab.json')) as f:
+            vocab = json.load(f)
+        return cls(indices, offsets, vocab, path=path)
+
+    @classmethod
+    def from_dense(cls, demo_features):
+        # one-hot lists of icd9_per_icustay.pickle, written before the codes were stored sparsely
+        demo_features = np.asarray(demo_features, dtype=np.int8)
+        stays, indices = np.nonzero(demo_features)
+        offsets = np.zeros(len(demo_features) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(stays, minlength=len(demo_features)), out=offsets[1:])
+        return cls(indices.astype(np.int32), offsets, num_codes=demo_features.shape[1])
+
+    def share_memory(self):
+        share_arrays(self, ('indices', 'offsets'))
+        return self
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return self.indices[self.offsets[index]:self.offsets[index + 1]]
+
+    def __getstate__(self):
+        # memory-mapped stores are sent to DataLoader workers as their path and re-opened there
+        if self.path is None:
+            return store_state(self)
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        if 'indices' in state:
+            restore_state(self, state)
+        else:
+            self.__dict__.update(CodeStore.load(state['path']).__dict__)
 
 class CustomDataset(Dataset):
     
-    def __init__(self, events, demo_features, labels):
+    def __init__(self, events, demo_features, labels, data_dir=None):
         self.x = events
         self.feats = demo_features
         self.y = labels
+        # directory the dataset was loaded from, which holds the preprocessing.pickle of its stays
+        self.data_dir = data_dir
         self.shape = self.dims()
+        self.num_codes = demo_features.num_codes
+        self.lengths = events.lengths
+
+    @classmethod
+    def load(cls, data_dir):
+        with open(os.path.join(data_dir, 'readmit_labels.pickle'), 'rb') as f:
+            readmit_labels = pickle.load(f)
+
+        # icd9_per_icustay.pickle and events.pickle are only read for data preprocessed before the code and event
+        # stores were introduced
+        if os.path.isdir(os.path.join(data_dir, 'icd9')):
+            demo_features = CodeStore.load(os.path.join(data_dir, 'icd9'))
+        else:
+            with open(os.path.join(data_dir, 'icd9_per_icustay.pickle'), 'rb') as f:
+                demo_features = CodeStore.from_dense(pickle.load(f))
+
+        if os.path.isdir(os.path.join(data_dir, 'events')):
+            events = EventStore.load(os.path.join(data_dir, 'events'))
+        else:
+            with open(os.path.join(data_dir, 'events.pickle'), 'rb') as f:
+                events = EventStore.from_lists(pickle.load(f))
+
+        # preprocess_mp.py wrote a label per chart event before it wrote one per stay
+        if len(readmit_labels) != len(events):
+            raise ValueError('{} holds {} labels for {} stays; rerun data_cleaning/preprocess_mp.py to write one label '
+                             'per stay'.format(os.path.join(data_dir, 'readmit_labels.pickle'), len(readmit_labels),
+                                           len(events)))
+        return cls(events, demo_features, readmit_labels, data_dir=data_dir)
     
+    def share_memory(self):
+        # moves the events, codes and labels into shared memory before training.kfold starts its fold processes or
+        # load_data starts DataLoader workers
+        self.x.share_memory()
+        self.feats.share_memory()
+        self.y = shared_array(np.asarray(self.y))
+        self.lengths = self.x.lengths
+        return self
+
     def __len__(self):
         return len(self.x)
     
@@ -44,46 +254,197 @@ class CustomDataset(Dataset):
         return self.x[index], self.feats[index], self.y[index]
         
     def dims(self):
-        events = self.x
-        num_patients = len(events)
-        num_hours = [len(patient) for patient in events]
-        num_categories = [len(hours) for patient in events for hours in patient]
-        num_events = [len(category) for patient in events for hours in patient for category in hours]
+        return self.x.shape
 
-        max_num_hours = max(num_hours)
-        max_num_categories = max(num_categories)
-        max_num_events = max(num_events)
+_datasets = {}
 
-        return num_patients, max_num_hours, max_num_categories, max_num_events
+def get_dataset(data_dir=DATA_DIR):
+    # Nothing is read when this module is imported; the dataset in data_dir is built on first use and cached
+    data_dir = os.path.abspath(data_dir)
+    if data_dir not in _datasets:
+        _datasets[data_dir] = CustomDataset.load(data_dir)
+    return _datasets[data_dir]
+
+def code_bags(features):
+    # ICD-9 codes as an (indices, offsets) bag per patient, in the input format of nn.EmbeddingBag
+    lengths = np.array([len(codes) for codes in features])
+    return (torch.from_numpy(np.concatenate(features).astype(np.int64)),
+            torch.from_numpy(np.cumsum(lengths) - lengths))
+
+class WithLengths(Dataset):
+    # dataset items followed by the number of real hours of the stay, for packed_collate_fn
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.shape = dataset.shape
+        self.lengths = dataset.lengths
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        return (*self.dataset[index], int(self.lengths[index]))
+
+class BucketBatchSampler(Sampler):
+    # Batches the indices of sampler so that every batch holds stays of similar length: pools of
+    # batch_size * pool_batches indices are taken in the order sampler draws them, sorted by length and cut into
+    # batches, which are yielded in random order. Every index sampler draws ends up in one batch, so the class
+    # balance of a weighted sampler is kept
+
+    def __init__(self, sampler, lengths, batch_size, pool_batches=50):
+        self.sampler = sampler
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.pool_size = batch_size * pool_batches
+
+    def batches(self, pool):
+        pool = sorted(pool, key=lambda index: self.lengths[index])
+        batches = [pool[i:i + self.batch_size] for i in range(0, len(pool), self.batch_size)]
+        return [batches[i] for i in torch.randperm(len(batches)).tolist()]
+
+    def __iter__(self):
+        pool = []
+        for index in self.sampler:
+            pool.append(index)
+            if len(pool) == self.pool_size:
+                yield from self.batches(pool)
+                pool = []
+        if pool:
+            yield from self.batches(pool)
 
-dataset = CustomDataset(events, demo_features, readmit_labels)
+    def __len__(self):
+        num_pools, rest = divmod(len(self.sampler), self.pool_size)
+        return num_pools * (self.pool_size // self.batch_size) + -(-rest // self.batch_size)
+
+def batch_tensor(shape, dtype=torch.float):
+    # Zeroed tensor for a batch. In a DataLoader worker it is allocated in shared memory, as default_collate does,
+    # so the batch is not copied into shared memory again to be sent to the main process
+    if get_worker_info() is None:
+        return torch.zeros(shape, dtype=dtype)
+    storage = torch.UntypedStorage._new_shared(math.prod(shape) * dtype.itemsize)
+    return torch.empty(0, dtype=dtype).set_(storage).view(shape).zero_()
 
-def collate_fn(data):
+def collate_fn(data, dims):
     events, features, labels = zip(*data)
-    batch_size = len(events)
-    _ , max_num_hours, max_num_categories, max_num_events = dataset.shape
+    values, counts = zip(*events)
+    _ , max_num_hours, max_num_categories, max_num_events = dims
 
     y = torch.tensor(labels, dtype=torch.long)
     # y = torch.zeros((len(labels), 2), dtype=torch.long)
     # for i_label, label in enumerate(labels):
     #    y[i_label, label] = 1
 
-    x = torch.full((batch_size, max_num_hours, max_num_categories, max_num_events), 0.0, dtype=torch.float)
-    masks = torch.zeros((batch_size, max_num_hours, max_num_categories, max_num_events), dtype=torch.bool)
-    for i_patient, patient in enumerate(events):
-        for j_hour, hour in enumerate(patient):
-            for k_category, category in enumerate(hour):
-                for l_event in range(len(category)):
-                    x[i_patient][j_hour][k_category][l_event] = category[l_event]
-                    masks[i_patient][j_hour][k_category][l_event] = True
+    # every patient's events are stored in (hour, category, event) order, so the events of the batch fill the
+    # mask in row-major order and can be scattered into x in a single call
+    counts = torch.from_numpy(np.stack(counts))
+    masks = torch.lt(torch.arange(max_num_events), counts.unsqueeze(-1),
+                     out=batch_tensor((*counts.shape, max_num_events), torch.bool))
+    x = batch_tensor(masks.shape)
+    x.masked_scatter_(masks, torch.from_numpy(np.concatenate(values)))
+
+    return x, code_bags(features), masks, y
+
+SUMMARY_STATS = ('count', 'mean', 'min', 'max', 'last', 'mask')
+
+def summary_collate_fn(data, dims):
+    # Encodes the events of every (hour, category) by the summary statistics in SUMMARY_STATS instead of padding
+    # them to max_num_events: x has shape (batch, hours, categories, len(SUMMARY_STATS)) and cells without events
+    # are all zeros. masks marks the (batch, hours, categories) cells that have events
+    events, features, labels = zip(*data)
+    values, counts = zip(*events)
+
+    y = torch.tensor(labels, dtype=torch.long)
+
+    # the events are stored in cell order, so every event's cell follows from the counts without padding them
+    counts = torch.from_numpy(np.stack(counts))
+    values = torch.from_numpy(np.concatenate(values))
+    flat_counts = counts.flatten().long()
+    cells = torch.repeat_interleave(torch.arange(len(flat_counts)), flat_counts)
+    masks = counts > 0
+    has_events = masks.flatten()
+
+    x = batch_tensor((len(flat_counts), len(SUMMARY_STATS)))
+    x[:, 0] = flat_counts
+    x[:, 1].index_add_(0, cells, values)
+    x[has_events, 1] /= x[has_events, 0]
+    x[:, 2].scatter_reduce_(0, cells, values, 'amin', include_self=False)
+    x[:, 3].scatter_reduce_(0, cells, values, 'amax', include_self=False)
+    x[has_events, 4] = values[torch.cumsum(flat_counts, 0)[has_events] - 1]
+    x[:, 5] = has_events
+    x = x.reshape(*counts.shape, len(SUMMARY_STATS))
 
-    feats = torch.tensor(features, dtype=torch.long)
+    return x, code_bags(features), masks, y
 
+def packed_collate_fn(data, dims, collate_fn=collate_fn):
+    # Batches items of WithLengths with collate_fn and packs x, flattened to (batch, hours, inputs), into a
+    # PackedSequence holding only the real hours of every stay, which the models run their LSTMs on
+    lengths = torch.tensor([item[-1] for item in data])
+    x, feats, masks, y = collate_fn([item[:-1] for item in data], dims)
+    x = pack_padded_sequence(x.flatten(start_dim=2), lengths, batch_first=True, enforce_sorted=False)
     return x, feats, masks, y
 
+# collate function of every input encoding
+ENCODINGS = {'events': collate_fn, 'summary': summary_collate_fn}
+
+def input_size(dims, encoding='events'):
+    # number of inputs per hour the models get from the collate function of encoding
+    _, _, max_num_categories, max_num_events = dims
+    if encoding == 'summary':
+        return max_num_categories * len(SUMMARY_STATS)
+    return max_num_categories * max_num_events
+
+def dense_feats(feats, num_codes):
+    # one-hot (batch, num_codes) encoding of the ICD-9 code bags of a batch
+    codes, offsets = feats
+    lengths = torch.diff(offsets, append=torch.tensor([len(codes)]))
+    dense = torch.zeros((len(offsets), num_codes), dtype=torch.long)
+    dense[torch.repeat_interleave(torch.arange(len(offsets)), lengths), codes] = 1
+    return dense
+
+
+def init_loader_worker(worker_id):
+    # collation runs in several workers at once, each on one thread
+    torch.set_num_threads(1)
+
+def load_data(train_sampler, val_sampler, collate_fn=None, batch_size=10, dataset=None, encoding='events',
+              packed=False, bucketing=False, num_workers=0, prefetch_factor=2, pin_memory=None):
+    # collate_fn is called with the dims of the dataset as its dims keyword argument. Without a collate_fn,
+    # the one of encoding is used ('events' or 'summary', see ENCODINGS).
+    # packed=True feeds x as a PackedSequence of the real hours of every stay and bucketing=True batches stays of
+    # similar length together (see BucketBatchSampler), so packed batches hold little padding.
+    # With num_workers > 0, batches are collated by that many worker processes while the model trains, each keeping
+    # prefetch_factor batches ready. The dataset is moved into read-only shared memory first, which the workers index
+    # without copying it; memory-mapped stores are shared through the page cache. The workers persist across
+    # epochs. Every batch is collated into tensors of its own, which are not reused for later batches. pin_memory, by
+    # default whether CUDA is available, collates into page-locked memory so that on a GPU the next batch is
+    # prefetched while the current one is computed (see training.device_batches); on CPU nothing is prefetched
+    # beyond the batches the workers keep ready
+    if dataset is None:
+        dataset = get_dataset()
+    if collate_fn is None:
+        collate_fn = ENCODINGS[encoding]
+    if num_workers > 0:
+        dataset.share_memory()
+    collate = partial(collate_fn, dims=dataset.shape)
+    if packed:
+        collate = partial(packed_collate_fn, dims=dataset.shape, collate_fn=collate_fn)
+        dataset = WithLengths(dataset)
+    if instrumentation.enabled():
+        collate = instrumentation.traced(collate, 'collate')
+
+    loader_kwargs = {'collate_fn': collate,
+                     'pin_memory': torch.cuda.is_available() if pin_memory is None else pin_memory}
+    if num_workers > 0:
+        loader_kwargs.update(num_workers=num_workers, persistent_workers=True, prefetch_factor=prefetch_factor,
+                             worker_init_fn=init_loader_worker)
 
-def load_data(train_sampler, val_sampler, collate_fn=collate_fn, batch_size=10):
-    train_loader = DataLoader(dataset, sampler=train_sampler, batch_size=batch_size, collate_fn=collate_fn, shuffle=False)
-    val_loader = DataLoader(dataset, sampler=val_sampler, batch_size=batch_size, collate_fn=collate_fn, shuffle=False)
+    loaders = []
+    for sampler in (train_sampler, val_sampler):
+        if bucketing:
+            batch_sampler = BucketBatchSampler(sampler, dataset.lengths, batch_size)
+            loaders.append(DataLoader(dataset, batch_sampler=batch_sampler, **loader_kwargs))
+        else:
+            loaders.append(DataLoader(dataset, sampler=sampler, batch_size=batch_size, shuffle=False, **loader_kwargs))
+    train_loader, val_loader = loaders
 
     return train_loader, val_loader
@@ -0,0 +1,198 @@
+# Data-parallel training of the readmission models on CPUs with torch.distributed and the gloo backend.
+#
+# Every rank holds a copy of the model and trains it on its own shard of the stays the class-balanced weighted sampler
+# of training.subset_weighted_random_sampler draws: all ranks draw the same stays for an epoch, from a generator
+# seeded with the seed and the epoch, and rank r takes every world_size-th of them starting at the r-th. The gradients
+# are averaged over the ranks before every optimizer step and the metrics of an epoch summed over them (see
+# training.run_epoch), so the ranks step identical models, and world_size ranks with batches of batch_size stays train
+# like one process with batches of world_size * batch_size stays, but for batch norm layers, which normalize by the
+# statistics of the batch of their rank. Their running statistics are averaged over the ranks after every training
+# epoch.
+#
+# The ranks find each other through the env:// rendezvous of torch.distributed (MASTER_ADDR, MASTER_PORT, RANK and
+# WORLD_SIZE), as set by torchrun on every node or by launch_local for ranks on this machine. Every rank loads the
+# dataset from data_dir itself; on one machine the memory-mapped event and code stores are shared through the page
+# cache. The ranks on a machine split its CPUs between them (see training.cpu_slices).
+# Only rank 0 saves the checkpoint.
+
+import os
+import socket
+import time
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from sklearn.model_selection import KFold
+from torch.utils.data import Sampler
+
+import dataloader
+import instrumentation
+from checkpoint import save_checkpoint
+from training import (HISTORY_DTYPE, adam, build_model, cpu_slices, criterion_for, print_epoch, record_epoch, run_epoch,
+                      subset_weighted_random_sampler)
+
+
+class DistributedWeightedSampler(Sampler):
+    # The shard of rank of the num_samples stays drawn with replacement by weights, as a WeightedRandomSampler draws
+    # them. The draws are rounded up to a multiple of world_size so every rank gets as many, and change with
+    # set_epoch
+
+    def __init__(self, weights, num_samples, rank, world_size, seed=0):
+        self.weights = torch.as_tensor(weights, dtype=torch.double)
+        self.num_samples = -(-num_samples // world_size)
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.epoch = 0
+
+    @classmethod
+    def shard(cls, sampler, rank, world_size, seed=0):
+        # the shard of rank of a WeightedRandomSampler
+        return cls(sampler.weights, sampler.num_samples, rank, world_size, seed)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(int(np.random.SeedSequence([self.seed, self.epoch]).generate_state(1)[0]))
+        draws = torch.multinomial(self.weights, self.num_samples * self.world_size, replacement=True,
+                                  generator=generator)
+        return iter(draws[self.rank::self.world_size].tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+
+def split(num_stays, k_folds, fold, seed):
+    # the train and validation indices of fold of a shuffled k-fold split, the same on every rank
+    train_idx, val_idx = list(KFold(n_splits=k_folds, shuffle=True, random_state=seed).split(np.arange(num_stays)))[fold]
+    return train_idx, val_idx
+
+def pin_local_rank(local_rank, local_world_size):
+    # runs the rank on its slice of the CPUs of its machine, with torch using one thread per CPU of the slice
+    cpus = cpu_slices(local_world_size)[local_rank]
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(len(cpus))
+
+def broadcast_parameters(model):
+    # the parameters and buffers of rank 0, so all ranks start from the same model
+    for tensor in [*model.parameters(), *model.buffers()]:
+        dist.broadcast(tensor.data, 0)
+
+def average_buffers(model):
+    # averages the floating point buffers, the running statistics of batch norm layers, over the ranks
+    world_size = dist.get_world_size()
+    for buffer in model.buffers():
+        if buffer.is_floating_point():
+            dist.all_reduce(buffer.data)
+            buffer.data /= world_size
+
+def max_over_ranks(value):
+    value = torch.tensor([value], dtype=torch.float64)
+    dist.all_reduce(value, op=dist.ReduceOp.MAX)
+    return value.item()
+
+
+def train(config):
+    # Trains on this rank of the initialized process group. config holds:
+    #   data_dir, model (a class name of checkpoint.MODELS) and model_kwargs (such as hidden_size)
+    #   k_folds, fold and seed of the train and validation split, which also seeds the model and the samplers
+    #   n_epochs, batch_size (per rank), lr, accumulation_steps and sample (see subset_weighted_random_sampler)
+    #   loader_kwargs for dataloader.load_data (encoding, packed, bucketing, num_workers)
+    #   checkpoint_path, where rank 0 saves the trained model, or None
+    #   verbose, for rank 0 to print the metrics of every epoch, and trace, to record the phases of every epoch
+    # Returns the HISTORY_DTYPE record of every epoch, with the metrics of all ranks, the seconds of every training
+    # epoch of the slowest rank and this rank's trace
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    if config.get('trace'):
+        instrumentation.enable()
+    dataset = dataloader.get_dataset(config['data_dir'])
+    loader_kwargs = config.get('loader_kwargs', {})
+    encoding = loader_kwargs.get('encoding', 'events')
+    train_idx, val_idx = split(len(dataset), config['k_folds'], config['fold'], config['seed'])
+
+    torch.manual_seed(config['seed'])
+    model = build_model(config['model'], dataset, encoding, **config.get('model_kwargs', {}))
+    if any(getattr(module, 'sparse', False) for module in model.modules()):
+        raise ValueError('sparse gradients are not all-reduced; build the model with sparse_grad=False')
+    broadcast_parameters(model)
+    # dropout differs between the ranks
+    torch.manual_seed(config['seed'] + rank)
+    criterion = criterion_for(model)
+    optimizer = adam(model, config['lr'])
+
+    sample = config.get('sample', 'over')
+    samplers = [DistributedWeightedSampler.shard(subset_weighted_random_sampler(dataset, idx, sample), rank, world_size,
+                                                 config['seed'] + i) for i, idx in enumerate((train_idx, val_idx))]
+    train_loader, test_loader = dataloader.load_data(*samplers, batch_size=config['batch_size'], dataset=dataset,
+                                                     **loader_kwargs)
+
+    n_epochs = config['n_epochs']
+    history = np.zeros(n_epochs, dtype=HISTORY_DTYPE)
+    train_seconds = []
+    verbose = config.get('verbose', True) and rank == 0
+    for epoch in range(n_epochs):
+        for sampler in samplers:
+            sampler.set_epoch(epoch)
+        start_time = time.perf_counter()
+        with instrumentation.stage('train_epoch', fold=config['fold'], epoch=epoch):
+            train_metrics = run_epoch(model, train_loader, criterion, optimizer, config.get('accumulation_steps', 1),
+                                      distributed=True)
+        train_seconds.append(max_over_ranks(time.perf_counter() - start_time))
+        average_buffers(model)
+        with instrumentation.stage('valid_epoch', fold=config['fold'], epoch=epoch):
+            test_metrics = run_epoch(model, test_loader, criterion, distributed=True)
+
+        record_epoch(history[epoch], config['fold'], epoch, train_metrics, test_metrics)
+        if verbose:
+            print_epoch(epoch, n_epochs, train_metrics, test_metrics)
+
+    if rank == 0 and config.get('checkpoint_path') is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(config['checkpoint_path'])), exist_ok=True)
+        save_checkpoint(config['checkpoint_path'], model, dataset, encoding, loader_kwargs.get('packed', False), val_idx)
+
+    return {'history': history, 'train_seconds': train_seconds, 'trace': instrumentation.take_trace()}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def run_local_rank(rank, config, world_size, port, results):
+    os.environ.update(MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port))
+    pin_local_rank(rank, world_size)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    try:
+        results.put((rank, train(config)))
+    finally:
+        dist.destroy_process_group()
+
+def launch_local(config, world_size):
+    # Trains with world_size ranks started as processes on this machine. Returns the result of train of every rank,
+    # in rank order. The processes are spawned, so config must be picklable
+    results = mp.get_context('spawn').SimpleQueue()
+    processes = mp.start_processes(run_local_rank, args=(config, world_size, free_port(), results), nprocs=world_size,
+                                   start_method='spawn', join=False)
+    # the results are read while the ranks run, as a rank can't exit before its result is read from the queue, and
+    # join raises the error of a rank that failed
+    rank_results = {}
+    done = False
+    while not done:
+        done = processes.join(timeout=0.1)
+        while not results.empty():
+            rank, result = results.get()
+            rank_results[rank] = result
+    return [rank_results[rank] for rank in range(world_size)]
+
+def run_torchrun(config):
+    # Trains on the rank torchrun started this process as, on one of possibly several machines
+    pin_local_rank(int(os.environ.get('LOCAL_RANK', 0)), int(os.environ.get('LOCAL_WORLD_SIZE', 1)))
+    dist.init_process_group('gloo')
+    try:
+        return train(config)
+    finally:
+        dist.destroy_process_group()
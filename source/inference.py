@@ -0,0 +1,133 @@
+# CPU inference artifacts of trained models, exported from a checkpoint (see checkpoint.py) by export.py:
+#   torchscript - the model traced with torch.jit.trace, saved with torch.jit.save
+#   onnx        - the model exported with torch.onnx.export, run with onnxruntime (both optional dependencies)
+# With quantize, the LSTM and Linear layers are quantized dynamically to int8: their weights are stored as int8 and
+# their activations are quantized batch by batch, which needs no calibration data. TorchScript artifacts are
+# quantized with torch.ao.quantization.quantize_dynamic before tracing, ONNX artifacts with
+# onnxruntime.quantization.quantize_dynamic after exporting.
+#
+# Every artifact takes the padded tensors of a batch of dataloader.collate_fn or summary_collate_fn, (x, codes,
+# offsets, masks), whatever inputs its model uses, and returns the probability of readmission of every stay. The
+# checkpoint the artifact was exported from is embedded in it without its weights, so score.py can preprocess
+# new stays for it.
+
+import base64
+import io
+import os
+import warnings
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from training import model_output
+
+FORMATS = ('torchscript', 'onnx')
+
+INPUT_NAMES = ['x', 'codes', 'offsets', 'masks']
+
+class ReadmissionProbability(nn.Module):
+    # model with the flat inputs of an artifact, returning the last output column: the probability of readmission,
+    # for the one-column LogisticRegression too
+    def __init__(self, model):
+        super(ReadmissionProbability, self).__init__()
+        self.model = model
+    def forward(self, x, codes, offsets, masks):
+        return model_output(self.model, x, (codes, offsets), masks)[:, -1]
+
+def quantize_dynamic(model):
+    with warnings.catch_warnings():
+        # torch.ao.quantization is deprecated in favour of torchao, which is not a dependency of this project
+        warnings.simplefilter('ignore', DeprecationWarning)
+        return torch.ao.quantization.quantize_dynamic(model, {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+
+def checkpoint_info(checkpoint):
+    # everything of the checkpoint but the weights and held-out stays, saved with torch.save like the checkpoint
+    # itself, as json would turn the integer keys of the label mappings into strings
+    buffer = io.BytesIO()
+    torch.save({key: value for key, value in checkpoint.items() if key not in ('state_dict', 'held_out')}, buffer)
+    return buffer.getvalue()
+
+def read_checkpoint_info(info):
+    return torch.load(io.BytesIO(info), weights_only=True)
+
+def export_torchscript(model, checkpoint, batch, path, quantize=False):
+    model = ReadmissionProbability(model).eval()
+    if quantize:
+        model = quantize_dynamic(model)
+    x, (codes, offsets), masks, _ = batch
+    with torch.no_grad():
+        traced = torch.jit.trace(model, (x, codes, offsets, masks), check_trace=False)
+    torch.jit.save(traced, path, _extra_files={'checkpoint.pt': checkpoint_info(checkpoint)})
+
+def export_onnx(model, checkpoint, batch, path, quantize=False):
+    try:
+        import onnx
+    except ImportError:
+        raise SystemExit('exporting to ONNX needs the onnx package: pip install onnx onnxruntime')
+    x, (codes, offsets), masks, _ = batch
+    # the number of stays and of codes in a batch vary
+    dynamic_axes = {'x': {0: 'stays'}, 'codes': {0: 'codes'}, 'offsets': {0: 'stays'}, 'masks': {0: 'stays'},
+                    'probability': {0: 'stays'}}
+    with torch.no_grad():
+        torch.onnx.export(ReadmissionProbability(model).eval(), (x, codes, offsets, masks), path, dynamo=False,
+                          input_names=INPUT_NAMES, output_names=['probability'], dynamic_axes=dynamic_axes)
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic as quantize_onnx
+        fp32_path = path + '.fp32'
+        os.replace(path, fp32_path)
+        quantize_onnx(fp32_path, path, weight_type=QuantType.QInt8)
+        os.remove(fp32_path)
+    artifact = onnx.load(path)
+    # model properties are strings
+    onnx.helper.set_model_props(artifact, {'checkpoint': base64.b64encode(checkpoint_info(checkpoint)).decode()})
+    onnx.save(artifact, path)
+
+def export(model, checkpoint, batch, path, format='torchscript', quantize=False):
+    # Exports model, loaded from checkpoint, to path, tracing it with batch, a batch of its collate function
+    if checkpoint['packed']:
+        raise SystemExit('models trained on packed sequences cannot be exported, as artifacts take padded batches')
+    if format == 'onnx':
+        export_onnx(model, checkpoint, batch, path, quantize)
+    else:
+        export_torchscript(model, checkpoint, batch, path, quantize)
+
+class OnnxModel:
+    # an onnxruntime session called like a TorchScript artifact
+    def __init__(self, path, threads=None):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        if threads is not None:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_names = [node.name for node in self.session.get_inputs()]
+    def __call__(self, x, codes, offsets, masks):
+        inputs = dict(zip(INPUT_NAMES, (x, codes, offsets, masks)))
+        # the exporter leaves out the inputs the model does not use
+        feed = {name: inputs[name].numpy() for name in self.input_names}
+        return torch.from_numpy(self.session.run(None, feed)[0])
+
+def load_exported(path, threads=None):
+    # Returns the artifact at path, called with (x, codes, offsets, masks), and the checkpoint it was exported from
+    # without its weights
+    with open(path, 'rb') as f:
+        is_onnx = f.read(2) != b'PK' # TorchScript artifacts are zip files
+    if is_onnx:
+        try:
+            import onnx
+        except ImportError:
+            raise SystemExit('running ONNX artifacts needs the onnx and onnxruntime packages')
+        props = {prop.key: prop.value for prop in onnx.load(path, load_external_data=False).metadata_props}
+        return OnnxModel(path, threads), read_checkpoint_info(base64.b64decode(props['checkpoint']))
+    extra_files = {'checkpoint.pt': ''}
+    model = torch.jit.load(path, map_location='cpu', _extra_files=extra_files)
+    return model.eval(), read_checkpoint_info(extra_files['checkpoint.pt'])
+
+def predict(model, batch):
+    # probability of readmission of every stay of a batch, from an artifact or an eager ReadmissionProbability
+    x, (codes, offsets), masks, _ = batch
+    with torch.no_grad():
+        return model(x, codes, offsets, masks)
+
+def max_probability_delta(reference, probs):
+    return float(np.max(np.abs(np.asarray(reference) - np.asarray(probs)))) if len(probs) else 0.0
@@ -0,0 +1,225 @@
+# Opt-in instrumentation of the preprocessing scripts and the training loops. Nothing is recorded until enable() is
+# called (preprocess_mp.py and events_to_list.py call it with --trace), and stage() is a no-op context until then.
+#
+# Every stage records its wall time, CPU time (user + system of the process) and memory:
+#   rss_mb            - resident memory at the end of the stage
+#   peak_rss_mb       - peak resident memory during the stage. On Linux the peak is reset at the start of every stage
+#                       through /proc/self/clear_refs; elsewhere it is the peak of the process so far
+#   tracemalloc_peak_mb - peak memory allocated by Python during the stage, with enable(memory=True) only, as
+#                       tracemalloc slows down allocation-heavy code several times
+# Stages may be nested; the peaks of a stage include those of the stages within it. annotate() adds attributes to the
+# record of the innermost open stage, such as the frame_mb size of the frame a section of preprocess_mp.py leaves.
+#
+# Stages run once per batch, such as the forward pass in training.run_epoch, are recorded with aggregate=True: their
+# wall and CPU times are summed per name into phases, without memory, which would cost more than the phase itself.
+# With enable(torch_profile_dir=...), every training and validation epoch also runs under torch.profiler, whose
+# Chrome traces are written to that directory.
+#
+# save() writes the stages and phases to a json trace:
+#   {"stages": [{"name", "start", "wall", "cpu", "rss_mb", "peak_rss_mb", "tracemalloc_peak_mb", ...}],
+#    "phases": {name: {"count", "wall", "cpu"}}}
+
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from functools import partial
+
+_tracer = None
+
+def _rss_mb():
+    # resident and peak resident memory of the process
+    try:
+        with open('/proc/self/status') as f:
+            status = dict(line.split(':', 1) for line in f)
+        return int(status['VmRSS'].split()[0]) / 1e3, int(status['VmHWM'].split()[0]) / 1e3
+    except (OSError, KeyError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1e6 if sys.platform == 'darwin' else 1e3)
+        return float('nan'), peak
+
+def _reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+class Tracer:
+
+    def __init__(self, memory=False, torch_profile_dir=None):
+        self.memory = memory
+        self.torch_profile_dir = torch_profile_dir
+        self.start_time = time.perf_counter()
+        self.records = []
+        self.phases = {}
+        # peaks and attributes of the open stages, innermost last
+        self.open_stages = []
+        self.open_attrs = []
+        self.num_profiles = 0
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def peaks(self):
+        _, peak_rss = _rss_mb()
+        return peak_rss, tracemalloc.get_traced_memory()[1] / 1e6 if self.memory else float('nan')
+
+    @contextmanager
+    def stage(self, name, **attrs):
+        if self.open_stages:
+            # the peaks of the enclosing stage so far, before they are reset for this one
+            outer = self.open_stages[-1]
+            outer[:] = [max(a, b) for a, b in zip(outer, self.peaks())]
+        _reset_peak_rss()
+        if self.memory:
+            tracemalloc.reset_peak()
+        self.open_stages.append([0.0, 0.0])
+        self.open_attrs.append(dict(attrs))
+        start_time, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - start_time, time.process_time() - start_cpu
+            peak_rss, peak_traced = [max(a, b) for a, b in zip(self.open_stages.pop(), self.peaks())]
+            attrs = self.open_attrs.pop()
+            if self.open_stages:
+                outer = self.open_stages[-1]
+                outer[:] = [max(a, b) for a, b in zip(outer, (peak_rss, peak_traced))]
+            self.records.append(dict(name=name, start=start_time - self.start_time, wall=wall, cpu=cpu,
+                                     rss_mb=_rss_mb()[0], peak_rss_mb=peak_rss,
+                                     tracemalloc_peak_mb=peak_traced if self.memory else None, **attrs))
+
+    @contextmanager
+    def phase(self, name):
+        start_time, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            totals = self.phases.setdefault(name, {'count': 0, 'wall': 0.0, 'cpu': 0.0})
+            totals['count'] += 1
+            totals['wall'] += time.perf_counter() - start_time
+            totals['cpu'] += time.process_time() - start_cpu
+
+    def merge(self, trace):
+        # adds the stages and phases of a trace recorded by another process, such as a fold process of training.kfold
+        self.records.extend(trace['stages'])
+        for name, totals in trace['phases'].items():
+            merged = self.phases.setdefault(name, {'count': 0, 'wall': 0.0, 'cpu': 0.0})
+            for key in merged:
+                merged[key] += totals[key]
+
+    def trace(self):
+        return {'stages': self.records, 'phases': self.phases}
+
+def enable(memory=False, torch_profile_dir=None):
+    # Starts recording. memory=True also traces Python allocations with tracemalloc
+    global _tracer
+    _tracer = Tracer(memory, torch_profile_dir)
+    return _tracer
+
+def enabled():
+    return _tracer is not None
+
+def settings():
+    # the arguments of enable, or None if not recording, for spawned processes to record the same way
+    if _tracer is None:
+        return None
+    return {'memory': _tracer.memory, 'torch_profile_dir': _tracer.torch_profile_dir}
+
+def disable():
+    global _tracer
+    if _tracer is not None and _tracer.memory:
+        tracemalloc.stop()
+    _tracer = None
+
+def stage(name, aggregate=False, **attrs):
+    # Context recording a stage, or with aggregate=True adding to the totals of the phase name. Extra keyword
+    # arguments, such as the fold and epoch, are stored with the record of a stage
+    if _tracer is None:
+        return nullcontext()
+    if aggregate:
+        return _tracer.phase(name)
+    return _tracer.stage(name, **attrs)
+
+def annotate(**attrs):
+    # adds attributes, such as the size of the data a stage produced, to the record of the innermost open stage
+    if _tracer is not None and _tracer.open_attrs:
+        _tracer.open_attrs[-1].update(attrs)
+
+def iterate(iterable, name):
+    # Yields the items of iterable, adding the time spent waiting for each of them to the phase name
+    if _tracer is None:
+        yield from iterable
+        return
+    iterator = iter(iterable)
+    while True:
+        with _tracer.phase(name):
+            item = next(iterator, StopIteration)
+        if item is StopIteration:
+            return
+        yield item
+
+def _traced_call(function, name, *args, **kwargs):
+    with stage(name, aggregate=True):
+        return function(*args, **kwargs)
+
+def traced(function, name):
+    # function, with its calls added to the phase name while recording. Stays picklable for DataLoader workers,
+    # whose calls are recorded by the tracer of the worker process and not returned to the main process
+    return partial(_traced_call, function, name)
+
+@contextmanager
+def torch_profile(name):
+    # Runs the enclosed code under torch.profiler when enabled with a torch_profile_dir, and writes its Chrome trace
+    # there as <name>-<pid>-<n>.json
+    if _tracer is None or _tracer.torch_profile_dir is None:
+        yield
+        return
+    import torch.profiler
+    os.makedirs(_tracer.torch_profile_dir, exist_ok=True)
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=_tracer.memory) as profiler:
+        yield
+    _tracer.num_profiles += 1
+    profiler.export_chrome_trace(os.path.join(_tracer.torch_profile_dir,
+                                              '{}-{}-{}.json'.format(name, os.getpid(), _tracer.num_profiles)))
+
+def record_function(name):
+    # labels the enclosed code in the torch.profiler trace
+    if _tracer is None or _tracer.torch_profile_dir is None:
+        return nullcontext()
+    import torch.profiler
+    return torch.profiler.record_function(name)
+
+def trace():
+    return _tracer.trace() if _tracer is not None else {'stages': [], 'phases': {}}
+
+def take_trace():
+    # the trace so far, after which recording starts over, for fold processes that return theirs to the parent
+    if _tracer is None:
+        return None
+    recorded = _tracer.trace()
+    _tracer.records, _tracer.phases = [], {}
+    return recorded
+
+def merge(recorded):
+    if _tracer is not None and recorded is not None:
+        _tracer.merge(recorded)
+
+def summary():
+    # one line per stage and phase
+    lines = []
+    for record in trace()['stages']:
+        lines.append('{:<40}{:9.3f}s wall {:9.3f}s cpu {:8.0f} MB peak RSS{}{}'.format(
+            record['name'], record['wall'], record['cpu'], record['peak_rss_mb'],
+            '' if record['tracemalloc_peak_mb'] is None else ' {:8.1f} MB traced'.format(record['tracemalloc_peak_mb']),
+            '' if 'frame_mb' not in record else ' {:8.1f} MB frame'.format(record['frame_mb'])))
+    for name, totals in trace()['phases'].items():
+        lines.append('{:<40}{:9.3f}s wall {:9.3f}s cpu {:8d} calls'.format(name, totals['wall'], totals['cpu'],
+                                                                         totals['count']))
+    return '\n'.join(lines)
+
+def save(path):
+    with open(path, 'w') as f:
+        json.dump(trace(), f, indent=1)
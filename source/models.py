@@ -0,0 +1,184 @@
+import math
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.utils.rnn import PackedSequence, pad_packed_sequence
+
+# The ICD-9 codes of a batch arrive from dataloader.collate_fn as (codes, offsets) bags. A linear layer over the
+# one-hot codes is the sum of the weight rows of the active codes, so it is computed with an nn.EmbeddingBag
+# in 'sum' mode instead of a matmul over the mostly zero one-hot matrix. sparse_grad=True makes the bag weights
+# receive sparse gradients holding only the rows of the codes in the batch, which training.adam steps with
+# torch.optim.SparseAdam.
+#
+# x is either the padded (batch, hours, ...) tensor of every stay or, with dataloader.load_data(packed=True), a
+# PackedSequence of only the real hours of every stay, so the LSTMs don't run over the hours repeated as padding.
+
+def init_linear_(params, fan_in):
+    # nn.Linear initialization of parameters that together form one linear layer with fan_in inputs
+    bound = 1 / math.sqrt(fan_in)
+    for param in params:
+        nn.init.uniform_(param, -bound, bound)
+
+def run_lstm(lstm, x, min_length=0):
+    # Output of a batch_first lstm over a padded tensor or a PackedSequence. The output of a PackedSequence is padded
+    # with zeros after the real hours of every stay, up to the longest stay of the batch or min_length if longer.
+    # Packed batches of stays of equal length (as batched by dataloader.BucketBatchSampler) hold no padding and are
+    # run unpacked, which is faster on CPU
+    if not isinstance(x, PackedSequence):
+        return lstm(x)[0]
+    length = max(len(x.batch_sizes), min_length)
+    if x.batch_sizes[0] == x.batch_sizes[-1]:
+        x, _ = pad_packed_sequence(x, batch_first=True)
+        x, _ = lstm(x)
+        return F.pad(x, (0, 0, 0, length - x.shape[1]))
+    x, _ = lstm(x)
+    x, _ = pad_packed_sequence(x, batch_first=True, total_length=length)
+    return x
+
+def packed_lengths(x):
+    # the number of real steps of every sequence of a PackedSequence, in the order of the batch: a sequence is as
+    # long as the number of steps whose batch size exceeds its position in the sorted batch
+    lengths = (x.batch_sizes.unsqueeze(1) > torch.arange(int(x.batch_sizes[0]))).sum(0)
+    if x.unsorted_indices is not None:
+        lengths = lengths[x.unsorted_indices.cpu()]
+    return lengths.to(x.data.device)
+
+class LSTMPlusCNN(nn.Module):
+    def __init__(self, input_size, input_len, feature_len, hidden_size, dropout=0.5, sparse_grad=False):
+        super(LSTMPlusCNN, self).__init__()
+        # constructor arguments, saved with the weights by checkpoint.save_checkpoint
+        self.config = dict(input_size=input_size, input_len=input_len, feature_len=feature_len, hidden_size=hidden_size,
+                           dropout=dropout, sparse_grad=sparse_grad)
+        self.lstm = nn.LSTM(input_size,
+                            hidden_size,
+                            num_layers=3,
+                            batch_first=True,
+                            dropout=dropout, # dropout percentage not specified in paper
+                            bidirectional=True)
+        self.bn = nn.BatchNorm1d(2*hidden_size)
+        self.cnn = nn.Conv1d(in_channels=2*hidden_size,
+                             out_channels=3, # paper refers to "No of filters: n"
+                             kernel_size=3)
+        self.relu = nn.ReLU()
+        self.input_len = input_len
+        # both the padded and the packed path (see packed_features) give the CNN output of input_len hours, which
+        # pools to (input_len - 2)//2 steps whether input_len is even or odd
+        self.pool = nn.MaxPool1d(2)
+        linear_features = 3*((input_len - 2)//2)
+        # fc and icd9 together are the linear layer over the CNN output concatenated with the one-hot ICD-9 codes
+        self.fc = nn.Linear(in_features=linear_features,
+                            out_features=2)
+        self.icd9 = nn.EmbeddingBag(feature_len, 2, mode='sum', sparse=sparse_grad)
+        init_linear_([*self.fc.parameters(), self.icd9.weight], linear_features + feature_len)
+        self.softmax = nn.Softmax(dim=1)
+    def forward(self, x, feats, masks):
+        if isinstance(x, PackedSequence):
+            x = self.packed_features(x)
+        else:
+            batch_size, seq_len = x.shape[:2]
+            x = torch.reshape(x, (batch_size, seq_len, -1))
+            masks = torch.reshape(masks, (batch_size, seq_len, -1))
+            x, _ = self.lstm(x)
+            x = torch.movedim(x, 1, 2) # (N,L,C) -> (N,C,L)
+            x = self.bn(x)
+            x = self.cnn(x)
+            x = self.relu(x)
+        x = self.pool(x)
+        x = torch.flatten(x, start_dim=1)
+        codes, offsets = feats
+        x = self.fc(x) + self.icd9(codes, offsets)
+        out = self.softmax(x) # (N,C*L) -> (N,2)
+        return out
+    def packed_features(self, x):
+        # The CNN output of a PackedSequence computed from the real hours of every stay only, so that the output of a
+        # stay doesn't depend on the other stays of its batch: the LSTM output is padded with zeros to input_len
+        # hours, batch norm normalizes by the statistics of the real hours, and the CNN outputs whose kernel reaches
+        # past the real hours of their stay are zeroed, which the max pool over the non-negative ReLU outputs ignores
+        lengths = packed_lengths(x)
+        x = run_lstm(self.lstm, x, min_length=self.input_len)
+        real = torch.arange(x.shape[1], device=x.device) < lengths.unsqueeze(1)
+        normalized = torch.zeros_like(x)
+        normalized[real] = self.bn(x[real])
+        x = self.relu(self.cnn(torch.movedim(normalized, 1, 2)))
+        kernel_size = self.cnn.kernel_size[0]
+        real = torch.arange(x.shape[2], device=x.device) + kernel_size <= lengths.unsqueeze(1)
+        return x * real.unsqueeze(1)
+
+class ReadmissionLSTM(nn.Module):
+    def __init__(self, input_size, input_len, hidden_size, dropout=0.5):
+        super(ReadmissionLSTM, self).__init__()
+        self.config = dict(input_size=input_size, input_len=input_len, hidden_size=hidden_size, dropout=dropout)
+        self.lstm = nn.LSTM(input_size,
+                            hidden_size,
+                            num_layers=3,
+                            batch_first=True,
+                            dropout=dropout,
+                            bidirectional=True)
+        self.input_len = input_len
+        self.fc = nn.Linear(2* input_len * hidden_size, 2)
+        self.softmax = nn.Softmax(dim=1)
+    def forward(self, x, masks):
+        if isinstance(x, PackedSequence):
+            x = run_lstm(self.lstm, x, min_length=self.input_len) # zeros after the real hours
+        else:
+            batch_size, seq_len = x.shape[:2]
+            x = torch.reshape(x, (batch_size, seq_len, -1))
+            masks = torch.reshape(masks, (batch_size, seq_len, -1))
+            x, _ = self.lstm(x)
+        x = torch.flatten(x, start_dim=1)
+        x = self.fc(x)
+        out = self.softmax(x)
+        return out
+
+class StreamingLSTM(nn.Module):
+    # Unidirectional counterpart of ReadmissionLSTM and LSTMPlusCNN for scoring stays hour by hour (see streaming.py).
+    # The probability of readmission after an hour depends only on the hours up to it, through the hidden state of
+    # the last LSTM layer, so a new hour is scored with one step of the LSTM from the state of the hour before. The
+    # ICD-9 codes of a stay enter the output layer as in LSTMPlusCNN.
+    # Trained on padded batches, the output is the one after the last of the input_len hours; on packed batches, the
+    # one after the last real hour of every stay
+    def __init__(self, input_size, feature_len, hidden_size, num_layers=3, dropout=0.5):
+        super(StreamingLSTM, self).__init__()
+        self.config = dict(input_size=input_size, feature_len=feature_len, hidden_size=hidden_size,
+                           num_layers=num_layers, dropout=dropout)
+        self.lstm = nn.LSTM(input_size,
+                            hidden_size,
+                            num_layers=num_layers,
+                            batch_first=True,
+                            dropout=dropout)
+        # fc and icd9 together are the linear layer over the last hidden state concatenated with the one-hot codes
+        self.fc = nn.Linear(hidden_size, 2)
+        self.icd9 = nn.EmbeddingBag(feature_len, 2, mode='sum')
+        init_linear_([*self.fc.parameters(), self.icd9.weight], hidden_size + feature_len)
+        self.softmax = nn.Softmax(dim=1)
+    def code_logits(self, feats):
+        # the part of the output the ICD-9 codes contribute, which is the same for every hour of a stay
+        codes, offsets = feats
+        return self.icd9(codes, offsets)
+    def output(self, hidden, code_logits):
+        return self.softmax(self.fc(hidden) + code_logits)
+    def step(self, x, state, code_logits):
+        # Scores one new hour x (batch, ...) of a batch of stays from the (h, c) LSTM state after their hours
+        # before (None for the first hour). Returns the probabilities and the state after the new hour
+        x, state = self.lstm(torch.reshape(x, (len(x), 1, -1)), state)
+        return self.output(x[:, -1], code_logits), state
+    def forward(self, x, feats, masks):
+        if not isinstance(x, PackedSequence):
+            x = torch.reshape(x, (*x.shape[:2], -1))
+        # the hidden state after the last hour of every stay, real or padded, in the order of the batch
+        _, (hidden, _) = self.lstm(x)
+        return self.output(hidden[-1], self.code_logits(feats))
+
+class LogisticRegression(nn.Module):
+    def __init__(self, feature_size, sparse_grad=False):
+        super(LogisticRegression, self).__init__()
+        self.config = dict(feature_size=feature_size, sparse_grad=sparse_grad)
+        # linear layer over the one-hot ICD-9 codes, split into the code weights and the bias
+        self.fc = nn.EmbeddingBag(feature_size, 1, mode='sum', sparse=sparse_grad)
+        self.bias = nn.Parameter(torch.empty(1))
+        init_linear_([self.fc.weight, self.bias], feature_size)
+        self.sigmoid = nn.Sigmoid()
+    def forward(self, feats):
+        codes, offsets = feats
+        out = self.sigmoid(self.fc(codes, offsets) + self.bias)
+        return out
@@ -0,0 +1,111 @@
+# Hour-by-hour readmission risk of ICU stays in progress, with a StreamingLSTM (see models.py).
+#
+# A SessionStore holds the LSTM state of every open stay, so a new hour of a stay is scored with one LSTM step
+# instead of rerunning the model over the whole window: the cost of an update does not grow with the hours the
+# stay has had. The states of all stays live in preallocated (layers, slots, hidden) tensors, and the stays updated
+# together are gathered from and scattered back to their slots, so a batch of stays is one LSTM step whatever the
+# number of open stays. Freed slots are reused and the tensors double when full.
+#
+# The hours are encoded as the collate function of the model's encoding encodes every hour of a stay in training
+# (see encode_hours). After the input_len hours of the training window, a stay keeps being scored from its state.
+
+import numpy as np
+import torch
+
+from checkpoint import load_checkpoint
+from dataloader import ENCODINGS, clip_events
+
+def encode_hours(hours, dims, encoding='events'):
+    # Encodes one hour of each of a number of stays, given as (values, counts) pairs of the event values of the hour
+    # in category order and the number of events of every category, as dataloader.ENCODINGS[encoding] encodes the
+    # hours of a stay. Events beyond the max_num_events of dims are dropped. Returns a (stays, categories, ...) tensor
+    _, _, num_categories, max_num_events = dims
+    data = []
+    for values, counts in hours:
+        values = np.asarray(values, dtype=np.float32)
+        counts = np.asarray(counts, dtype=np.int32).reshape(1, 1, num_categories)
+        if encoding == 'events':
+            values, counts, _ = clip_events(values, counts, max_num_events)
+        data.append(((values, counts[0]), [], 0))
+    x, _, _, _ = ENCODINGS[encoding](data, (len(data), 1, num_categories, max_num_events))
+    return x[:, 0]
+
+class SessionStore:
+    # LSTM states, ICD-9 code logits and latest probabilities of the open stays, by stay id
+
+    def __init__(self, model, dims, encoding='events', capacity=1024):
+        self.model = model.eval()
+        self.dims = dims
+        self.encoding = encoding
+        num_layers, hidden_size = model.lstm.num_layers, model.lstm.hidden_size
+        self.h = torch.zeros(num_layers, capacity, hidden_size)
+        self.c = torch.zeros(num_layers, capacity, hidden_size)
+        self.code_logits = torch.zeros(capacity, 2)
+        # hours scored and latest probability of the stay in every slot
+        self.hours = np.zeros(capacity, dtype=np.int32)
+        self.probabilities = np.full(capacity, np.nan, dtype=np.float32)
+        self.slots = {}
+        self.free = list(range(capacity - 1, -1, -1))
+
+    @classmethod
+    def from_checkpoint(cls, path, capacity=1024):
+        model, checkpoint = load_checkpoint(path)
+        return cls(model, tuple(checkpoint['dims']), checkpoint['encoding'], capacity)
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, stay_id):
+        return stay_id in self.slots
+
+    def grow(self):
+        capacity = self.h.shape[1]
+        self.h = torch.cat([self.h, torch.zeros_like(self.h)], dim=1)
+        self.c = torch.cat([self.c, torch.zeros_like(self.c)], dim=1)
+        self.code_logits = torch.cat([self.code_logits, torch.zeros_like(self.code_logits)])
+        self.hours = np.concatenate([self.hours, np.zeros_like(self.hours)])
+        self.probabilities = np.concatenate([self.probabilities, np.full_like(self.probabilities, np.nan)])
+        self.free = list(range(2 * capacity - 1, capacity - 1, -1)) + self.free
+
+    def open(self, stay_id, codes=()):
+        # Starts a stay with the vocabulary indices of its ICD-9 codes, before its first hour
+        if stay_id in self.slots:
+            raise KeyError('stay {} is already open'.format(stay_id))
+        if not self.free:
+            self.grow()
+        slot = self.free.pop()
+        self.slots[stay_id] = slot
+        self.h[:, slot] = 0
+        self.c[:, slot] = 0
+        self.hours[slot] = 0
+        self.probabilities[slot] = np.nan
+        with torch.no_grad():
+            codes = torch.tensor(np.asarray(codes, dtype=np.int64).reshape(-1))
+            self.code_logits[slot] = self.model.code_logits((codes, torch.zeros(1, dtype=torch.long)))[0]
+
+    def close(self, stay_id):
+        # Ends a stay and returns its latest probability
+        slot = self.slots.pop(stay_id)
+        self.free.append(slot)
+        return float(self.probabilities[slot])
+
+    def update(self, stay_ids, x):
+        # Scores the next hour of every stay of stay_ids, given encoded as x (stays, categories, ...) in the same
+        # order (see encode_hours). A stay may appear once per call. Returns their probabilities of readmission
+        slots = torch.tensor([self.slots[stay_id] for stay_id in stay_ids], dtype=torch.long)
+        with torch.no_grad():
+            probs, (h, c) = self.model.step(x, (self.h[:, slots], self.c[:, slots]), self.code_logits[slots])
+        self.h[:, slots] = h
+        self.c[:, slots] = c
+        probs = probs[:, -1].numpy()
+        self.hours[slots.numpy()] += 1
+        self.probabilities[slots.numpy()] = probs
+        return probs
+
+    def update_events(self, stay_ids, hours):
+        # update with the hours given as (values, counts) pairs, see encode_hours
+        return self.update(stay_ids, encode_hours(hours, self.dims, self.encoding))
+
+    def probability(self, stay_id):
+        # latest probability of a stay, nan before its first hour
+        return float(self.probabilities[self.slots[stay_id]])
@@ -0,0 +1,380 @@
+# Training and validation loops shared by the model notebooks, adapted from:
+# https://medium.com/dataseries/k-fold-cross-validation-with-pytorch-and-sklearn-d094aa00105f
+#
+# The loss and confusion counts of an epoch are accumulated in tensors on the model's device, and the confusion counts
+# of a batch are added with a single bincount, so the loops don't wait on the device after every batch; the
+# accumulated values are read once at the end of the epoch.
+#
+# With instrumentation enabled (see instrumentation.py), every epoch is recorded as a stage and the time of its
+# batches is split into the phases <train|valid>.data_wait, .forward, .backward and .optimizer_step; with workers=0
+# the data wait includes collation, which load_data also records on its own as the collate phase.
+#
+# run_epoch(distributed=True) is the epoch of one rank of the data-parallel training of distributed.py: the gradients
+# are averaged over the ranks before every optimizer step and the loss and confusion counts summed over them at the
+# end of the epoch, so every rank steps the same model and returns the metrics of the whole epoch.
+
+import inspect
+import multiprocessing as mp
+import os
+import pickle
+from functools import partial
+
+import numpy as np
+import torch
+import torch.distributed as dist
+from sklearn.model_selection import KFold
+from torch.nn.utils.rnn import PackedSequence
+from torch.utils.data import WeightedRandomSampler
+
+import instrumentation
+from checkpoint import MODELS, save_checkpoint
+from dataloader import input_size, load_data
+from models import LogisticRegression, ReadmissionLSTM
+
+# one record per fold and epoch of kfold; a structured array of these is indexed by metric like the dict of lists
+# the notebooks stored before, e.g. history['test_acc']. The loss is the one the model trains with, which differs
+# between the models (see loss_and_predictions); the nll, the negative log-likelihood of the labels under the
+# predicted probability of readmission, compares across them.
+# version is HISTORY_VERSION. The histories the notebooks pickled before, dicts of lists such as
+# source/lstm_cnn_model_history.pickle, are version 1: their loss is the sum of the mean losses of the batches divided
+# by the number of stays, about 1 / batch_size of the mean loss per stay recorded since, and they have no nll
+HISTORY_VERSION = 2
+HISTORY_DTYPE = np.dtype([
+    ('fold', np.int16), ('epoch', np.int16),
+    ('train_loss', np.float32), ('test_loss', np.float32),
+    ('train_acc', np.float32), ('test_acc', np.float32),
+    ('train_tpr', np.float32), ('test_tpr', np.float32),
+    ('train_fpr', np.float32), ('test_fpr', np.float32),
+    ('train_nll', np.float32), ('test_nll', np.float32),
+    ('version', np.int8),
+])
+
+def model_builder(name, dataset, encoding='events', **kwargs):
+    # A function returning a new model of the class name of checkpoint.MODELS for the dims and ICD-9 codes of dataset
+    # and the input encoding, the build_model of kfold. kwargs are further constructor arguments, such as hidden_size
+    # and dropout. Unlike a lambda, it can be pickled to the fold processes of kfold(workers > 1)
+    dims = {'input_size': input_size(dataset.shape, encoding), 'input_len': dataset.shape[1],
+            'feature_len': dataset.num_codes, 'feature_size': dataset.num_codes}
+    params = inspect.signature(MODELS[name]).parameters
+    return partial(MODELS[name], **{arg: value for arg, value in dims.items() if arg in params}, **kwargs)
+
+def build_model(name, dataset, encoding='events', **kwargs):
+    # a new model, see model_builder
+    return model_builder(name, dataset, encoding, **kwargs)()
+
+class SparseDenseAdam:
+    # Adam over the dense parameters of a model and torch.optim.SparseAdam over the weights of its embedding bags
+    # built with sparse=True (sparse_grad=True of the models), whose sparse gradients Adam rejects
+
+    def __init__(self, dense_params, sparse_params, lr):
+        self.dense = torch.optim.Adam(dense_params, lr=lr)
+        self.sparse = torch.optim.SparseAdam(sparse_params, lr=lr)
+
+    def step(self):
+        self.dense.step()
+        self.sparse.step()
+
+    def zero_grad(self):
+        self.dense.zero_grad()
+        self.sparse.zero_grad()
+
+    def state_dict(self):
+        return {'dense': self.dense.state_dict(), 'sparse': self.sparse.state_dict()}
+
+    def load_state_dict(self, state):
+        self.dense.load_state_dict(state['dense'])
+        self.sparse.load_state_dict(state['sparse'])
+
+def adam(model, lr):
+    # the optimizer every training loop steps model with: Adam, or SparseDenseAdam if model has sparse gradients
+    sparse_params = [module.weight for module in model.modules()
+                     if isinstance(module, (torch.nn.Embedding, torch.nn.EmbeddingBag)) and module.sparse]
+    if not sparse_params:
+        return torch.optim.Adam(model.parameters(), lr=lr)
+    dense_params = [param for param in model.parameters() if all(param is not sparse for sparse in sparse_params)]
+    return SparseDenseAdam(dense_params, sparse_params, lr)
+
+def criterion_for(model):
+    # the loss the notebooks train each model with, see loss_and_predictions
+    return torch.nn.BCELoss() if isinstance(model, LogisticRegression) else torch.nn.CrossEntropyLoss()
+
+def model_output(model, x, feats, masks):
+    # the inputs each model takes from a batch of dataloader.collate_fn
+    if isinstance(model, LogisticRegression):
+        return model(feats)
+    if isinstance(model, ReadmissionLSTM):
+        return model(x, masks)
+    return model(x, feats, masks)
+
+def loss_and_predictions(y_hat, y, criterion):
+    # LogisticRegression outputs the probability of readmission as one column and is trained with nn.BCELoss,
+    # the LSTMs output the probabilities of both classes
+    if y_hat.shape[1] == 1:
+        return criterion(y_hat, y.unsqueeze(1).float()), torch.round(y_hat.detach()).squeeze(1).long()
+    return criterion(y_hat, y), torch.argmax(y_hat.detach(), dim=1)
+
+def nll_sum(y_hat, y):
+    # Summed negative log-likelihood of the labels y under the probability of readmission y_hat[:, -1], the last
+    # column of every model's output. Unlike the losses of loss_and_predictions, which apply nn.CrossEntropyLoss to
+    # the probabilities the LSTMs output, it is the same measure for every model. The logs are clamped as in
+    # nn.BCELoss, so it equals the loss of LogisticRegression
+    return torch.nn.functional.binary_cross_entropy(y_hat.detach()[:, -1], y.to(y_hat.dtype), reduction='sum')
+
+def to_device(batch, device, non_blocking=False):
+    x, (codes, offsets), masks, y = batch
+    return (x.to(device, non_blocking=non_blocking),
+            (codes.to(device, non_blocking=non_blocking), offsets.to(device, non_blocking=non_blocking)),
+            masks.to(device, non_blocking=non_blocking), y.to(device, non_blocking=non_blocking))
+
+def batch_tensors(batch):
+    x, (codes, offsets), masks, y = batch
+    xs = [tensor for tensor in x if tensor is not None] if isinstance(x, PackedSequence) else [x]
+    return xs + [codes, offsets, masks, y]
+
+def device_batches(batches, device):
+    # Yields the batches moved to device. On a GPU the next batch is prefetched: it is copied on a side stream while
+    # the current one is computed, which overlaps the copies with the model when the loader pins its batches (see
+    # dataloader.load_data). On CPU the batches are yielded as the loader collated them; there is no copy to overlap
+    if device.type != 'cuda':
+        for batch in batches:
+            yield to_device(batch, device)
+        return
+    stream = torch.cuda.Stream(device)
+    pending = None
+    for batch in batches:
+        with torch.cuda.stream(stream):
+            batch = to_device(batch, device, non_blocking=True)
+        copied = stream.record_event()
+        if pending is not None:
+            yield pending
+        torch.cuda.current_stream(device).wait_event(copied)
+        for tensor in batch_tensors(batch):
+            # the memory of the batch must not be reused by the side stream while the model still reads it
+            tensor.record_stream(torch.cuda.current_stream(device))
+        pending = batch
+    if pending is not None:
+        yield pending
+
+def epoch_metrics(totals):
+    # loss and nll per stay, accuracy in percent, TPR and FPR from the [loss sum, nll sum, tn, fp, fn, tp] totals of
+    # an epoch
+    loss_sum, nll, true_neg, false_pos, false_neg, true_pos = totals
+    num_samples = true_neg + false_pos + false_neg + true_pos
+    return {
+        'loss': loss_sum / num_samples,
+        'nll': nll / num_samples,
+        'acc': (true_pos + true_neg) / num_samples * 100,
+        'tpr': true_pos / (true_pos + false_neg) if true_pos + false_neg else float('nan'),
+        'fpr': false_pos / (false_pos + true_neg) if false_pos + true_neg else float('nan'),
+    }
+
+def all_reduce_gradients(model):
+    # Averages the gradients of model over the ranks of torch.distributed in a single all-reduce of all gradients
+    # flattened into one buffer. Parameters without a gradient take part with zeros, as every rank must reduce a
+    # buffer of the same size
+    params = [param for param in model.parameters() if param.requires_grad]
+    flat = torch.cat([(param.grad if param.grad is not None else torch.zeros_like(param)).reshape(-1)
+                      for param in params])
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+    for param, grad in zip(params, flat.split([param.numel() for param in params])):
+        param.grad = grad.view_as(param)
+
+def run_epoch(model, dataloader, criterion, optimizer=None, accumulation_steps=1, distributed=False):
+    # Trains model for an epoch of dataloader when an optimizer is given, otherwise validates it. With
+    # accumulation_steps > 1, the gradients of that many batches are averaged before every optimizer step; the last
+    # group of an epoch may hold fewer batches and is averaged over those.
+    # distributed=True averages the gradients and sums the metrics over the ranks of torch.distributed, whose
+    # dataloaders must all yield the same number of batches
+    device = next(model.parameters()).device
+    loss_sum = torch.zeros((), dtype=torch.float64, device=device)
+    nll = torch.zeros((), dtype=torch.float64, device=device)
+    # counts of the true label * 2 + the predicted label: true negatives, false positives, false negatives, true positives
+    confusion = torch.zeros(4, dtype=torch.long, device=device)
+
+    training = optimizer is not None
+    model.train(training)
+    if training:
+        optimizer.zero_grad()
+        num_batches = len(dataloader)
+
+    phase = 'train' if training else 'valid'
+    stage = instrumentation.stage
+    step = -1
+    with torch.set_grad_enabled(training), instrumentation.torch_profile(phase):
+        for step, (x, feats, masks, y) in enumerate(instrumentation.iterate(device_batches(dataloader, device),
+                                                                              phase + '.data_wait')):
+            with stage(phase + '.forward', aggregate=True), instrumentation.record_function('forward'):
+                y_hat = model_output(model, x, feats, masks)
+                loss, y_pred = loss_and_predictions(y_hat, y, criterion)
+            if training:
+                group_start = step - step % accumulation_steps
+                group_size = min(accumulation_steps, num_batches - group_start)
+                with stage('train.backward', aggregate=True), instrumentation.record_function('backward'):
+                    (loss / group_size).backward()
+                if step + 1 == group_start + group_size:
+                    if distributed:
+                        with stage('train.all_reduce', aggregate=True), instrumentation.record_function('all_reduce'):
+                            all_reduce_gradients(model)
+                    with stage('train.optimizer_step', aggregate=True), instrumentation.record_function('optimizer_step'):
+                        optimizer.step()
+                        optimizer.zero_grad()
+
+            loss_sum += loss.detach() * len(y)
+            nll += nll_sum(y_hat, y)
+            confusion += torch.bincount(y * 2 + y_pred, minlength=4)
+
+    # the only synchronization of the epoch, apart from the all-reduces of distributed training
+    totals = torch.cat([loss_sum.view(1), nll.view(1), confusion.double()])
+    if distributed:
+        dist.all_reduce(totals)
+    return epoch_metrics(totals.tolist())
+
+def train_epoch(model, train_dataloader, optimizer, criterion, accumulation_steps=1):
+    return run_epoch(model, train_dataloader, criterion, optimizer, accumulation_steps)
+
+def valid_epoch(model, valid_dataloader, criterion):
+    return run_epoch(model, valid_dataloader, criterion)
+
+def subset_weighted_random_sampler(dataset, idx, sample="over"):
+    # Draws the stays of idx with both labels equally likely: "over" draws twice the number of negative stays,
+    # "under" as many as there are negative stays and anything else as many as there are stays in idx
+    labels = torch.as_tensor(np.asarray(dataset.y))
+    subset_labels = labels[idx]
+    majority_len = int((subset_labels == 0).sum())
+    minority_len = int((subset_labels == 1).sum())
+    if sample == "over":
+        sample_size = 2 * majority_len
+    elif sample == "under":
+        sample_size = majority_len
+    else:
+        sample_size = len(idx)
+
+    weights = torch.zeros(len(labels))
+    weights[idx] = 1
+    weights[labels == 1] = weights[labels == 1] * (0.5 / minority_len)
+    weights[labels == 0] = weights[labels == 0] * (0.5 / majority_len)
+
+    return WeightedRandomSampler(weights, num_samples=sample_size, replacement=True)
+
+def record_epoch(record, fold, epoch, train, test):
+    # fills a HISTORY_DTYPE record with the train and test metrics of an epoch
+    record['fold'], record['epoch'], record['version'] = fold, epoch, HISTORY_VERSION
+    for name in ('loss', 'acc', 'tpr', 'fpr', 'nll'):
+        record['train_' + name], record['test_' + name] = train[name], test[name]
+
+def print_epoch(epoch, n_epochs, train, test):
+    print("Epoch:{}/{} AVG Training Loss:{:.3f} AVG Test Loss:{:.3f} AVG Training Acc {:.2f} % AVG Test Acc {:.2f} %".format(epoch + 1, n_epochs, train['loss'], test['loss'], train['acc'], test['acc']))
+    print("Epoch:{}/{} AVG Training TPR:{:.3f} AVG Test TPR:{:.3f} AVG Training FPR:{:.3f} AVG Test FPR:{:.3f}".format(epoch + 1, n_epochs, train['tpr'], test['tpr'], train['fpr'], test['fpr']))
+
+def train_fold(build_model, dataset, criterion, fold, train_idx, val_idx, n_epochs=10, batch_size=64, lr=0.002,
+               accumulation_steps=1, sample="over", verbose=True, checkpoint_dir=None, **loader_kwargs):
+    # Trains a model of build_model() on the stays of train_idx and validates it on those of val_idx after every
+    # epoch. Returns a HISTORY_DTYPE record per epoch. With a checkpoint_dir, the trained model is saved there as
+    # fold-<fold>.pt (see checkpoint.py)
+    history = np.zeros(n_epochs, dtype=HISTORY_DTYPE)
+    if verbose:
+        print('Fold {}'.format(fold + 1))
+
+    train_sampler = subset_weighted_random_sampler(dataset, train_idx, sample)
+    test_sampler = subset_weighted_random_sampler(dataset, val_idx, sample)
+    train_loader, test_loader = load_data(train_sampler, test_sampler, batch_size=batch_size, dataset=dataset,
+                                          **loader_kwargs)
+
+    model = build_model()
+    optimizer = adam(model, lr)
+
+    for epoch in range(n_epochs):
+        with instrumentation.stage('train_epoch', fold=fold, epoch=epoch):
+            train = train_epoch(model, train_loader, optimizer, criterion, accumulation_steps)
+        with instrumentation.stage('valid_epoch', fold=fold, epoch=epoch):
+            test = valid_epoch(model, test_loader, criterion)
+
+        record_epoch(history[epoch], fold, epoch, train, test)
+        if verbose:
+            print_epoch(epoch, n_epochs, train, test)
+
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        save_checkpoint(os.path.join(checkpoint_dir, 'fold-{}.pt'.format(fold + 1)), model, dataset,
+                        loader_kwargs.get('encoding', 'events'), loader_kwargs.get('packed', False), val_idx)
+
+    return history
+
+# what the fold processes of kfold need, set by their initializer
+_fold_context = {}
+
+def cpu_slices(num_workers):
+    # the CPUs this process may run on split into num_workers slices, or one CPU per worker if there are fewer CPUs
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    if num_workers >= len(cpus):
+        return [[cpus[i % len(cpus)]] for i in range(num_workers)]
+    return [cpu_slice.tolist() for cpu_slice in np.array_split(cpus, num_workers)]
+
+def init_fold_worker(worker_ids, slices):
+    # every fold process takes the next CPU slice and runs torch on as many threads as the slice has CPUs
+    with worker_ids.get_lock():
+        cpus = slices[worker_ids.value % len(slices)]
+        worker_ids.value += 1
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(len(cpus))
+
+def init_fold_process(worker_ids, slices, context, tracing):
+    # Initializer of the spawned fold processes of kfold: pins the process to its CPU slice before it runs any torch op,
+    # records a trace if the parent does, and keeps context, whose dataset is unpickled from its shared stores
+    init_fold_worker(worker_ids, slices)
+    if tracing is not None:
+        instrumentation.enable(**tracing)
+    _fold_context.update(context)
+
+def run_fold(fold, train_idx, val_idx):
+    context = _fold_context
+    torch.manual_seed(context['seed'] + fold)
+    history = train_fold(context['build_model'], context['dataset'], context['criterion'], fold, train_idx, val_idx,
+                         **context['kwargs'])
+    return history, instrumentation.take_trace()
+
+def kfold(build_model, dataset, criterion, k_folds=5, n_epochs=10, batch_size=64, lr=0.002, accumulation_steps=1,
+          sample="over", verbose=True, workers=1, checkpoint_dir=None, **loader_kwargs):
+    # k-fold cross-validation of the models build_model() returns, one per fold, trained with Adam. loader_kwargs
+    # are passed on to dataloader.load_data (encoding, packed, bucketing, num_workers, prefetch_factor). Returns a
+    # HISTORY_DTYPE record per fold and epoch.
+    # With workers > 1 the folds run in that many processes at a time, each pinned to its own slice of the CPUs with
+    # torch using one thread per CPU of the slice. The processes are spawned rather than forked, as a fork would
+    # inherit the OpenMP thread pool of torch in a state that can hang the fold processes once the parent has run
+    # torch ops. The dataset is moved into shared memory first and pickled to the processes as handles to it, so they
+    # share one copy of it. build_model and criterion are pickled too, so build_model can't be a lambda; use
+    # model_builder. The fold processes cannot start DataLoader workers of their own, so workers > 1 and
+    # num_workers > 0 exclude each other.
+    # With a checkpoint_dir, the model of every fold is saved there (see train_fold)
+    kwargs = dict(n_epochs=n_epochs, batch_size=batch_size, lr=lr, accumulation_steps=accumulation_steps,
+                  sample=sample, verbose=verbose, checkpoint_dir=checkpoint_dir, **loader_kwargs)
+    kf = KFold(n_splits=k_folds, shuffle=True)
+    folds = [(fold, train_idx, val_idx) for fold, (train_idx, val_idx) in enumerate(kf.split(np.arange(len(dataset))))]
+
+    if workers > 1 and loader_kwargs.get('num_workers', 0) > 0:
+        raise ValueError('fold processes cannot start DataLoader workers; use either workers or num_workers')
+
+    if workers <= 1:
+        histories = [train_fold(build_model, dataset, criterion, *fold, **kwargs) for fold in folds]
+    else:
+        try:
+            pickle.dumps((build_model, criterion))
+        except (pickle.PicklingError, AttributeError, TypeError) as error:
+            raise ValueError('fold processes need a picklable build_model and criterion, such as '
+                             'training.model_builder(...) instead of a lambda') from error
+        workers = min(workers, k_folds)
+        dataset.share_memory()
+        fold_context = dict(build_model=build_model, dataset=dataset, criterion=criterion, kwargs=kwargs,
+                            seed=int(torch.randint(2**31, ())))
+        context = mp.get_context('spawn')
+        with context.Pool(workers, initializer=init_fold_process,
+                          initargs=(context.Value('i', 0), cpu_slices(workers), fold_context,
+                                    instrumentation.settings())) as pool:
+            results = pool.starmap(run_fold, folds, chunksize=1)
+        histories = [history for history, _ in results]
+        for _, trace in results:
+            instrumentation.merge(trace)
+
+    return np.concatenate(histories)
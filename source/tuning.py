@@ -0,0 +1,205 @@
+# Hyperparameter sweeps over the readmission models with successive halving.
+#
+# A trial is a model class name of checkpoint.MODELS, a sampling mode of training.subset_weighted_random_sampler and
+# values for the model's constructor arguments (hidden_size, dropout) and for lr and batch_size, which grid expands
+# from lists of values. Every trial trains on the same fold of a shuffled k-fold split and is validated on the same
+# stays, drawn class-balanced with the "over" mode whatever the trial samples its training stays with, and drawn the
+# same way every epoch. The trials are compared by their validation NLL, the negative log-likelihood of the labels
+# under the predicted probability of readmission (see training.nll_sum), as the losses the models train with differ:
+# nn.BCELoss for LogisticRegression, nn.CrossEntropyLoss over the softmax output for the LSTMs.
+#
+# Successive halving trains all trials to the first rung of epochs, keeps the 1 / eta of them with the lowest
+# validation NLL, trains those to the next rung, and so on to max_epochs. The dataset is loaded once; with
+# workers > 1 the trials of a rung run at the same time in spawned processes that share it, each on its own slice of
+# the CPUs, as the folds of training.kfold do.
+#
+# After every epoch, a trial saves its model to <sweep_dir>/<trial name>.pt, a checkpoint score.py and export.py take,
+# together with its optimizer state and history. A trial with a checkpoint resumes from it, and a trial that has
+# trained as many epochs as its rung asks for is not trained again, so an interrupted sweep picks up where it stopped
+# when run again with the same sweep_dir. Every epoch seeds torch from the seed, the trial name and the epoch, so a
+# resumed trial draws the same stays it would have drawn if the sweep had not stopped. The pruning decisions are
+# taken again from the checkpointed histories.
+
+import inspect
+import itertools
+import json
+import multiprocessing as mp
+import os
+import zlib
+
+import numpy as np
+import torch
+
+import dataloader
+import instrumentation
+from checkpoint import MODELS, save_checkpoint
+from distributed import DistributedWeightedSampler, split
+from training import (HISTORY_DTYPE, HISTORY_VERSION, adam, build_model, cpu_slices, criterion_for, init_fold_process,
+                      record_epoch, run_epoch, subset_weighted_random_sampler)
+
+# the training settings a trial may set, with the defaults of training.kfold
+TRAINING_PARAMS = {'lr': 0.002, 'batch_size': 64}
+
+
+def trial_name(trial):
+    # a readable name unique to the trial, used as the name of its checkpoint
+    params = ['{}={}'.format(name, trial[name]) for name in sorted(trial) if name not in ('model', 'sample')]
+    return '-'.join([trial['model'], trial['sample'], *params])
+
+def grid(models, samples=('over',), **params):
+    # The trials of every combination of a model, a sampling mode and the values of params, each a list of values of
+    # a constructor argument or of lr or batch_size, keyed by trial name. The arguments a model doesn't take are left
+    # out of its trials
+    trials = {}
+    for model, sample in itertools.product(models, samples):
+        accepted = inspect.signature(MODELS[model]).parameters
+        names = [name for name in params if name in accepted or name in TRAINING_PARAMS]
+        for values in itertools.product(*(params[name] for name in names)):
+            trial = {'model': model, 'sample': sample, **dict(zip(names, values))}
+            trials[trial_name(trial)] = trial
+    return trials
+
+def rungs(min_epochs, max_epochs, eta):
+    # the epochs trials are trained to before each pruning: min_epochs, min_epochs * eta, ... and max_epochs
+    epochs = []
+    while min_epochs < max_epochs:
+        epochs.append(min_epochs)
+        min_epochs *= eta
+    return epochs + [max_epochs]
+
+def trial_seed(seed, name, epoch):
+    return int(np.random.SeedSequence([seed, zlib.crc32(name.encode()), epoch]).generate_state(1)[0])
+
+def validation_nll(history, epochs):
+    # the validation NLL after epochs, with diverged trials last
+    nll = float(history['test_nll'][epochs - 1])
+    return nll if np.isfinite(nll) else float('inf')
+
+def prune(survivors, histories, epochs, eta):
+    # the 1 / eta of the trials survivors with the lowest validation NLL after epochs, and at least one
+    survivors = sorted(survivors, key=lambda name: validation_nll(histories[name], epochs))
+    return survivors[:max(1, len(survivors) // eta)]
+
+
+# what train_trial needs, set by sweep and, in the trial processes, by init_trial_process
+_sweep_context = {}
+
+def init_trial_process(worker_ids, slices, context, tracing):
+    # initializer of the trial processes, which set up their CPU slice, tracing and context as kfold's fold processes
+    init_fold_process(worker_ids, slices, {}, tracing)
+    _sweep_context.update(context)
+
+def train_trial(name, epochs):
+    # Trains the trial name to epochs epochs, from its checkpoint if it has one, and returns its history
+    context = _sweep_context
+    trial, dataset = context['trials'][name], context['dataset']
+    loader_kwargs = context['loader_kwargs']
+    encoding = loader_kwargs.get('encoding', 'events')
+    path = os.path.join(context['sweep_dir'], name + '.pt')
+
+    torch.manual_seed(trial_seed(context['seed'], name, 0))
+    model_kwargs = {arg: value for arg, value in trial.items() if arg not in ('model', 'sample', *TRAINING_PARAMS)}
+    model = build_model(trial['model'], dataset, encoding, **model_kwargs)
+    optimizer = adam(model, trial.get('lr', TRAINING_PARAMS['lr']))
+    history = np.zeros(0, dtype=HISTORY_DTYPE)
+    if os.path.isfile(path):
+        checkpoint = torch.load(path, map_location='cpu', weights_only=True)
+        if checkpoint['trial'] != trial or checkpoint['split'] != context['split']:
+            raise ValueError('{} holds a trial of another sweep; remove it or sweep into another directory'.format(path))
+        # the version is the last field of a history record
+        if any(len(record) != len(HISTORY_DTYPE) or record[-1] != HISTORY_VERSION
+               for record in checkpoint['history']):
+            raise ValueError('{} holds a history of an older format; sweep into another directory'.format(path))
+        model.load_state_dict(checkpoint['state_dict'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        history = np.array([tuple(record) for record in checkpoint['history']], dtype=HISTORY_DTYPE)
+    if len(history) >= epochs:
+        return history
+
+    train_sampler = subset_weighted_random_sampler(dataset, context['train_idx'], trial['sample'])
+    test_sampler = DistributedWeightedSampler.shard(
+        subset_weighted_random_sampler(dataset, context['val_idx'], 'over'), 0, 1, context['seed'])
+    train_loader, test_loader = dataloader.load_data(train_sampler, test_sampler, dataset=dataset,
+                                                     batch_size=trial.get('batch_size', TRAINING_PARAMS['batch_size']),
+                                                     **loader_kwargs)
+    criterion = criterion_for(model)
+
+    start = len(history)
+    history = np.concatenate([history, np.zeros(epochs - start, dtype=HISTORY_DTYPE)])
+    for epoch in range(start, epochs):
+        torch.manual_seed(trial_seed(context['seed'], name, epoch + 1))
+        with instrumentation.stage('train_epoch', trial=name, epoch=epoch):
+            train = run_epoch(model, train_loader, criterion, optimizer)
+        with instrumentation.stage('valid_epoch', trial=name, epoch=epoch):
+            test = run_epoch(model, test_loader, criterion)
+        record_epoch(history[epoch], context['split']['fold'], epoch, train, test)
+        save_checkpoint(path, model, dataset, encoding, loader_kwargs.get('packed', False), context['val_idx'],
+                        trial=trial, split=context['split'], optimizer=optimizer.state_dict(),
+                        history=history[:epoch + 1].tolist())
+    return history
+
+def run_trial(job):
+    # trains the trial of job, a trial name and epochs, in a trial process and returns its trace with its history
+    name, epochs = job
+    return name, train_trial(name, epochs), instrumentation.take_trace()
+
+def sweep(trials, data_dir, sweep_dir, min_epochs=1, max_epochs=9, eta=3, k_folds=5, fold=0, seed=0, workers=1,
+          verbose=True, **loader_kwargs):
+    # Successive halving over trials, a dict of trial name to trial such as grid returns, trained on the dataset of
+    # data_dir and validated on fold of a k-fold split. loader_kwargs are passed on to dataloader.load_data
+    # (encoding, packed, bucketing, num_workers). Returns a dict per trial, best first, with the trial, its history,
+    # the epochs it trained and its last validation NLL, and writes them to <sweep_dir>/results.json.
+    # As in training.kfold, workers > 1 and num_workers > 0 exclude each other
+    if workers > 1 and loader_kwargs.get('num_workers', 0) > 0:
+        raise ValueError('trial processes cannot start DataLoader workers; use either workers or num_workers')
+    os.makedirs(sweep_dir, exist_ok=True)
+    dataset = dataloader.get_dataset(data_dir)
+    train_idx, val_idx = split(len(dataset), k_folds, fold, seed)
+    _sweep_context.update(trials=trials, dataset=dataset, train_idx=train_idx, val_idx=val_idx, seed=seed,
+                          sweep_dir=sweep_dir, loader_kwargs=loader_kwargs,
+                          split={'k_folds': k_folds, 'fold': fold, 'seed': seed, 'stays': len(dataset)})
+
+    histories = {}
+    survivors = list(trials)
+    pool = None
+    try:
+        if workers > 1:
+            dataset.share_memory()
+            context = mp.get_context('spawn')
+            workers = min(workers, len(trials))
+            pool = context.Pool(workers, initializer=init_trial_process,
+                                initargs=(context.Value('i', 0), cpu_slices(workers), dict(_sweep_context),
+                                          instrumentation.settings()))
+        schedule = rungs(min_epochs, max_epochs, eta)
+        for rung, epochs in enumerate(schedule):
+            if verbose:
+                print('Rung {}/{}: {} trials to {} epochs'.format(rung + 1, len(schedule), len(survivors), epochs))
+            jobs = [(name, epochs) for name in survivors]
+            if pool is not None:
+                results = pool.imap_unordered(run_trial, jobs)
+            else:
+                results = ((name, train_trial(name, epochs), None) for name, epochs in jobs)
+            for name, history, trace in results:
+                histories[name] = history
+                if trace is not None:
+                    instrumentation.merge(trace)
+                if verbose:
+                    print('  {:<60} validation NLL {:.4f}'.format(name, validation_nll(history, epochs)))
+            if rung < len(schedule) - 1:
+                survivors = prune(survivors, histories, epochs, eta)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        _sweep_context.clear()
+
+    results = [{'name': name, 'trial': trials[name], 'epochs': len(histories[name]),
+                'val_nll': validation_nll(histories[name], len(histories[name])), 'history': histories[name]}
+               for name in trials]
+    # the trials that trained longest first, then by their last validation NLL
+    results.sort(key=lambda result: (-result['epochs'], result['val_nll']))
+    with open(os.path.join(sweep_dir, 'results.json'), 'w') as f:
+        json.dump([{**result, 'history': {metric: result['history'][metric].tolist()
+                                          for metric in HISTORY_DTYPE.names if metric not in ('fold', 'epoch', 'version')}}
+                   for result in results], f, indent=1)
+    return results
@@ -0,0 +1,63 @@
+# Sweeps the hyperparameters of the readmission models with successive halving (see source/tuning.py): every
+# combination of --models, --samples and the listed values of --hidden-size, --dropout, --lr and --batch-size is a
+# trial, all trials train to --min-epochs, the best 1 / --eta of them by validation NLL go on to --eta times as many
+# epochs, and so on to --max-epochs. --workers trials train at the same time, sharing the dataset.
+#
+# Every trial keeps its checkpoint in --sweep-dir; run the same command again to resume an interrupted sweep. The
+# checkpoints can be scored with score.py, and the trials, their histories and validation NLLs are written to
+# <sweep-dir>/results.json.
+#
+# Usage:
+#   python3 sweep.py --data-dir data --sweep-dir sweeps/lstm-cnn --models LSTMPlusCNN ReadmissionLSTM \
+#       --samples over under --hidden-size 128 256 --lr 0.002 0.0005 --max-epochs 9 --workers 4
+
+import argparse
+import os
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'source'))
+import tuning
+from checkpoint import MODELS
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data-dir', default=os.path.join(ROOT_DIR, 'data'))
+    parser.add_argument('--sweep-dir', required=True, help='directory of the trial checkpoints')
+    parser.add_argument('--models', nargs='+', choices=list(MODELS), default=['LSTMPlusCNN'])
+    parser.add_argument('--samples', nargs='+', default=['over', 'under'],
+                        help='modes of training.subset_weighted_random_sampler')
+    parser.add_argument('--hidden-size', type=int, nargs='+', default=[128])
+    parser.add_argument('--dropout', type=float, nargs='+')
+    parser.add_argument('--lr', type=float, nargs='+')
+    parser.add_argument('--batch-size', type=int, nargs='+')
+    parser.add_argument('--min-epochs', type=int, default=1)
+    parser.add_argument('--max-epochs', type=int, default=9)
+    parser.add_argument('--eta', type=int, default=3, help='1 / eta of the trials go on to the next rung')
+    parser.add_argument('--k-folds', type=int, default=5)
+    parser.add_argument('--fold', type=int, default=0, help='fold of the k-fold split to validate on')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=1, help='trials to train at the same time')
+    parser.add_argument('--encoding', default='events')
+    parser.add_argument('--packed', action='store_true')
+    parser.add_argument('--bucketing', action='store_true')
+    parser.add_argument('--num-workers', type=int, default=0, help='DataLoader workers, with --workers 1')
+    args = parser.parse_args()
+
+    params = {name: values for name, values in (('hidden_size', args.hidden_size), ('dropout', args.dropout),
+                                                 ('lr', args.lr), ('batch_size', args.batch_size)) if values}
+    trials = tuning.grid(args.models, args.samples, **params)
+    print('{} trials, rungs of {} epochs'.format(len(trials), tuning.rungs(args.min_epochs, args.max_epochs, args.eta)))
+
+    start_time = time.perf_counter()
+    results = tuning.sweep(trials, args.data_dir, args.sweep_dir, args.min_epochs, args.max_epochs, args.eta,
+                           args.k_folds, args.fold, args.seed, args.workers, encoding=args.encoding,
+                           packed=args.packed, bucketing=args.bucketing, num_workers=args.num_workers)
+
+    print('\n{:<60}{:>8}{:>18}'.format('trial', 'epochs', 'validation NLL'))
+    for result in results:
+        print('{:<60}{:>8}{:>18.4f}'.format(result['name'], result['epochs'], result['val_nll']))
+    print('\n{:.1f}s, best checkpoint {}'.format(time.perf_counter() - start_time,
+                                                os.path.join(args.sweep_dir, results[0]['name'] + '.pt')))
@@ -0,0 +1,36 @@
+# The tests import the modules of source/, data_cleaning/ and benchmarks/ the way the scripts do, by path.
+# Run them from the repository root with: python3 -m pytest tests
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+for directory in ('benchmarks', 'data_cleaning', 'source'):
+    sys.path.insert(0, os.path.join(ROOT_DIR, directory))
+
+from dataloader import CodeStore, CustomDataset, EventStore
+
+
+def random_events(rng, num_stays, num_hours=8, num_categories=3, max_num_events=3):
+    # nested (stay, hour, category, event) lists of normalized event values, as events_to_list.py used to pickle them
+    return [[[rng.normal(size=rng.integers(0, max_num_events + 1)).tolist() for _ in range(num_categories)]
+             for _ in range(num_hours)] for _ in range(num_stays)]
+
+def random_codes(rng, num_stays, num_codes=10):
+    # one-hot ICD-9 codes of every stay, as icd9_per_icustay.pickle holds them
+    return (rng.random((num_stays, num_codes)) < 0.3).astype(int).tolist()
+
+
+@pytest.fixture
+def nested_data():
+    rng = np.random.default_rng(0)
+    num_stays = 12
+    return random_events(rng, num_stays), random_codes(rng, num_stays), [i % 2 for i in range(num_stays)]
+
+@pytest.fixture
+def dataset(nested_data):
+    events, codes, labels = nested_data
+    return CustomDataset(EventStore.from_lists(events), CodeStore.from_dense(codes), labels)
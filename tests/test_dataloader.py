@@ -0,0 +1,96 @@
+import pickle
+
+import numpy as np
+import pytest
+import torch
+
+import events_to_list
+import preprocess_mp
+from collate_benchmark import dense_codes, loop_collate_fn
+from dataloader import (CodeStore, CustomDataset, EventStore, WithLengths, collate_fn, dense_feats, flatten_events,
+                        packed_collate_fn)
+
+
+def assert_same_stays(expected, actual):
+    assert len(expected) == len(actual)
+    for i in range(len(expected)):
+        for expected_array, actual_array in zip(expected[i], actual[i]):
+            np.testing.assert_array_equal(expected_array, actual_array)
+
+def test_event_store_round_trip(tmp_path, nested_data):
+    events, _, _ = nested_data
+    store = EventStore.from_lists(events)
+    lengths = np.arange(len(events), dtype=np.int32) % store.shape[1] + 1
+    events_to_list.save_event_store(*flatten_events(events), tmp_path / 'events', lengths)
+
+    loaded = EventStore.load(tmp_path / 'events')
+    assert isinstance(loaded.values, np.memmap)
+    assert loaded.shape == store.shape
+    np.testing.assert_array_equal(loaded.lengths, lengths)
+    assert_same_stays(store, loaded)
+    for i, stay in enumerate(events):
+        values, counts = loaded[i]
+        np.testing.assert_array_equal(counts, [[len(category) for category in hour] for hour in stay])
+        np.testing.assert_allclose(values, [value for hour in stay for category in hour for value in category],
+                                   rtol=1e-6)
+
+    # memory-mapped stores pickle as their path, stores in shared memory as their arrays
+    assert_same_stays(loaded, pickle.loads(pickle.dumps(loaded)))
+    assert_same_stays(store, pickle.loads(pickle.dumps(store.share_memory())))
+
+def test_loading_an_event_store_does_not_write_to_it(tmp_path, nested_data):
+    events, _, _ = nested_data
+    store = EventStore.from_lists(events)
+    events_to_list.save_event_store(*flatten_events(events), tmp_path)
+    # a store written before meta.json existed
+    (tmp_path / 'meta.json').unlink()
+    assert EventStore.load(tmp_path).shape == store.shape
+    assert not (tmp_path / 'meta.json').exists()
+
+def test_dataset_needs_a_label_per_stay(tmp_path, nested_data):
+    events, codes, labels = nested_data
+    for name, value in (('events.pickle', events), ('icd9_per_icustay.pickle', codes), ('readmit_labels.pickle', labels)):
+        with open(tmp_path / name, 'wb') as f:
+            pickle.dump(value, f)
+    assert len(CustomDataset.load(tmp_path)) == len(events)
+
+    # a label per chart event, as preprocess_mp.py wrote them before
+    with open(tmp_path / 'readmit_labels.pickle', 'wb') as f:
+        pickle.dump(labels * 3, f)
+    with pytest.raises(ValueError, match='preprocess_mp.py'):
+        CustomDataset.load(tmp_path)
+
+def test_code_store_round_trip(tmp_path, monkeypatch, nested_data):
+    _, codes, _ = nested_data
+    store = CodeStore.from_dense(codes)
+    vocab = ['{:05d}'.format(code) for code in range(store.num_codes)]
+    monkeypatch.chdir(tmp_path)
+    preprocess_mp.save_icd9_codes(store.indices, store.offsets, vocab)
+
+    loaded = CodeStore.load(tmp_path / 'icd9')
+    assert loaded.vocab == vocab and loaded.num_codes == store.num_codes
+    for i, dense in enumerate(codes):
+        np.testing.assert_array_equal(loaded[i], np.flatnonzero(dense))
+        assert dense_codes(loaded[i], loaded.num_codes) == dense
+    for pickled in (pickle.loads(pickle.dumps(loaded)), pickle.loads(pickle.dumps(store.share_memory()))):
+        for i in range(len(codes)):
+            np.testing.assert_array_equal(pickled[i], np.flatnonzero(codes[i]))
+
+def test_collate_matches_loop(nested_data, dataset):
+    events, codes, labels = nested_data
+    idx = [3, 0, 7, 7, 11]
+    x, feats, masks, y = collate_fn([dataset[i] for i in idx], dataset.shape)
+    expected = loop_collate_fn([(events[i], codes[i], labels[i]) for i in idx], dataset.shape)
+    for expected_tensor, actual in zip(expected, (x, dense_feats(feats, dataset.num_codes), masks, y)):
+        assert expected_tensor.dtype == actual.dtype
+        torch.testing.assert_close(actual, expected_tensor)
+
+def test_packed_collate_holds_the_real_hours(dataset):
+    dataset.lengths = np.array([3, 8, 1, 5] * 3)
+    idx = [0, 1, 2, 3]
+    x, _, _, _ = collate_fn([dataset[i] for i in idx], dataset.shape)
+    packed, _, _, _ = packed_collate_fn([WithLengths(dataset)[i] for i in idx], dataset.shape)
+    padded, lengths = torch.nn.utils.rnn.pad_packed_sequence(packed, batch_first=True)
+    assert lengths.tolist() == [3, 8, 1, 5]
+    for i, length in enumerate(lengths):
+        torch.testing.assert_close(padded[i, :length], x[i, :length].flatten(start_dim=1))
@@ -0,0 +1,60 @@
+import numpy as np
+import torch
+
+from dataloader import (CodeStore, CustomDataset, EventStore, WithLengths, collate_fn, flatten_events, input_size,
+                        packed_collate_fn)
+from conftest import random_codes, random_events
+from models import LSTMPlusCNN, run_lstm
+
+
+def dataset_with_lengths(lengths, num_hours=8):
+    rng = np.random.default_rng(1)
+    events = EventStore(*flatten_events(random_events(rng, len(lengths), num_hours)),
+                        lengths=np.array(lengths, dtype=np.int32))
+    return CustomDataset(events, CodeStore.from_dense(random_codes(rng, len(lengths))), [i % 2 for i in range(len(lengths))])
+
+def packed_batch(dataset, indices):
+    items = WithLengths(dataset)
+    return packed_collate_fn([items[i] for i in indices], dataset.shape)
+
+def lstm_cnn(dataset):
+    torch.manual_seed(0)
+    return LSTMPlusCNN(input_size(dataset.shape), dataset.shape[1], dataset.num_codes, hidden_size=4, dropout=0.0)
+
+
+def test_packed_output_does_not_depend_on_the_batch():
+    dataset = dataset_with_lengths([4, 2, 8, 5, 3, 8])
+    model = lstm_cnn(dataset).eval()
+    outputs = []
+    with torch.no_grad():
+        for indices in ([0, 1], [0, 2, 3], [4, 0, 5]):
+            x, feats, masks, _ = packed_batch(dataset, indices)
+            outputs.append(model(x, feats, masks)[indices.index(0)])
+    for output in outputs[1:]:
+        torch.testing.assert_close(output, outputs[0])
+
+
+def test_packed_batch_norm_uses_the_real_hours_only():
+    dataset = dataset_with_lengths([4, 2, 8, 5])
+    model = lstm_cnn(dataset).train()
+    # with momentum 1 the running statistics are those of the last batch
+    model.bn.momentum = 1.0
+    x, feats, masks, _ = packed_batch(dataset, [0, 1, 2, 3])
+    model(x, feats, masks)
+
+    with torch.no_grad():
+        hidden = run_lstm(model.lstm, x)
+    real = torch.cat([hidden[i, :length] for i, length in enumerate([4, 2, 8, 5])])
+    torch.testing.assert_close(model.bn.running_mean, real.mean(dim=0))
+
+
+def test_odd_number_of_hours():
+    # 7 hours give 5 CNN outputs, pooled in pairs to 2 steps as nn.MaxPool1d(2) pools them
+    dataset = dataset_with_lengths([7, 3, 5], num_hours=7)
+    model = lstm_cnn(dataset).eval()
+    assert model.fc.in_features == 3 * 2
+    with torch.no_grad():
+        x, feats, masks, _ = collate_fn([dataset[i] for i in range(3)], dataset.shape)
+        assert model(x, feats, masks).shape == (3, 2)
+        x, feats, masks, _ = packed_batch(dataset, [0, 1, 2])
+        assert model(x, feats, masks).shape == (3, 2)
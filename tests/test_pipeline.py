@@ -0,0 +1,115 @@
+# End-to-end checks of the preprocessing backends and score.py on a small synthetic MIMIC III extract (see
+# benchmarks/synthetic_mimic.py), which every backend preprocesses as a script in its own directory
+
+import pickle
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+
+import inference
+import sql_backend_benchmark
+from checkpoint import save_checkpoint
+from conftest import ROOT_DIR
+from dataloader import CustomDataset, WithLengths, collate_fn, packed_collate_fn
+from training import build_model
+
+# small partitions and chunks, so the streaming mode and score.py go through several of them
+STREAM_OPTIONS = ['--stream', '--stays-per-partition', '7', '--chunk-size', '2000']
+
+
+@pytest.fixture(scope='module')
+def subset(tmp_path_factory):
+    return sql_backend_benchmark.synthetic_subset(str(tmp_path_factory.mktemp('synthetic')), 30, 0)
+
+@pytest.fixture(scope='module')
+def preprocessed(tmp_path_factory, subset):
+    # output directory of a preprocessing script and events_to_list.py run with options
+    out_dirs = {}
+    def run(script, *options):
+        if (script, options) not in out_dirs:
+            out_dir = str(tmp_path_factory.mktemp('preprocessed'))
+            sql_backend_benchmark.run(script, out_dir, ['--mimic-path', subset, *options])
+            out_dirs[script, options] = out_dir
+        return out_dirs[script, options]
+    return run
+
+def test_sql_backend_matches_pandas(preprocessed):
+    pytest.importorskip('duckdb')
+    reference = preprocessed(sql_backend_benchmark.PREPROCESS)
+    out_dir = preprocessed(sql_backend_benchmark.PREPROCESS_SQL, '--threads', '1')
+    assert sql_backend_benchmark.compare_outputs(reference, out_dir, rtol=1e-4) == []
+
+def test_streaming_matches_eager(preprocessed):
+    reference = preprocessed(sql_backend_benchmark.PREPROCESS)
+    out_dir = preprocessed(sql_backend_benchmark.PREPROCESS, *STREAM_OPTIONS)
+    expected, actual = CustomDataset.load(reference), CustomDataset.load(out_dir)
+
+    assert expected.shape == actual.shape
+    assert list(expected.y) == list(actual.y)
+    for name in ('counts', 'offsets', 'lengths'):
+        np.testing.assert_array_equal(getattr(expected.x, name), getattr(actual.x, name))
+    # the normalization statistics are accumulated chunk by chunk, so the values may differ in the last digits
+    np.testing.assert_allclose(expected.x.values, actual.x.values, rtol=1e-4, atol=1e-4)
+    for name in ('indices', 'offsets', 'vocab'):
+        np.testing.assert_array_equal(getattr(expected.feats, name), getattr(actual.feats, name))
+
+    for name in ('categories.pickle', 'preprocessing.pickle'):
+        expected, actual = sql_backend_benchmark.load(reference, name), sql_backend_benchmark.load(out_dir, name)
+        if name == 'preprocessing.pickle':
+            expected_stats, actual_stats = expected.pop('event_label_stats'), actual.pop('event_label_stats')
+            assert expected_stats['itemid'] == actual_stats['itemid']
+            for key in ('mean', 'std'):
+                np.testing.assert_allclose(expected_stats[key], actual_stats[key], rtol=1e-4)
+        assert expected == actual
+
+@pytest.mark.parametrize('name, kwargs, packed', [('LogisticRegression', {}, False),
+                                                  ('LSTMPlusCNN', {'hidden_size': 4}, False),
+                                                  ('ReadmissionLSTM', {'hidden_size': 4}, True)])
+def test_score_matches_checkpoint(tmp_path, subset, preprocessed, name, kwargs, packed):
+    # score.py preprocesses the stays of the subset again, with the statistics saved in the checkpoint, and must give
+    # the stays the model was trained on the probabilities the model gives them from the preprocessed data
+    data_dir = preprocessed(sql_backend_benchmark.PREPROCESS)
+    dataset = CustomDataset.load(data_dir)
+    torch.manual_seed(0)
+    model = build_model(name, dataset, **kwargs).eval()
+    save_checkpoint(tmp_path / 'model.pt', model, dataset, packed=packed)
+
+    subprocess.run([sys.executable, ROOT_DIR + '/score.py', '--checkpoint', str(tmp_path / 'model.pt'),
+                    '--mimic-path', subset, '--out', str(tmp_path / 'scores.csv'), '--stays-per-partition', '10'],
+                   check=True, stdout=subprocess.DEVNULL)
+    scores = pd.read_csv(tmp_path / 'scores.csv').set_index('icustay_id')['readmission_probability']
+
+    # the stays of the dataset are in icustay_id order
+    with open(data_dir + '/chart_events_df.pickle', 'rb') as f:
+        icustay_ids = np.sort(pickle.load(f)['icustay_id'].unique())
+    if packed:
+        batch = packed_collate_fn([WithLengths(dataset)[i] for i in range(len(dataset))], dataset.shape)
+    else:
+        batch = collate_fn([dataset[i] for i in range(len(dataset))], dataset.shape)
+    expected = inference.predict(inference.ReadmissionProbability(model).eval(), batch).numpy()
+    np.testing.assert_allclose(scores.loc[icustay_ids].to_numpy(), expected, rtol=1e-5, atol=1e-6)
+
+def test_score_keeps_leading_zeros_of_numeric_chunks(tmp_path, subset, preprocessed):
+    # DIAGNOSES_ICD.csv read in chunks of 50 rows holds chunks of numeric codes only, with codes such as '0389'
+    # whose leading zero a numeric column would lose
+    chunk_size = 50
+    codes = pd.read_csv(subset + 'DIAGNOSES_ICD.csv', dtype={'icd9_code': str})['icd9_code']
+    chunks = [codes[start:start + chunk_size] for start in range(0, len(codes), chunk_size)]
+    assert any(chunk.str.isdigit().all() and chunk.str.startswith('0').any() for chunk in chunks)
+
+    data_dir = preprocessed(sql_backend_benchmark.PREPROCESS)
+    dataset = CustomDataset.load(data_dir)
+    torch.manual_seed(0)
+    model = build_model('LogisticRegression', dataset).eval()
+    save_checkpoint(tmp_path / 'model.pt', model, dataset)
+    for name, options in (('whole.csv', []), ('chunked.csv', ['--chunk-size', str(chunk_size)])):
+        subprocess.run([sys.executable, ROOT_DIR + '/score.py', '--checkpoint', str(tmp_path / 'model.pt'),
+                        '--mimic-path', subset, '--out', str(tmp_path / name), *options],
+                       check=True, stdout=subprocess.DEVNULL)
+    whole = pd.read_csv(tmp_path / 'whole.csv').set_index('icustay_id')['readmission_probability']
+    chunked = pd.read_csv(tmp_path / 'chunked.csv').set_index('icustay_id')['readmission_probability']
+    np.testing.assert_allclose(chunked.loc[whole.index].to_numpy(), whole.to_numpy(), rtol=1e-6)
@@ -0,0 +1,78 @@
+from functools import partial
+
+import numpy as np
+import pytest
+import torch
+from torch.utils.data import DataLoader, SequentialSampler
+
+from dataloader import collate_fn, input_size, load_data
+from models import ReadmissionLSTM
+from training import HISTORY_VERSION, adam, build_model, criterion_for, kfold, model_builder, run_epoch
+
+
+class RecordingOptimizer:
+    # stands in for an optimizer and keeps the gradients of every step instead of applying them
+
+    def __init__(self, model):
+        self.params = list(model.parameters())
+        self.steps = []
+
+    def zero_grad(self):
+        for param in self.params:
+            param.grad = None
+
+    def step(self):
+        self.steps.append([param.grad.clone() for param in self.params])
+
+
+def test_accumulated_gradients_match_combined_batches(dataset):
+    torch.manual_seed(0)
+    model = ReadmissionLSTM(input_size(dataset.shape), dataset.shape[1], hidden_size=4, dropout=0.0)
+    criterion = torch.nn.CrossEntropyLoss()
+
+    # 12 stays in 6 batches of 2, accumulated over 4 batches: a group of 8 stays and a last group of 4
+    sampler = SequentialSampler(range(len(dataset)))
+    loader, _ = load_data(sampler, sampler, batch_size=2, dataset=dataset)
+    accumulated = RecordingOptimizer(model)
+    run_epoch(model, loader, criterion, accumulated, accumulation_steps=4)
+
+    combined_loader = DataLoader(dataset, batch_sampler=[list(range(8)), list(range(8, 12))],
+                                 collate_fn=partial(collate_fn, dims=dataset.shape))
+    combined = RecordingOptimizer(model)
+    run_epoch(model, combined_loader, criterion, combined)
+
+    assert len(accumulated.steps) == len(combined.steps) == 2
+    for accumulated_grads, combined_grads in zip(accumulated.steps, combined.steps):
+        for accumulated_grad, combined_grad in zip(accumulated_grads, combined_grads):
+            torch.testing.assert_close(accumulated_grad, combined_grad)
+
+
+@pytest.mark.parametrize('name, kwargs, bag, dense', [('LogisticRegression', {}, 'fc.weight', 'bias'),
+                                                     ('LSTMPlusCNN', {'hidden_size': 4}, 'icd9.weight', 'fc.weight')])
+def test_sparse_gradients_are_stepped(dataset, name, kwargs, bag, dense):
+    torch.manual_seed(0)
+    model = build_model(name, dataset, sparse_grad=True, **kwargs)
+    optimizer = adam(model, lr=0.01)
+    before = {key: value.clone() for key, value in model.state_dict().items()}
+
+    sampler = SequentialSampler(range(len(dataset)))
+    loader, _ = load_data(sampler, sampler, batch_size=4, dataset=dataset)
+    run_epoch(model, loader, criterion_for(model), optimizer)
+
+    # the code bag weights, stepped by SparseAdam, and the dense parameters, stepped by Adam
+    after = model.state_dict()
+    assert not torch.equal(after[bag], before[bag])
+    assert not torch.equal(after[dense], before[dense])
+
+
+def test_kfold_fold_processes(dataset):
+    # the folds train in spawned processes, which get the model builder and the shared dataset pickled
+    history = kfold(model_builder('LogisticRegression', dataset), dataset, torch.nn.BCELoss(), k_folds=2, n_epochs=2,
+                    batch_size=4, verbose=False, workers=2)
+    assert sorted(history[['fold', 'epoch']].tolist()) == [(0, 0), (0, 1), (1, 0), (1, 1)]
+    assert (history['version'] == HISTORY_VERSION).all()
+    assert not np.isnan(history['train_loss']).any()
+
+def test_kfold_rejects_lambdas(dataset):
+    with pytest.raises(ValueError, match='model_builder'):
+        kfold(lambda: build_model('LogisticRegression', dataset), dataset, torch.nn.BCELoss(), k_folds=2, workers=2)
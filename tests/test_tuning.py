@@ -0,0 +1,64 @@
+import numpy as np
+import torch
+from torch.utils.data import SequentialSampler
+
+from dataloader import CodeStore, CustomDataset, EventStore, input_size, load_data
+from models import LogisticRegression, LSTMPlusCNN
+from training import HISTORY_DTYPE, criterion_for, record_epoch, run_epoch
+from tuning import prune, rungs
+
+
+def label_code(feats):
+    # 1 for the stays of a batch with ICD-9 code 0, which the stays of the test dataset have if readmitted
+    codes, offsets = feats
+    return torch.nn.functional.embedding_bag(codes, (torch.arange(2) == 0).float().unsqueeze(1), offsets,
+                                             mode='max').squeeze(1)
+
+class ConfidentLSTM(LSTMPlusCNN):
+    # puts a probability of 0.9 on the label of every stay
+    def forward(self, x, feats, masks):
+        p = 0.1 + 0.8 * label_code(feats)
+        return torch.stack([1 - p, p], dim=1)
+
+class HedgingLogistic(LogisticRegression):
+    # puts a probability of 0.75 on the label of every stay
+    def forward(self, feats):
+        return (0.25 + 0.5 * label_code(feats)).unsqueeze(1)
+
+
+def test_prune_compares_models_by_nll(nested_data):
+    events, _, labels = nested_data
+    dataset = CustomDataset(EventStore.from_lists(events), CodeStore.from_dense([[label, 1] for label in labels]),
+                            labels)
+    models = {'lstm': ConfidentLSTM(input_size(dataset.shape), dataset.shape[1], dataset.num_codes, hidden_size=2),
+              'logistic': HedgingLogistic(dataset.num_codes)}
+    sampler = SequentialSampler(range(len(dataset)))
+    _, loader = load_data(sampler, sampler, batch_size=4, dataset=dataset)
+
+    histories = {}
+    for name, model in models.items():
+        test = run_epoch(model, loader, criterion_for(model))
+        histories[name] = np.zeros(1, dtype=HISTORY_DTYPE)
+        record_epoch(histories[name][0], 0, 0, test, test)
+
+    # the LSTM predicts the labels better, but nn.CrossEntropyLoss over its probabilities is higher than the
+    # nn.BCELoss of the logistic regression
+    assert histories['lstm']['test_nll'][0] < histories['logistic']['test_nll'][0]
+    assert histories['lstm']['test_loss'][0] > histories['logistic']['test_loss'][0]
+    np.testing.assert_allclose(histories['logistic']['test_nll'], histories['logistic']['test_loss'])
+    assert prune(['logistic', 'lstm'], histories, 1, eta=2) == ['lstm']
+
+def test_prune_puts_diverged_trials_last():
+    histories = {name: np.zeros(2, dtype=HISTORY_DTYPE) for name in 'abc'}
+    histories['a']['test_nll'] = [0.1, np.nan]
+    histories['b']['test_nll'] = [0.5, 0.6]
+    histories['c']['test_nll'] = [0.2, 0.4]
+    assert prune(list('abc'), histories, 1, eta=1) == ['a', 'c', 'b']
+    assert prune(list('abc'), histories, 2, eta=1) == ['c', 'b', 'a']
+    assert prune(list('abc'), histories, 2, eta=3) == ['c']
+
+def test_rungs():
+    assert rungs(1, 9, 3) == [1, 3, 9]
+    assert rungs(2, 9, 3) == [2, 6, 9]
+    assert rungs(1, 10, 3) == [1, 3, 9, 10]
+    assert rungs(9, 9, 3) == [9]
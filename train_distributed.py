@@ -0,0 +1,70 @@
+# Trains a readmission model with the data-parallel training of source/distributed.py: every rank trains on its shard
+# of the class-balanced sampler and the gradients are averaged over the ranks with the gloo backend, on CPUs.
+#
+# Started as it is, the script launches --nprocs ranks as processes on this machine, which split its CPUs between
+# them. Started by torchrun, it is one rank of a run that may span several machines, each running torchrun with the
+# same rendezvous endpoint and this script with the same options; rank 0 then prints the metrics and saves the
+# history and checkpoint. Every machine needs the data directory at --data-dir.
+#
+# --batch-size is per rank, so the model is stepped with batches of ranks * --batch-size stays.
+#
+# Usage:
+#   python3 train_distributed.py --data-dir data --model LSTMPlusCNN --hidden-size 128 --epochs 10 --nprocs 4
+#   torchrun --nnodes 2 --nproc-per-node 8 --rdzv-backend c10d --rdzv-endpoint node1:29500 \
+#       train_distributed.py --data-dir data --model LSTMPlusCNN --hidden-size 256 --epochs 10 --checkpoint fold-1.pt
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'source'))
+import distributed
+from checkpoint import MODELS
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data-dir', default=os.path.join(ROOT_DIR, 'data'))
+    parser.add_argument('--model', choices=list(MODELS), default='LSTMPlusCNN')
+    parser.add_argument('--hidden-size', type=int, default=128)
+    parser.add_argument('--encoding', default='events')
+    parser.add_argument('--packed', action='store_true')
+    parser.add_argument('--bucketing', action='store_true')
+    parser.add_argument('--num-workers', type=int, default=0, help='DataLoader workers of every rank')
+    parser.add_argument('--epochs', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=64, help='stays per batch of every rank')
+    parser.add_argument('--lr', type=float, default=0.002)
+    parser.add_argument('--accumulation-steps', type=int, default=1)
+    parser.add_argument('--sample', default='over', help='mode of training.subset_weighted_random_sampler')
+    parser.add_argument('--k-folds', type=int, default=5)
+    parser.add_argument('--fold', type=int, default=0, help='fold of the k-fold split to validate on')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--nprocs', type=int, default=2, help='ranks to launch on this machine without torchrun')
+    parser.add_argument('--checkpoint', help='path to save the trained model to')
+    parser.add_argument('--history', help='.npy file to save the history of every epoch to')
+    args = parser.parse_args()
+
+    model_kwargs = {} if args.model == 'LogisticRegression' else {'hidden_size': args.hidden_size}
+    config = {'data_dir': os.path.abspath(args.data_dir), 'model': args.model, 'model_kwargs': model_kwargs,
+              'k_folds': args.k_folds, 'fold': args.fold, 'seed': args.seed, 'n_epochs': args.epochs,
+              'batch_size': args.batch_size, 'lr': args.lr, 'accumulation_steps': args.accumulation_steps,
+              'sample': args.sample, 'checkpoint_path': args.checkpoint,
+              'loader_kwargs': {'encoding': args.encoding, 'packed': args.packed, 'bucketing': args.bucketing,
+                                'num_workers': args.num_workers}}
+
+    start_time = time.perf_counter()
+    if 'RANK' in os.environ:
+        result = distributed.run_torchrun(config)
+        if int(os.environ['RANK']) != 0:
+            sys.exit()
+    else:
+        result = distributed.launch_local(config, args.nprocs)[0]
+
+    print('{:.1f}s, {:.2f}s per training epoch'.format(time.perf_counter() - start_time,
+                                                       np.median(result['train_seconds'])))
+    if args.history is not None:
+        np.save(args.history, result['history'])